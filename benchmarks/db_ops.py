@@ -0,0 +1,76 @@
+"""
+Micro-benchmark of UserDB and SessionDB operations: ops/sec with a new connection per operation
+(how it was done before marktplaats_gpt.db) and with long-lived WAL connections.
+
+    python benchmarks/db_ops.py --ops 2000
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from marktplaats_gpt import users_db, sessions_db
+from marktplaats_gpt.db import close_all
+from marktplaats_gpt.users_db import UserDB
+from marktplaats_gpt.sessions_db import SessionDB
+
+
+def per_operation_connection(db_file, sql, params, fetch=False):
+    with sqlite3.connect(db_file) as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall() if fetch else None
+        conn.commit()
+    return rows
+
+
+BEFORE = {
+    'UserDB.set': lambda i: per_operation_connection(users_db.DB_FILE, "INSERT OR REPLACE INTO user_settings (username, setting_key, setting_value) VALUES (?, ?, ?)", (f"user{i % 50}", 'status', 'active')),
+    'UserDB.get': lambda i: per_operation_connection(users_db.DB_FILE, "SELECT setting_value FROM user_settings WHERE username=? and setting_key=?", (f"user{i % 50}", 'status'), fetch=True),
+    'SessionDB.create': lambda i: per_operation_connection(sessions_db.DB_FILE, "INSERT OR REPLACE INTO user_sessions (username) VALUES (?)", (f"user{i % 50}",)),
+    'SessionDB.use': lambda i: per_operation_connection(sessions_db.DB_FILE, "INSERT OR REPLACE INTO user_sessions (username, model, prompt_tokens, completion_tokens) VALUES (?,?,?,?)", (f"user{i % 50}", 'gpt-4-1106-preview', 500, 50)),
+}
+
+AFTER = {
+    'UserDB.set': lambda i: UserDB.set(f"user{i % 50}", 'status', 'active'),
+    'UserDB.get': lambda i: UserDB.get(f"user{i % 50}", 'status'),
+    'SessionDB.create': lambda i: SessionDB.create(f"user{i % 50}"),
+    'SessionDB.use': lambda i: SessionDB.use(f"user{i % 50}", 'gpt-4-1106-preview', 500, 50),
+}
+
+
+def ops_per_second(op, ops):
+    start = time.perf_counter()
+    for i in range(ops):
+        op(i)
+    return ops / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of UserDB and SessionDB operations.')
+    parser.add_argument('--ops', type=int, default=2000, help='Operations per benchmark (default is 2000)')
+    args = parser.parse_args()
+
+    print(f"{'operation':<20} {'before ops/s':>14} {'after ops/s':>14} {'speedup':>8}")
+    for name in AFTER:
+        results = []
+        for ops in [BEFORE, AFTER]:
+            # fresh databases for every run, in rollback-journal mode for "before", WAL is switched on by `connect`
+            with tempfile.TemporaryDirectory() as workdir:
+                os.chdir(workdir)
+                close_all()
+                if ops is BEFORE:
+                    per_operation_connection(users_db.DB_FILE, "CREATE TABLE user_settings (id INTEGER PRIMARY KEY, username TEXT, modified_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP, setting_key TEXT, setting_value TEXT, UNIQUE(username, setting_key))", ())
+                    per_operation_connection(sessions_db.DB_FILE, "CREATE TABLE user_sessions (id INTEGER PRIMARY KEY, username TEXT, created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP, model TEXT NULL, prompt_tokens INTEGER NULL, completion_tokens INTEGER NULL)", ())
+                else:
+                    UserDB.init_db()
+                    SessionDB.init_db()
+                results.append(ops_per_second(ops[name], args.ops))
+                close_all()
+                os.chdir('/')
+        before, after = results
+        print(f"{name:<20} {before:>14.0f} {after:>14.0f} {after / before:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
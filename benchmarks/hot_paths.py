@@ -0,0 +1,129 @@
+"""
+Micro-benchmarks of the bot hot paths on synthetic data (see synthetic.py): OpenAI cost over large histories,
+`/last` pages, conversation transcripts and database operations. Prints median time per operation of `--repeat`
+runs; data is seeded, so results of the same arguments are comparable across commits:
+
+    python benchmarks/hot_paths.py --json before.json
+    git checkout my-branch
+    python benchmarks/hot_paths.py --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import timeit
+import synthetic
+from marktplaats_gpt import bot
+from marktplaats_gpt.db import close_all
+from marktplaats_gpt.openai_pricing import openai_cost, openai_cost_micro_usd
+from marktplaats_gpt.sessions_db import SessionDB
+from marktplaats_gpt.users_db import UserDB
+
+
+def benchmarks(args, loop):
+    """Returns {name: operation}, with the databases filled with the synthetic history."""
+    users = synthetic.usernames(args.users)
+    events = synthetic.session_events(users, days=args.days)
+    heavy_user = users[0]
+    history = [event for event in events if event[0] == heavy_user and event[2]]
+    SessionDB.write_batch(events)
+    for username in users:
+        UserDB.set(username, 'status', 'active')
+    thread = synthetic.conversation(messages=args.messages)
+    sorted_items = sorted(thread['_embedded']['mc:message'], key=lambda x: x['receivedDate'])
+    peer = thread['_embedded']['otherParticipant']
+    page = synthetic.sessions_page()
+
+    return {
+        f'openai_cost ({len(history)} requests)': lambda: sum(openai_cost(model, prompt, completion) for _, _, model, prompt, completion, _ in history),
+        f'openai_cost_micro_usd ({len(history)} requests)': lambda: sum(openai_cost_micro_usd(model, prompt, completion) for _, _, model, prompt, completion, _ in history),
+        'users_openai_usage': lambda: loop.run_until_complete(bot.users_openai_usage(heavy_user)),
+        'time_end_and_delta': lambda: bot.time_end_and_delta("2023-10-13 12:00:00", "2023-10-15 15:42:17"),
+        'session_line (admin)': lambda: [bot.session_line(session, True) for session in page],
+        '/last page (all users)': lambda: [bot.session_line(session, True) for session in SessionDB.get_sessions_page(from_seconds=3600*24*7, limit=bot.LIST_PAGE_SIZE + 1)],
+        '/last page (one user)': lambda: [bot.session_line(session, True) for session in SessionDB.get_sessions_page(username=heavy_user, limit=bot.LIST_PAGE_SIZE + 1)],
+        f'render_transcript ({args.messages} messages)': lambda: bot.render_transcript(sorted_items, peer),
+        'UserDB.get': lambda: UserDB.get(heavy_user, 'status'),
+        'UserDB.set': lambda: UserDB.set(heavy_user, 'status', 'active'),
+        'SessionDB.create': lambda: SessionDB.create(heavy_user),
+        'SessionDB.use': lambda: SessionDB.use(heavy_user, 'gpt-4-1106-preview', 500, 50),
+        'SessionDB.get_usage': lambda: SessionDB.get_usage(heavy_user),
+    }
+
+
+def seconds_per_op(op, repeat):
+    timer = timeit.Timer(op)
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f} us"
+    return f"{seconds * 1e3:.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the bot hot paths on synthetic data.')
+    parser.add_argument('--users', type=int, default=50, help='Users with session history (default is 50)')
+    parser.add_argument('--days', type=int, default=30, help='Days of session history (default is 30)')
+    parser.add_argument('--messages', type=int, default=200, help='Messages in the rendered conversation (default is 200)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark, the median is reported (default is 5)')
+    parser.add_argument('--filter', default='', help='Run only benchmarks with this in their name')
+    parser.add_argument('--json', metavar='FILE', help='Save results to FILE, for --compare on another commit')
+    parser.add_argument('--compare', metavar='FILE', help='Compare with results saved by --json')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline['sizes'] != {'users': args.users, 'days': args.days, 'messages': args.messages}:
+            print(f"Warning: {args.compare} was made with other sizes: {baseline['sizes']}")
+
+    results = {}
+    loop = asyncio.new_event_loop()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            UserDB.init_db()
+            SessionDB.init_db()
+            print(f"{'benchmark':<45} {'time/op':>12}" + (f" {'before':>12} {'change':>8}" if baseline else ""))
+            for name, op in benchmarks(args, loop).items():
+                if args.filter not in name:
+                    continue
+                results[name] = seconds_per_op(op, args.repeat)
+                line = f"{name:<45} {format_time(results[name]):>12}"
+                before = baseline['results'].get(name) if baseline else None
+                if before:
+                    line += f" {format_time(before):>12} {(results[name] / before - 1) * 100:>+7.1f}%"
+                print(line)
+        finally:
+            close_all()
+            loop.close()
+            os.chdir(cwd)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'sizes': {'users': args.users, 'days': args.days, 'messages': args.messages},
+                'results': results,
+            }, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Startup time of the entry points: median wall time of `--runs` fresh interpreter runs and the slowest top-level
+imports as reported by `python -X importtime`.
+
+    python benchmarks/startup.py --runs 10
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+ENTRY_POINTS = {
+    'python (bare interpreter)': ['-c', 'pass'],
+    'marktplaats-gpt --help': ['-m', 'marktplaats_gpt.main', '--help'],
+    'marktplaats-gpt (import)': ['-c', 'import marktplaats_gpt.main'],
+    'marktplaats-gpt-bot (import)': ['-c', 'import marktplaats_gpt.bot'],
+    'marktplaats-gpt-fake-openai --help': ['-m', 'marktplaats_gpt.fake_openai', '--help'],
+}
+
+
+def wall_time(args, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def top_imports(args, top):
+    """Returns (cumulative microseconds, module) of the slowest imports of the entry point and of its direct imports."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if len(name) - len(name.lstrip()) > 3:
+            continue # deeper than imports of the entry point's modules, counted in their cumulative times
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of entry points startup time.')
+    parser.add_argument('--runs', type=int, default=10, help='Runs per entry point (default is 10)')
+    parser.add_argument('--top', type=int, default=5, help='Slowest imports shown per entry point (default is 5)')
+    args = parser.parse_args()
+
+    for name, entry_args in ENTRY_POINTS.items():
+        print(f"{name:<40} {wall_time(entry_args, args.runs) * 1000:>8.1f} ms")
+        for cumulative, module in top_imports(entry_args, args.top):
+            print(f"    {module:<36} {cumulative / 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Synthetic data for benchmarks: users, their session histories and Marktplaats conversations with long message
+threads. Everything is generated from a seeded `random.Random`, so the same arguments give the same data on every
+run and commit.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+from marktplaats_gpt.openai_pricing import OPENAI_PRICES, openai_cost_micro_usd
+
+
+WORDS = (
+    "hallo is it still available yes I can pick up tomorrow will you sell for what is the lowest price "
+    "does it work fine any scratches can you send it by post how old is it thanks goedemiddag nog beschikbaar"
+).split()
+
+
+def text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + rng.choice("?.!")
+
+
+def usernames(count):
+    return [f"user{i}" for i in range(count)]
+
+
+def session_events(users, days=30, sessions_per_day=3, requests_per_session=4, seed=1):
+    """
+    Returns session history of `users` over the last `days`, as `SessionDB.write_batch` events sorted by time:
+    every session is a start followed by up to `requests_per_session` OpenAI requests of a random known model.
+    """
+    rng = random.Random(seed)
+    models = sorted(OPENAI_PRICES)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    events = []
+    for username in users:
+        for day in range(days):
+            for _ in range(sessions_per_day):
+                created = now - timedelta(days=day, seconds=rng.randrange(3600, 24 * 3600)) # requests stay in the past
+                events.append((username, created, None, None, None, None))
+                for _ in range(rng.randint(1, requests_per_session)):
+                    created += timedelta(seconds=rng.randint(5, 600))
+                    model = rng.choice(models)
+                    prompt_tokens, completion_tokens = rng.randint(200, 4000), rng.randint(20, 400)
+                    events.append((username, created, model, prompt_tokens, completion_tokens, openai_cost_micro_usd(model, prompt_tokens, completion_tokens)))
+    events.sort(key=lambda event: event[1])
+    return [(username, created.strftime("%Y-%m-%d %H:%M:%S"), *usage) for username, created, *usage in events]
+
+
+def conversation(messages=25, peer_id=1000, seed=1):
+    """Returns a conversation as `Client.get_conversation` does, with `messages` messages alternating between peer and us."""
+    rng = random.Random(seed)
+    start = datetime(2023, 10, 13, tzinfo=timezone.utc)
+    return {
+        'totalCount': messages,
+        'limit': messages,
+        'offset': 0,
+        '_embedded': {
+            'otherParticipant': {'id': peer_id, 'name': f"Buyer{peer_id}"},
+            'mc:message': [
+                {
+                    'senderId': peer_id if i % 2 == 0 else 42,
+                    'text': text(rng, rng.randint(3, 60)),
+                    'receivedDate': (start + timedelta(minutes=7 * i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    'isRead': rng.random() < 0.8,
+                }
+                for i in range(messages)
+            ],
+        },
+    }
+
+
+def sessions_page(count=20, seed=1):
+    """Returns a page of sessions as `SessionDB.get_sessions_page` does, every fifth one being a compacted day."""
+    rng = random.Random(seed)
+    start = datetime(2023, 10, 13, 12, tzinfo=timezone.utc)
+    page = []
+    for i in range(count):
+        start_time = start - timedelta(hours=3 * i)
+        end_time = start_time + timedelta(seconds=rng.randint(0, 3 * 24 * 3600))
+        page.append({
+            'username': f"user{i % 7}",
+            'start_time': start_time.strftime("%Y-%m-%d %H:%M:%S"),
+            'end_time': end_time.strftime("%Y-%m-%d %H:%M:%S"),
+            'sessions_count': rng.randint(1, 9) if i % 5 == 4 else 1,
+            'requests_count': rng.randint(0, 12),
+            'prompt_tokens': rng.randint(0, 40000),
+            'completion_tokens': rng.randint(0, 4000),
+            'cost_micro_usd': rng.randint(0, 2000000),
+            'unpriced_count': 0,
+            'compacted': i % 5 == 4,
+        })
+    return page
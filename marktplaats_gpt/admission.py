@@ -0,0 +1,215 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from marktplaats_gpt import metrics, tracing
+
+
+# Expensive operations of the bot: OpenAI completions, Marktplaats API calls (/start, /archive) and item pages
+SUGGESTION, LISTING, SCRAPING = 'suggestion', 'listing', 'scraping'
+
+OPERATION_NAMES = {
+    SUGGESTION: "ChatGPT suggestions",
+    LISTING: "Marktplaats requests",
+    SCRAPING: "conversation loads",
+}
+
+# operation: (requests per minute, burst) of every user
+DEFAULT_LIMITS = {
+    SUGGESTION: (10, 5),
+    LISTING: (6, 3),
+    SCRAPING: (20, 10),
+}
+
+
+class TokenBucket:
+    """Allows `burst` requests at once and `rate` requests per second on average."""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes a token, returns 0 if there was one, or seconds until there will be one."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class FairQueue:
+    """
+    Budget of `concurrency` requests running at once, shared between users by start-time fair queueing (a variant
+    of weighted fair queueing): a request's start tag is the later of the queue's virtual time and the finish tag
+    of the user's previous request, its finish tag is the start tag + 1 / weight, and the waiting request with
+    the smallest start tag runs next. A user sending many requests is served as often as the others, a user with
+    weight 2 twice as often. Not thread-safe, used from the event loop.
+    """
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.running = 0
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.waiting = [] # heap of (start tag, sequence number, future)
+        self.sequence = itertools.count()
+
+    def enqueue(self, user, weight=1.0):
+        """Returns a future resolved when the request may run and its position in the queue, 0 if it runs now."""
+        start = max(self.virtual_time, self.finish_tags.get(user, 0.0))
+        self.finish_tags[user] = start + 1.0 / weight
+        future = asyncio.get_running_loop().create_future()
+        if self.running < self.concurrency:
+            # below the budget nobody is waiting, but requests cancelled while they were
+            self.waiting.clear()
+            self.running += 1
+            self.virtual_time = start
+            future.set_result(None)
+            return future, 0
+        entry = (start, next(self.sequence), future)
+        heapq.heappush(self.waiting, entry)
+        metrics.ADMISSION_QUEUED.set(len(self.waiting))
+        return future, sum(1 for waiting in self.waiting if waiting[:2] <= entry[:2] and not waiting[2].cancelled())
+
+    def release(self):
+        self.running -= 1
+        while self.waiting and self.running < self.concurrency:
+            start, _, future = heapq.heappop(self.waiting)
+            if future.cancelled():
+                continue
+            self.running += 1
+            self.virtual_time = start
+            future.set_result(None)
+        metrics.ADMISSION_QUEUED.set(len(self.waiting))
+        if not self.running and not self.waiting:
+            # idle, so nobody is behind anybody anymore
+            self.finish_tags.clear()
+            self.virtual_time = 0.0
+
+
+class Admission:
+    """
+    Admission of expensive operations of the bot: every user has a token bucket per operation, refusing requests
+    above its rate with a reply saying when to try again, and all operations share a `concurrency` budget,
+    queued fairly between users (see FairQueue) with a "You're queued (#3)" reply to the waiting ones.
+
+    `limits` are {operation: (requests per minute, burst)}, 0 requests per minute is no limit, `concurrency` 0 is
+    no budget. `weights` are {username: weight} in the queue, 1 by default. Limits are per bot process.
+    """
+    def __init__(self, limits=DEFAULT_LIMITS, concurrency=8, weights=None):
+        self.limits = limits
+        self.weights = weights or {}
+        self.buckets = {}
+        self.queue = FairQueue(concurrency) if concurrency > 0 else None
+
+    @classmethod
+    def from_env(cls):
+        limits = {}
+        for operation, (per_minute, burst) in DEFAULT_LIMITS.items():
+            limits[operation] = (
+                float(os.environ.get(f"ADMISSION_{operation.upper()}_PER_MINUTE", str(per_minute))),
+                float(os.environ.get(f"ADMISSION_{operation.upper()}_BURST", str(burst))),
+            )
+        weights = {}
+        for item in os.environ.get("ADMISSION_WEIGHTS", "").split(','):
+            if item.strip():
+                username, weight = item.split('=', 1)
+                weights[username.strip()] = float(weight)
+        return cls(limits=limits, concurrency=int(os.environ.get("ADMISSION_CONCURRENCY", "8")), weights=weights)
+
+    async def allow(self, update: Update, operation: str):
+        """Takes a token of the user's bucket for `operation`, if there is none replies when to try again and returns False."""
+        per_minute, burst = self.limits[operation]
+        if per_minute <= 0:
+            return True
+        username = update.effective_user.username
+        bucket = self.buckets.get((username, operation))
+        if bucket is None:
+            bucket = self.buckets[(username, operation)] = TokenBucket(per_minute / 60.0, max(1.0, burst))
+        retry_after = bucket.take()
+        if not retry_after:
+            return True
+        metrics.ADMISSION_REJECTIONS.inc(operation=operation)
+        logging.warning("User %s exceeded %s limit of %s per minute", username, operation, per_minute)
+        await update.message.reply_text(
+            f"<i>Too many {OPERATION_NAMES[operation]}, please try again in {retry_after:.0f} seconds.</i>",
+            parse_mode='HTML'
+        )
+        return False
+
+    @asynccontextmanager
+    async def slot(self, update: Update, operation: str):
+        """Waits for a slot of the concurrency budget, telling the user their place in the queue, and runs in it:
+
+            async with admission.slot(update, SUGGESTION):
+                completion = await asyncio.to_thread(openai.ChatCompletion.create, ...)
+        """
+        if self.queue is None:
+            yield
+            return
+        username = update.effective_user.username
+        start = time.perf_counter()
+        future, position = self.queue.enqueue(username, self.weights.get(username, 1.0))
+        try:
+            if position:
+                logging.info("User %s is queued for %s at #%d", username, operation, position)
+                await update.message.reply_text(f"<i>You're queued (#{position}), requests of all users are served in turn.</i>", parse_mode='HTML')
+            with tracing.child_span("admission wait", operation=operation, position=position):
+                await future
+        except BaseException:
+            # cancelled or failed to reply, the slot is given back or the place in the queue is left
+            if future.done() and not future.cancelled():
+                self.queue.release()
+            else:
+                future.cancel()
+            raise
+        metrics.ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, operation=operation)
+        try:
+            yield
+        finally:
+            self.queue.release()
+
+
+class ChatSequentialUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently, up to `max_concurrent_updates`, and updates of one chat
+    one by one in their order, as ConversationHandler needs. Updates waiting for their chat don't take the
+    concurrency, so one chat sending many updates doesn't hold up the others.
+    """
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.chats = {} # chat id: [lock, number of its updates being processed or waiting]
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self.chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chats[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+from marktplaats_gpt.db import SQLiteStorage, migrate, storage, utc_timestamp
+
+
+DB_FILE = 'archive.db'
+
+MIGRATIONS = [
+    # 1: conversations and messages of Marktplaats accounts (owner is bot's username, '' for the cli),
+    # with full-text index over message texts and item titles, filled by triggers
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            owner TEXT,
+            id TEXT,
+            item_id TEXT,
+            title TEXT,
+            peer_name TEXT,
+            fingerprint TEXT,
+            synced_time TIMESTAMP,
+            PRIMARY KEY (owner, id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            conversation_id TEXT NOT NULL,
+            received_date TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            from_peer INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            UNIQUE (owner, conversation_id, received_date, sender_id)
+        )
+        ''',
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(title, text, tokenize='unicode61 remove_diacritics 2')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, title, text)
+            SELECT new.id, title, new.text FROM conversations WHERE owner = new.owner AND id = new.conversation_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_title AFTER UPDATE OF title ON conversations BEGIN
+            UPDATE messages_fts SET title = new.title
+            WHERE rowid IN (SELECT id FROM messages WHERE owner = new.owner AND conversation_id = new.id);
+        END
+        ''',
+    ],
+]
+
+SEARCH = """
+    SELECT c.id, c.title, c.peer_name, c.item_id, m.received_date, m.from_peer,
+        snippet(messages_fts, 1, ?, ?, '…', 16)
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.owner = m.owner AND c.id = m.conversation_id
+    WHERE messages_fts MATCH ? AND m.owner = ? AND substr(m.received_date, 1, 10) >= ?
+    ORDER BY bm25(messages_fts)
+    LIMIT ?
+"""
+
+# Last buyer message before every seller reply, of all conversations in the order the buyer messages were received
+REPLY_PAIRS = """
+    SELECT question, reply FROM (
+        SELECT id, received_date, text AS question, from_peer,
+            LEAD(text) OVER conversation_messages AS reply,
+            LEAD(from_peer) OVER conversation_messages AS reply_from_peer
+        FROM messages
+        WHERE owner = ?
+        WINDOW conversation_messages AS (PARTITION BY conversation_id ORDER BY received_date, id)
+    ) AS pairs
+    WHERE from_peer = 1 AND reply_from_peer = 0
+    ORDER BY received_date, id
+"""
+
+_local_storage = SQLiteStorage()
+
+
+def connect():
+    """
+    Archive is always an SQLite database, as it needs FTS5: in the configured storage directory, or in the current
+    one when the bot's state is kept in Postgres.
+    """
+    configured = storage()
+    return (configured if isinstance(configured, SQLiteStorage) else _local_storage).connect(DB_FILE)
+
+
+def match_query(query: str):
+    """Turns words of `query` into an FTS5 query matching all of them, `word*` matches a prefix."""
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return " ".join(terms)
+
+
+class ArchiveDB:
+    def init_db():
+        migrate(connect(), MIGRATIONS)
+
+
+    def get_fingerprints(owner: str):
+        """Returns fingerprints of archived conversations of `owner` by conversation id."""
+        with connect() as conn:
+            cursor = conn.execute("SELECT id, fingerprint FROM conversations WHERE owner=?", (owner,))
+            return dict(cursor.fetchall())
+
+
+    def save_conversation(owner: str, conv, messages, fingerprint: str):
+        """
+        Archives conversation `conv` (an entry of conversations listing) with its `messages` (as returned by
+        `Client.get_conversation`), returns number of messages new to the archive.
+        """
+        peer = messages['_embedded']['otherParticipant']
+        with connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO conversations (owner, id, item_id, title, peer_name, fingerprint, synced_time) VALUES (?,?,?,?,?,?,?)
+                ON CONFLICT(owner, id) DO UPDATE SET
+                    item_id = excluded.item_id,
+                    title = excluded.title,
+                    peer_name = excluded.peer_name,
+                    fingerprint = excluded.fingerprint,
+                    synced_time = excluded.synced_time
+                """,
+                (owner, conv['id'], conv['itemId'], conv['title'], peer['name'], fingerprint, utc_timestamp())
+            )
+            count_messages = lambda: conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE owner=? AND conversation_id=?", (owner, conv['id'])
+            ).fetchone()[0]
+            before = count_messages()
+            conn.executemany(
+                """
+                INSERT INTO messages (owner, conversation_id, received_date, sender_id, from_peer, text) VALUES (?,?,?,?,?,?)
+                ON CONFLICT DO NOTHING
+                """,
+                [
+                    (owner, conv['id'], m['receivedDate'], str(m['senderId']), m['senderId'] == peer['id'], m['text'])
+                    for m in messages['_embedded']['mc:message']
+                ]
+            )
+            return count_messages() - before
+
+
+    def get_version(owner: str):
+        """Returns a number changing whenever messages of `owner` are added."""
+        with connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages WHERE owner=?", (owner,)).fetchone()[0]
+
+
+    def get_reply_pairs(owner: str):
+        """Returns (buyer message, seller reply) pairs of archived conversations of `owner`, oldest first."""
+        with connect() as conn:
+            return conn.execute(REPLY_PAIRS, (owner,)).fetchall()
+
+
+    def search(owner: str, query: str, limit: int = 20, from_seconds: int = None, highlight=('[', ']')):
+        """
+        Returns messages of `owner` matching all words of `query`, best matches first, optionally only of the days
+        in last `from_seconds`. Matched words in the snippets are wrapped in `highlight` marks.
+        """
+        fts_query = match_query(query)
+        if not fts_query:
+            return []
+        from_day = utc_timestamp(from_seconds)[:10] if from_seconds else ''
+        with connect() as conn:
+            cursor = conn.execute(SEARCH, (*highlight, fts_query, owner, from_day, limit))
+            return [
+                {
+                    'conversation': conversation_id,
+                    'title': title,
+                    'peer': peer_name,
+                    'itemId': item_id,
+                    'receivedDate': received_date,
+                    'from_peer': bool(from_peer),
+                    'snippet': snippet,
+                }
+                for conversation_id, title, peer_name, item_id, received_date, from_peer, snippet in cursor.fetchall()
+            ]
+
+
+def fingerprint(conv):
+    return hashlib.sha1(json.dumps(conv, sort_keys=True).encode()).hexdigest()
+
+
+def sync(client, owner: str = '', page_size: int = 50):
+    """
+    Archives all conversations of `client`'s account. Messages are fetched only for conversations whose listing
+    entry changed since the previous sync. Returns counts of listed and fetched conversations and new messages.
+    """
+    from marktplaats_gpt.batch import all_conversations
+    counts = {'conversations': 0, 'fetched': 0, 'messages': 0}
+    fingerprints = ArchiveDB.get_fingerprints(owner)
+    for conv in all_conversations(client, page_size=page_size):
+        counts['conversations'] += 1
+        conv_fingerprint = fingerprint(conv)
+        if fingerprints.get(conv['id']) == conv_fingerprint:
+            continue
+        messages = client.get_conversation(conv['id'])
+        if messages['totalCount'] > messages['limit'] + messages['offset']:
+            logging.warning("Archiving %d of %d messages of conversation %s", messages['limit'], messages['totalCount'], conv['id'])
+        counts['fetched'] += 1
+        counts['messages'] += ArchiveDB.save_conversation(owner, conv, messages, conv_fingerprint)
+    logging.info("Archived %s for %r", counts, owner)
+    return counts
@@ -0,0 +1,56 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from marktplaats_gpt import metrics
+from marktplaats_gpt.users_db import UserDB
+from marktplaats_gpt.sessions_db import SessionDB
+from marktplaats_gpt.archive_db import ArchiveDB
+
+
+_executor = None
+
+
+def executor():
+    """
+    Database calls of the bot run on these threads, not on the event loop, DB_THREADS of them started on first use.
+    Every thread keeps its own long-lived connections (see marktplaats_gpt.db). One thread (the default) serializes
+    the writes of the handlers, but not all writes of the process: session events are written by the thread of
+    the write buffer (see marktplaats_gpt.write_buffer) and sessions compaction runs on a thread of its own, so that
+    its long transactions don't hold up the handlers. SQLite's busy timeout makes these writers wait for each other.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=int(os.environ.get("DB_THREADS", "1")), thread_name_prefix='db')
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    """Runs blocking `func` on a database thread and waits for the result, timing it for metrics."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, metrics.timed_call, func.__qualname__, func, *args, **kwargs)
+    return await loop.run_in_executor(executor(), call)
+
+
+class AsyncDB:
+    """
+    Awaitable version of a DB class, for the async handlers, the sync one stays for the CLI:
+
+        await AsyncUserDB.get(username, 'status')
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+
+        async def call(*args, **kwargs):
+            return await run(method, *args, **kwargs)
+
+        return call
+
+
+AsyncUserDB = AsyncDB(UserDB)
+AsyncSessionDB = AsyncDB(SessionDB)
+AsyncArchiveDB = AsyncDB(ArchiveDB)
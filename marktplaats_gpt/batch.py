@@ -0,0 +1,168 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai
+from marktplaats_messages.client import Client
+from marktplaats_gpt.scraping import load_item_data
+
+
+_local = threading.local()
+
+
+def thread_client():
+    """Marktplaats client of the current worker thread, clients are not shared between threads."""
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client = Client()
+        _local.client = client
+    return client
+
+
+def unread_conversations(client, offset=0, page_size=50, max_conversations=200, include_read=False):
+    """
+    Pages through conversations, newest first, yielding the ones with unread messages, or all of them
+    with `include_read` (listed conversations don't tell who sent the last message, `suggest` checks it).
+
+    Stops after `max_conversations` listed, at the end of the list, or, without `include_read`, at a page without
+    unread conversations (conversations are ordered by update time, so older pages are not expected to have any).
+    """
+    listed = 0
+    while listed < max_conversations:
+        limit = min(page_size, max_conversations - listed)
+        convs = client.get_conversations(params={
+            'offset': str(offset + listed),
+            'limit': str(limit),
+        })['_embedded']['mc:conversations']
+        listed += len(convs)
+        unread = [conv for conv in convs if conv['unreadMessagesCount']]
+        logging.info("Listed %d conversations from %d, %d unread", len(convs), offset + listed - len(convs), len(unread))
+        yield from convs if include_read else unread
+        if len(convs) < limit or not (unread or include_read):
+            return
+
+
+def all_conversations(client, offset=0, page_size=50):
+    """
+    Pages through all conversations, newest first, yielding them one by one.
+
+    The next page is fetched on a background thread while the current one is consumed, so at most two pages
+    are held in memory. Stops at the first page shorter than `page_size`.
+    """
+    def fetch(start):
+        return client.get_conversations(params={
+            'offset': str(start),
+            'limit': str(page_size),
+        })['_embedded']['mc:conversations']
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch') as executor:
+        page = executor.submit(fetch, offset)
+        while page:
+            convs = page.result()
+            logging.info("Listed %d conversations from %d", len(convs), offset)
+            offset += len(convs)
+            page = executor.submit(fetch, offset) if len(convs) == page_size else None
+            yield from convs
+
+
+def suggest(conv, context, openai_model, client=None, since=None):
+    """
+    Fetches messages and item data of conversation `conv` and asks ChatGPT for a reply suggestion,
+    if the last message is from the peer (and received after `since`, if given). Returns the result as a dict.
+
+    Uses `client` or, on worker threads, the thread's own one.
+    """
+    start = time.perf_counter()
+    result = {
+        'conversation': conv['id'],
+        'title': conv['title'],
+        'peer': conv['otherParticipant']['name'],
+        'itemId': conv['itemId'],
+    }
+    messages = (client or thread_client()).get_conversation(conv['id'])
+    peer = messages['_embedded']['otherParticipant']
+    sorted_items = sorted(messages['_embedded']['mc:message'], key=lambda x: x['receivedDate'], reverse=False)
+    last_message = sorted_items[-1]
+    result['last_message'] = {'receivedDate': last_message['receivedDate'], 'text': last_message['text']}
+    if last_message['senderId'] != peer['id']:
+        result['skipped'] = "last message was not from peer"
+        return result
+    if since and last_message['receivedDate'] <= since:
+        result['skipped'] = "no new messages from peer"
+        return result
+
+    item_data, url = load_item_data(conv['itemId'])
+    if not item_data:
+        result['skipped'] = f"no product description at {url}"
+        return result
+
+    completion_messages = [{"role": "system", "content": context + "\n" + item_data}]
+    for m in sorted_items:
+        completion_messages.append({
+            "role": "user" if m['senderId'] == peer['id'] else "assistant",
+            "content": m['text']
+        })
+    logging.debug("About to ask ChatGPT %s model for completion to %s", openai_model, completion_messages)
+    completion = openai.ChatCompletion.create(model=openai_model, messages=completion_messages)
+    logging.debug("Usage: %s", completion.usage)
+    result['model'] = completion.model
+    result['usage'] = {'prompt_tokens': completion.usage.prompt_tokens, 'completion_tokens': completion.usage.completion_tokens}
+    result['suggestion'] = completion.choices[0].message.content
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def print_result(result):
+    print(f"=== {result['title']} :: {result['peer']} :: {result['conversation']}")
+    if 'last_message' in result:
+        print(f"[{result['last_message']['receivedDate']}] {result['peer']}: {result['last_message']['text']}")
+    if 'error' in result:
+        print(f"Failed: {result['error']}")
+    elif 'skipped' in result:
+        print(f"Skipped: {result['skipped']}")
+    else:
+        print(f"Suggested answer ({result['model']}): {result['suggestion']}")
+    print()
+
+
+def run_batch(client, context, openai_model, concurrency=4, offset=0, page_size=50, max_conversations=200, output=None,
+              include_read=False):
+    """
+    Suggests replies for unread conversations waiting for an answer, or for all conversations waiting for
+    an answer with `include_read`, on `concurrency` threads.
+
+    Workers start as soon as a page of conversations is listed, results are printed (and written to `output` file
+    as JSON lines) in order of completion, while the listing goes on. No replies are sent. Returns counts of the results.
+    """
+    start = time.perf_counter()
+    counts = {'suggested': 0, 'skipped': 0, 'failed': 0}
+
+    def report(future, conv):
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.exception("Suggestion for conversation %s failed", conv['id'])
+            result = {'conversation': conv['id'], 'title': conv['title'], 'peer': conv['otherParticipant']['name'], 'itemId': conv['itemId'], 'error': str(e)}
+        if 'error' in result:
+            counts['failed'] += 1
+        elif 'skipped' in result:
+            counts['skipped'] += 1
+        else:
+            counts['suggested'] += 1
+        print_result(result)
+        if output:
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+    print(f"Suggesting replies for {'all' if include_read else 'unread'} conversations, {concurrency} at a time...\n")
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+        futures = {}
+        for conv in unread_conversations(client, offset, page_size, max_conversations, include_read):
+            futures[executor.submit(suggest, conv, context, openai_model)] = conv
+            for future in [future for future in futures if future.done()]:
+                report(future, futures.pop(future))
+        for future in as_completed(futures):
+            report(future, futures[future])
+    print(f"{counts['suggested']} suggested, {counts['skipped']} skipped, {counts['failed']} failed in {time.perf_counter() - start:.1f}s")
+    return counts
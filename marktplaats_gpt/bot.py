@@ -1,12 +1,16 @@
+import asyncio
+import html
 import logging
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.ext import (
     filters,
+    CallbackQueryHandler,
     MessageHandler,
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler
 )
 from dotenv import load_dotenv
 import os
@@ -15,19 +19,49 @@ from header_hunter.sniff import sniff_cookie_from_text
 from header_hunter.store import store_value
 import re
 import openai
-from marktplaats_gpt.main import load_context
-from marktplaats_gpt.scraping import load_item_data
+from marktplaats_gpt import metrics, tracing
+from marktplaats_gpt.admission import Admission, ChatSequentialUpdateProcessor
+from marktplaats_gpt.chat_context import ContextRegistry
+from marktplaats_gpt.client_pool import ClientPool
+from marktplaats_gpt.logging_config import configure_logging
+from marktplaats_gpt.model_routing import ModelRouter
+from marktplaats_gpt.profiler import UpdateProfiler
+from marktplaats_gpt.scraping import ItemParserPool, fetch_item_page
 from marktplaats_gpt.user_session import UserSession
 from marktplaats_gpt.users_db import UserDB
 from marktplaats_gpt.sessions_db import SessionDB
+from marktplaats_gpt.async_db import AsyncUserDB, AsyncSessionDB, AsyncArchiveDB, run as run_db
+from marktplaats_gpt.archive_db import ArchiveDB, sync as sync_archive
+from marktplaats_gpt.reply_index import best_reply
+from marktplaats_gpt.state_db import StateDB, SharedStatePersistence, refresh_conversations, save_state
+from marktplaats_gpt.write_buffer import session_writes
 from marktplaats_gpt.version_info import version as the_version
 from datetime import datetime
+from urllib.parse import urlparse
 
 
 CONVERSATION_NUMBER_PATTERN = r' \((\d*)\)$'
 
 CONVERSATION, SUGGESTION = range(2)
 
+# Components of the bot configured by env vars, set by `configure`
+contexts = None
+profiler = None
+admission = None
+clients = None
+item_parser = None
+
+
+def configure():
+    """Creates components of the bot from env vars, call it after .env is loaded and before building the application."""
+    global contexts, profiler, admission, clients, item_parser
+    contexts = ContextRegistry.from_env()
+    profiler = UpdateProfiler.from_env()
+    admission = Admission.from_env()
+    # Client is looked up on every call, the load test replaces it
+    clients = ClientPool.from_env(lambda cookie: Client(load_env=False, use_jar=False, cookie=cookie))
+    item_parser = ItemParserPool.from_env()
+
 
 def conversation_url(conversation_id):
     return f"https://www.marktplaats.nl/link/messages/{conversation_id}" # using '/link' makes it a Universal Link, see https://www.marktplaats.nl/.well-known/apple-app-site-association
@@ -65,24 +99,9 @@ def time_end_and_delta(str1, str2):
         return f"{hours_str2:02}:{minutes_str2:02}:{seconds_str2:02} ({hours:02}:{minutes:02}:{seconds:02})"
 
 
-def openai_cost(model: str, prompt_tokens: int, completion_tokens: int):
-    """
-    Return estimated cost of OpenAI completion, based on prices at https://openai.com/pricing as of 2023-10-23.
-
-    See https://platform.openai.com/docs/models/continuous-model-upgrades for models status.
-    """
-    if model == "gpt-4-1106-preview": # 128k context	$0.01 / 1K tokens	$0.03 / 1K tokens
-        return (0.01 * prompt_tokens ) / 1000.0 + (0.03 * completion_tokens) / 1000.0
-    elif model == "gpt-4-0613": # 8K context	$0.03 / 1K tokens	$0.06 / 1K tokens
-        return (0.03 * prompt_tokens ) / 1000.0 + (0.06 * completion_tokens) / 1000.0
-    else:
-        raise NotImplementedError(f"Model's costs are unknown: {model}!!!")
-
-
-def users_openai_usage(username: str):
-    """Return user's OpenAI total usage in $$."""
-    sessions = SessionDB.get_all_for_user(username=username)
-    return sum(openai_cost(session['model'], session['prompt_tokens'], session['completion_tokens']) for session in sessions.values() if session['model'])
+async def users_openai_usage(username: str):
+    """Return user's OpenAI total usage in $$, including not yet written usage."""
+    return await run_db(session_writes().cost_micro_usd, username) / 1e6
 
 
 async def set_quota(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -104,7 +123,7 @@ async def set_quota(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if len(context.args) == 2:
         subject_user = context.args[0]
         quota_amount_in_us_dollars = context.args[1]
-        UserDB.set(subject_user, 'openai-quota', f"{quota_amount_in_us_dollars}")
+        await AsyncUserDB.set(subject_user, 'openai-quota', f"{quota_amount_in_us_dollars}")
         logging.warn("User %s quota is set to $%s by %s", subject_user, quota_amount_in_us_dollars, user)
         await update.message.reply_text(
             f"User {subject_user} quota set to ${quota_amount_in_us_dollars}!",
@@ -120,10 +139,65 @@ async def set_quota(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
 
 
+LIST_PAGE_SIZE = 20
+
+
+def pagination_markup(command, offset, has_next, argument):
+    """Prev/next buttons for a page of /last or /users list, the callback data is {command}:{offset}:{argument}."""
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("« Prev", callback_data=f"{command}:{max(0, offset - LIST_PAGE_SIZE)}:{argument}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=f"{command}:{offset + LIST_PAGE_SIZE}:{argument}"))
+    if buttons:
+        return InlineKeyboardMarkup([buttons])
+    return None
+
+
+def session_line(session, im_an_admin):
+    """Line of a /last page: session start, end and duration, or a compacted day; with costs and tokens for admin."""
+    username = session['username']
+    session_start = session['start_time']
+    if session['compacted']:
+        line = f"{username} - {session_start[:10]} - {session['sessions_count']} sessions (compacted)"
+    else:
+        line = f"{username} - {session_start}"
+        if session['end_time']:
+            line += f" - {time_end_and_delta(session_start, session['end_time'])}"
+    if im_an_admin and session['requests_count']:
+        line += f" : ${session['cost_micro_usd'] / 1e6}{unpriced(session)}"
+        line += f" => {session['requests_count']} requests, ({session['prompt_tokens']}, {session['completion_tokens']}) tokens"
+    return line
+
+
+def unpriced(totals):
+    """Note to a cost, of requests of models without a price, which are not in it."""
+    if totals['unpriced_count']:
+        return f" + {totals['unpriced_count']} unpriced requests"
+    return ""
+
+
+async def last_page(im_an_admin, subject_user, offset):
+    """Returns text and markup of a /last page, of `subject_user` sessions or of all users for the last week."""
+    replay_details = ""
+    from_seconds = None
+    if not subject_user:
+        from_seconds = 3600*24*7 # last week
+        replay_details = f" for last {from_seconds} seconds"
+    sessions = await AsyncSessionDB.get_sessions_page(username=subject_user, from_seconds=from_seconds, limit=LIST_PAGE_SIZE + 1, offset=offset)
+
+    sessions_section = "\n".join(session_line(session, im_an_admin) for session in sessions[:LIST_PAGE_SIZE])
+    text = (
+        f"Sessions{replay_details}:\n"
+        f"<pre>{sessions_section}</pre>"
+    )
+    return text, pagination_markup('last', offset, len(sessions) > LIST_PAGE_SIZE, subject_user or '')
+
+
 async def last(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Lists known users. Extended for Admin."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -134,8 +208,6 @@ async def last(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     logging.warn("User %s called /last %s", user, context.args)
 
-    replay_details = ""
-    
     if len(context.args) == 1:
         if not is_admin(user):
             logging.warn(f"Not an admin")
@@ -149,56 +221,44 @@ async def last(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logging.warn(f"Is an admin")
         subject_user = context.args[0]
         logging.warn("Getting sessions for %s", subject_user)
-        sessions = SessionDB.get_all_for_user(username=subject_user)
     else:
         if not is_admin(user):
             im_an_admin = False
             logging.warn(f"Not an admin")
-            logging.warn("Getting sessions for self", user.username)
-            sessions = SessionDB.get_all_for_user(username=user.username)
+            logging.warn("Getting sessions for self %s", user.username)
+            subject_user = user.username
         else:
             im_an_admin = True
             logging.warn(f"Is an admin")
-            from_seconds = 3600*24*7 # last week
-            replay_details = f" for last {from_seconds} seconds"
-            logging.warn("Getting sessions for all users for last %d seconds", from_seconds)
-            sessions = SessionDB.get_all(from_seconds)
-
-    sessions_list = []
-    sessions_stack = {}
-    for k,v in sorted(sessions.items(), key=lambda x: x[1]['created_time'], reverse=True):
-        username = v['username']
-        if v['model']:
-            if username not in sessions_stack:
-                sessions_stack[username] = []
-            sessions_stack[username].append((v['created_time'], v['prompt_tokens'], v['completion_tokens'], v['model']))
-        elif username in sessions_stack:
-            session_line = ""
-            session_attempts = [(openai_cost(m, pt, ct), pt,ct,) for t,pt,ct,m in sessions_stack[username]]
-            session_costs = sum(c[0] for c in session_attempts)
-            session_tokens = [(c[1],c[2]) for c in session_attempts]
-            session_start = v['created_time']
-            session_line += f"{username} - {session_start}"
-            if sessions_stack[username]:
-                session_end = sessions_stack[username][-1][0]
-                session_line += f" - {time_end_and_delta(session_start, session_end)}"
-            if im_an_admin:
-                if session_costs != 0:
-                    session_line += f" : ${session_costs}"
-                if len(session_tokens) != 0:
-                    session_line += f" => {session_tokens}"
-            sessions_list.append(session_line)
-            sessions_stack[username] = []
-    sessions_section = "\n".join(sessions_list)
+            logging.warn("Getting sessions for all users for last week")
+            subject_user = None
+
+    text, reply_markup = await last_page(im_an_admin, subject_user, offset=0)
     await update.message.reply_text(
-        f"Sessions{replay_details}:\n"
-        f"<pre>{sessions_section}</pre>",
-        reply_markup=ReplyKeyboardRemove(),
+        text,
+        reply_markup=reply_markup or ReplyKeyboardRemove(),
         parse_mode='HTML'
     )
     return
 
 
+async def users_page(from_seconds, offset):
+    """Returns text and markup of a /users page."""
+    users = await AsyncSessionDB.get_users_page(from_seconds, limit=LIST_PAGE_SIZE + 1, offset=offset)
+    users_list = []
+    for u in users[:LIST_PAGE_SIZE]:
+        if u['requests_count']:
+            users_list.append(f"{u['last_time']} - {u['username']} - ${u['cost_micro_usd'] / 1e6}{unpriced(u)}")
+        else:
+            users_list.append(f"{u['last_time']} - {u['username']}")
+    users_section = "\n".join(users_list)
+    text = (
+        f"Sessions for last {from_seconds} seconds:\n"
+        f"<pre>{users_section}</pre>"
+    )
+    return text, pagination_markup('users', offset, len(users) > LIST_PAGE_SIZE, from_seconds)
+
+
 async def users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Lists known users. Admin command."""
     user = update.message.from_user
@@ -221,35 +281,41 @@ async def users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         from_seconds = 3600*24 # last 24 hours
 
     logging.warn("Getting sessions for last %d seconds", from_seconds)
-    sessions = SessionDB.get_all(from_seconds)
-    users_dict = {}
-    user_sessions = {}
-    for k,v in sorted(sessions.items(), key=lambda x: x[1]['created_time'], reverse=False):
-        username = v['username']
-        users_dict[username] = v['created_time']
-        if v['model']:
-            if username not in user_sessions:
-                user_sessions[username] = []
-            user_sessions[username].append(v)
-    logging.info(f"sessions: {sessions}")
-    logging.info(f"user_sessions: {user_sessions}")
-    users_list = []
-    for username, last_session_time in sorted(users_dict.items(), key=lambda x: x[1], reverse=True):
-        if username in user_sessions:
-            user_costs_for_period = sum(openai_cost(session['model'], session['prompt_tokens'], session['completion_tokens']) for session in user_sessions[username])
-            users_list.append(f"{last_session_time} - {username} - ${user_costs_for_period}")
-        else:
-            users_list.append(f"{last_session_time} - {username}")
-    users_section = "\n".join(users_list)
+    text, reply_markup = await users_page(from_seconds, offset=0)
     await update.message.reply_text(
-        f"Sessions for last {from_seconds} seconds:\n"
-        f"<pre>{users_section}</pre>",
-        reply_markup=ReplyKeyboardRemove(),
+        text,
+        reply_markup=reply_markup or ReplyKeyboardRemove(),
         parse_mode='HTML'
     )
     return
 
 
+async def page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows another page of /last or /users list, on prev/next button press."""
+    query = update.callback_query
+    user = query.from_user
+    command, offset, argument = query.data.split(':', 2)
+    offset = int(offset)
+
+    logging.info("User %s requested page %s", user, query.data)
+    if command == 'users':
+        if not is_admin(user):
+            await query.answer("Nice try, talk to admin")
+            return
+        text, reply_markup = await users_page(int(argument), offset)
+    elif is_admin(user):
+        text, reply_markup = await last_page(True, argument or None, offset)
+    else:
+        user_status = await AsyncUserDB.get(user.username, 'status')
+        if user_status != 'active':
+            await query.answer("You are not known for me, please talk to admin")
+            return
+        text, reply_markup = await last_page(False, user.username, offset)
+
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='HTML')
+
+
 async def activate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Activates the user (username specified as first argument). Admin command."""
     user = update.message.from_user
@@ -267,7 +333,7 @@ async def activate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logging.warn(f"Is an admin")
     if len(context.args) == 1:
         subject_user = context.args[0]
-        UserDB.set(subject_user, 'status', 'active')
+        await AsyncUserDB.set(subject_user, 'status', 'active')
         logging.warn("User %s activated by %s", subject_user, user)
         await update.message.reply_text(
             f"User {subject_user} was activated!",
@@ -300,9 +366,9 @@ async def deactivate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logging.warn(f"Is an admin")
     if len(context.args) == 1:
         subject_user = context.args[0]
-        old_user_status = UserDB.get(subject_user, 'status')
+        old_user_status = await AsyncUserDB.get(subject_user, 'status')
         if old_user_status:
-            UserDB.set(subject_user, 'status', 'inactive')
+            await AsyncUserDB.set(subject_user, 'status', 'inactive')
             logging.warn("User %s deactivated by %s (old status was %s)", subject_user, user, old_user_status)
             await update.message.reply_text(
                 f"User {subject_user} was deactivated (old status was {old_user_status})!",
@@ -342,7 +408,7 @@ async def user_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     logging.warn(f"Is an admin")
     if len(context.args) == 1:
         subject_user = context.args[0]
-        user_settings = UserDB.get_all(subject_user)
+        user_settings = await AsyncUserDB.get_all(subject_user)
         if user_settings:
             settings_list = []
             for k,v in user_settings.items():
@@ -388,7 +454,8 @@ async def load_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.warn(f"Is an admin")
     cookie = os.environ.get("COOKIE")
     if cookie:
-        UserDB.set(user.username, 'cookie', cookie)
+        await AsyncUserDB.set(user.username, 'cookie', cookie)
+        clients.invalidate(user.username)
         logging.info("User %s set new cookie", user)
         await update.message.reply_text(
             "New cookie:\n\n"
@@ -397,7 +464,7 @@ async def load_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='HTML'
         )
     else:
-        logging.info("No COOKIE env var found", user)
+        logging.info("No COOKIE env var found, asked by %s", user)
         await update.message.reply_text(
             "No COOKIE env var found",
             reply_markup=ReplyKeyboardRemove(),
@@ -405,6 +472,46 @@ async def load_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Profiles the bot for {seconds} or {number} updates, or stops profiling. Admin command."""
+    user = update.message.from_user
+
+    logging.warn("User %s called /profile %s", user, context.args)
+    if not is_admin(user):
+        logging.warn(f"Not an admin")
+        await update.message.reply_text(
+            f"Nice try, talk to <a href='tg://user?id={admin_id()}'>admin</a>",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode='HTML'
+        )
+        return
+
+    logging.warn(f"Is an admin")
+
+    if context.args == ['stop']:
+        if profiler.running:
+            await profiler.stop(context.application)
+        else:
+            await update.message.reply_text("Not profiling", reply_markup=ReplyKeyboardRemove())
+        return
+
+    if profiler.running:
+        await update.message.reply_text("Already profiling, see /profile stop", reply_markup=ReplyKeyboardRemove())
+        return
+
+    if len(context.args) == 1 and context.args[0].isdigit():
+        profiler.start(context.application, update.effective_chat.id, seconds=int(context.args[0]))
+        await update.message.reply_text(f"Profiling for {context.args[0]} seconds", reply_markup=ReplyKeyboardRemove())
+    elif len(context.args) == 2 and context.args[0].isdigit() and context.args[1] == 'updates':
+        profiler.start(context.application, update.effective_chat.id, updates=int(context.args[0]))
+        await update.message.reply_text(f"Profiling next {context.args[0]} updates", reply_markup=ReplyKeyboardRemove())
+    else:
+        await update.message.reply_text(
+            "Usage: /profile {seconds}, /profile {number} updates or /profile stop",
+            reply_markup=ReplyKeyboardRemove()
+        )
+
+
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
 
@@ -426,7 +533,7 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the session, lists Marktplaats conversations and asks user which to pick up."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -435,10 +542,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return ConversationHandler.END
 
-    logging.info(f"Starting user session for {user}")
+    if not await admission.allow(update, 'listing'):
+        return ConversationHandler.END
+
+    logging.info("Starting user session for %s", user)
     session = UserSession(user_data=context.user_data)
 
-    SessionDB.create(user.username)
+    session_writes().create(user.username)
 
     limit = 5
     offset = 0
@@ -455,7 +565,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             logging.error(e)
             await context.bot.send_message(chat_id=update.effective_chat.id, text=f"I didn't get second (OFFSET) argument for the command. {e}")
 
-    cookie = UserDB.get(user.username, 'cookie')
+    cookie = await AsyncUserDB.get(user.username, 'cookie')
     if not cookie:
         await update.message.reply_text(
             f"No cookie found, set cookie with /reset_cookie.",
@@ -463,16 +573,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             parse_mode='HTML'
         )
         return ConversationHandler.END
-    c = Client(load_env=False, use_jar=False, cookie=cookie)
 
-    convs = c.get_conversations(params = {
-        'offset': str(offset),
-        'limit': str(limit),
-    })
+    async with admission.slot(update, 'listing'):
+        async with clients.async_client(user.username, cookie) as c:
+            with metrics.upstream('marktplaats', 'get_conversations'):
+                convs = await asyncio.to_thread(c.get_conversations, params = {
+                    'offset': str(offset),
+                    'limit': str(limit),
+                })
 
     session.set_conversations(convs)
 
-    logging.info(f"Listing {limit} newly-updated conversations (from {offset}):")
+    logging.info("Listing %d newly-updated conversations (from %d):", limit, offset)
 
     ids = []
     convs_list = [] # "{id} [{unreadMessagesCount}] :: {title} :: {otherParticipant_name} :: {itemId}\n"
@@ -510,10 +622,38 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return CONVERSATION
 
 
+def render_transcript(sorted_items, peer):
+    """Returns HTML transcript of conversation messages (sorted by time) and them as ChatGPT completion messages."""
+    completion_messages = []
+    messages_list = []
+    
+    for m in sorted_items:
+        if m['senderId'] == peer['id']:
+            author = peer['name']
+            role = "user"
+        else:
+            author = 'You' # m['senderId']
+            role = "assistant"
+        if m['isRead']:
+            read_status = '- '
+        else:
+            read_status = '* '
+        messages_list.append(
+            f"<i>[{m['receivedDate']}]</i> {read_status}<b>{author}:</b>\n"
+            f"<pre>{m['text']}</pre>"
+        )
+        completion_messages.append({
+            "role": role,
+            "content": m['text']
+        })
+
+    return "\n\n".join(messages_list), completion_messages
+
+
 async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Prints conversation and suggests a reply."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -533,13 +673,20 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Sorry, I didn't understand that.")
         return ConversationHandler.END
 
+    if not await admission.allow(update, 'scraping'):
+        return ConversationHandler.END
+
     session = UserSession(user_data=context.user_data)
     conv = session.activate_conversation(conversation_number)
     logging.info('Conv %d: %s', conversation_number, conv)
     conversation_id = conv['id']
     item_id = conv["itemId"]
 
-    item_data, url = load_item_data(item_id)
+    async with admission.slot(update, 'scraping'):
+        with metrics.upstream('item_page', 'fetch_item_page'):
+            html_page, url = await asyncio.to_thread(fetch_item_page, item_id)
+    with metrics.ITEM_PARSE_SECONDS.time(), tracing.child_span("parse item page"):
+        item_data = await item_parser.parse(html_page, item_id, url)
     if not item_data:
         await update.message.reply_text(
             f"<i>Didn't find product description at <a href=\"{url}\">{url}</a></i>.",
@@ -555,7 +702,7 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         )
         session.set_item_data(item_data)
 
-    cookie = UserDB.get(user.username, 'cookie')
+    cookie = await AsyncUserDB.get(user.username, 'cookie')
     if not cookie:
         await update.message.reply_text(
             f"No cookie found, set cookie with /reset_cookie.",
@@ -563,9 +710,11 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             parse_mode='HTML'
         )
         return ConversationHandler.END
-    c = Client(load_env=False, use_jar=False, cookie=cookie)
 
-    messages = c.get_conversation(conversation_id)
+    async with admission.slot(update, 'scraping'):
+        async with clients.async_client(user.username, cookie) as c:
+            with metrics.upstream('marktplaats', 'get_conversation'):
+                messages = await asyncio.to_thread(c.get_conversation, conversation_id)
     peer = messages['_embedded']['otherParticipant']
     if messages['totalCount'] > messages['limit'] + messages['offset']:
         messages_notice = f". Displaying {messages['limit']}, beginning from {messages['offset']}"
@@ -581,36 +730,12 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         disable_web_page_preview=True
     )
 
-    completion_messages=[]
-
     sorted_items = sorted(messages['_embedded']['mc:message'], key=lambda x: x['receivedDate'], reverse=False)
     last_message = sorted_items[-1]
 
-    messages_list = []
-    
-    for m in sorted_items:
-        if m['senderId'] == peer['id']:
-            author = peer['name']
-            role = "user"
-        else:
-            author = 'You' # m['senderId']
-            role = "assistant"
-        if m['isRead']:
-            read_status = '- '
-        else:
-            read_status = '* '
-        messages_list.append(
-            f"<i>[{m['receivedDate']}]</i> {read_status}<b>{author}:</b>\n"
-            f"<pre>{m['text']}</pre>"
-        )
-        completion_messages.append({
-            "role": role,
-            "content": m['text']
-        })
-
+    messages_section, completion_messages = render_transcript(sorted_items, peer)
     session.set_completion_messages(completion_messages)
 
-    messages_section = "\n\n".join(messages_list)
     await update.message.reply_text(
         f"It has {messages['totalCount']} messages{messages_notice}:\n\n"
         f"{messages_section}",
@@ -621,6 +746,17 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     reply_keyboard = [["Yes", "No"]]
 
     if last_message['senderId'] == peer['id']:
+        # a reply given before to a similar message comes first, it's instant and free
+        with tracing.child_span("reply_index best_reply"):
+            past_reply = await asyncio.to_thread(best_reply, user.username, last_message['text'])
+        if past_reply:
+            similarity, past_question, reply = past_reply
+            await update.message.reply_text(
+                f"<i>You replied to a similar message ({similarity:.0%} match) \"{html.escape(past_question)}\":</i>\n"
+                f"<pre>{html.escape(reply)}</pre>",
+                reply_markup=ReplyKeyboardRemove(),
+                parse_mode='HTML'
+            )
         await update.message.reply_text(
             "<i>Asking ChatGPT?</i>",
             reply_markup=ReplyKeyboardMarkup(
@@ -644,7 +780,7 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Asks ChatGPT for reply suggestion for active conversation and sends to the user."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -653,7 +789,7 @@ async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return ConversationHandler.END
 
-    quota = UserDB.get(user.username, 'openai-quota')
+    quota = await AsyncUserDB.get(user.username, 'openai-quota')
     if not quota:
         await update.message.reply_text(
             f"No OpenAI quota defined for you, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -664,10 +800,10 @@ async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     else:
         quota_amount_in_us_dollars = float(quota)
     
-    current_usage = users_openai_usage(user.username)
-    logging.info("User OpenAI quota is $%s, and $%s is already used", current_usage, quota_amount_in_us_dollars)
+    current_usage = await users_openai_usage(user.username)
+    logging.info("User OpenAI quota is $%s, and $%s is already used", quota_amount_in_us_dollars, current_usage)
     
-    if users_openai_usage(user.username) >= quota_amount_in_us_dollars:
+    if current_usage >= quota_amount_in_us_dollars:
         await update.message.reply_text(
             f"You exceeded your OpenAI quota, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
             reply_markup=ReplyKeyboardRemove(),
@@ -680,7 +816,7 @@ async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logging.info('Active conv %s', conv)
     conversation_id = conv['id']
 
-    if update.message.text != "Yes":
+    if update.message.text not in ("Yes", "Smarter"):
         logging.info("Not asking ChatGPT, as user %s replied %s", user.id, update.message.text)
         conv_url = conversation_url(conversation_id)
         await update.message.reply_text(
@@ -692,11 +828,17 @@ async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return ConversationHandler.END
 
+    if not await admission.allow(update, 'suggestion'):
+        return SUGGESTION
+
     item_data = session.get_item_data()
-    chatgpt_context = UserDB.get(user.username, 'chat-context')
+    chatgpt_context = await AsyncUserDB.get(user.username, 'chat-context')
     if not chatgpt_context:
-        chatgpt_context = load_context("chat-context")
-    context = chatgpt_context + "\n" + item_data
+        context_name = await AsyncUserDB.get(user.username, 'chat-context-name')
+        chatgpt_context = await read_context(update, context_name if context_name in contexts.files else 'default')
+        if chatgpt_context is None:
+            return ConversationHandler.END
+    context = contexts.combine(user.username, conv['itemId'], chatgpt_context, item_data)
     await update.message.reply_text(
         "<i>This will be the context for ChatGPT request:</i>",
         reply_markup=ReplyKeyboardRemove(),
@@ -717,21 +859,32 @@ async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     openai.organization = os.environ.get("OPENAI_ORG_ID")
     openai.api_key = os.environ.get("OPENAI_API_KEY")
-    openai_model = os.environ.get("OPENAI_MODEL", "gpt-4-1106-preview")
+    openai_model, routing_reason = ModelRouter.from_env().route(
+        completion_messages,
+        remaining_quota=quota_amount_in_us_dollars - current_usage,
+        escalate=update.message.text == "Smarter"
+    )
+    logging.info("Routed to %s model: %s", openai_model, routing_reason)
     logging.debug("About to ask ChatGPT %s model for completion to %s", openai_model, completion_messages)
-    completion = openai.ChatCompletion.create(model=openai_model, messages=completion_messages)
+    async with admission.slot(update, 'suggestion'):
+        with metrics.upstream('openai', 'ChatCompletion.create'):
+            completion = await asyncio.to_thread(openai.ChatCompletion.create, model=openai_model, messages=completion_messages)
     logging.debug("Usage: %s", completion.usage)
+    metrics.OPENAI_TOKENS.inc(completion.usage.prompt_tokens, model=completion.model, kind='prompt')
+    metrics.OPENAI_TOKENS.inc(completion.usage.completion_tokens, model=completion.model, kind='completion')
     logging.debug("Choice: %s", completion.choices[0].message.content)
     logging.info("Completion id: %s", completion.id)
-    SessionDB.use(
+    session_writes().use(
         username=user.username,
         model=completion.model,
         prompt_tokens=completion.usage.prompt_tokens,
-        completion_tokens=completion.usage.completion_tokens
+        completion_tokens=completion.usage.completion_tokens,
+        requested_model=openai_model
     )
+    completion_model = completion.model
     completion = completion.choices[0].message.content
     await update.message.reply_text(
-        f"<i>Suggested answer:</i>\n",
+        f"<i>Suggested answer ({completion_model}):</i>\n",
         reply_markup=ReplyKeyboardRemove(),
         parse_mode='HTML'
     )
@@ -741,9 +894,9 @@ async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         parse_mode='HTML'
     )
 
-    reply_keyboard = [["Yes"],["No"]]
+    reply_keyboard = [["Yes"],["Smarter"],["No"]]
     await update.message.reply_text(
-        "<i>Asking ChatGPT to regenerate?</i>",
+        "<i>Asking ChatGPT to regenerate? (Smarter uses the larger model)</i>",
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder="Ask ChatGPT for a new suggestion?"
         ),
@@ -755,7 +908,7 @@ async def suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -775,7 +928,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Returns current user's quota."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -784,7 +937,7 @@ async def quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
-    quota = UserDB.get(user.username, 'openai-quota')
+    quota = await AsyncUserDB.get(user.username, 'openai-quota')
     if not quota:
         await update.message.reply_text(
             f"No OpenAI quota defined for you, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -795,8 +948,8 @@ async def quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         quota_amount_in_us_dollars = float(quota)
     
-    current_usage = users_openai_usage(user.username)
-    logging.info("User OpenAI quota is $%s, and $%s is already used", current_usage, quota_amount_in_us_dollars)
+    current_usage = await users_openai_usage(user.username)
+    logging.info("User OpenAI quota is $%s, and $%s is already used", quota_amount_in_us_dollars, current_usage)
 
     await update.message.reply_text(
         f"Your OpenAI quota is ${quota_amount_in_us_dollars}",
@@ -806,10 +959,24 @@ async def quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def read_context(update: Update, name: str):
+    """Returns text of prepared context `name`, or None if its file can't be read, telling the user so."""
+    try:
+        return contexts.get(name)
+    except OSError as e:
+        logging.error("Failed to read context %s: %s", name, e)
+        await update.message.reply_text(
+            f"Context @{name} can't be read, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode='HTML'
+        )
+        return None
+
+
 async def context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset context to new text or to default one, if none provided."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -821,11 +988,28 @@ async def context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = UserSession(user_data=context.user_data)
 
     if len(context.args) == 0:
-        text = load_context("chat-context")
-        UserDB.delete(user.username, 'chat-context')
+        text = await read_context(update, 'default')
+        if text is None:
+            return
+        await AsyncUserDB.delete(user.username, 'chat-context')
+        await AsyncUserDB.delete(user.username, 'chat-context-name')
+    elif len(context.args) == 1 and context.args[0].startswith('@'):
+        context_name = context.args[0][1:]
+        if context_name not in contexts.files:
+            await update.message.reply_text(
+                f"No such context, known ones are: {', '.join('@' + name for name in contexts.names())}",
+                reply_markup=ReplyKeyboardRemove(),
+                parse_mode='HTML'
+            )
+            return
+        text = await read_context(update, context_name)
+        if text is None:
+            return
+        await AsyncUserDB.delete(user.username, 'chat-context')
+        await AsyncUserDB.set(user.username, 'chat-context-name', context_name)
     else:
         text = " ".join(context.args)
-        UserDB.set(user.username, 'chat-context', text)
+        await AsyncUserDB.set(user.username, 'chat-context', text)
     logging.info("New context for ChatGPT: %s", text)
 
     await update.message.reply_text(
@@ -839,7 +1023,7 @@ async def context(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def reset_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset cookie to new value."""
     user = update.message.from_user
-    user_status = UserDB.get(user.username, 'status')
+    user_status = await AsyncUserDB.get(user.username, 'status')
     if user_status != 'active':
         await update.message.reply_text(
             f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
@@ -849,7 +1033,8 @@ async def reset_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     if len(context.args) == 0:
-        UserDB.delete(user.username, 'cookie')
+        await AsyncUserDB.delete(user.username, 'cookie')
+        clients.invalidate(user.username)
         logging.info("User %s deleted cookie", user)
         await update.message.reply_text(
                 "Cookie deleted",
@@ -860,7 +1045,8 @@ async def reset_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = " ".join(context.args)
         cookie = store_value(sniff_cookie_from_text(text))
         if cookie:
-            UserDB.set(user.username, 'cookie', cookie)
+            await AsyncUserDB.set(user.username, 'cookie', cookie)
+            clients.invalidate(user.username)
             logging.info("User %s set new cookie", user)
             await update.message.reply_text(
                 "New cookie:\n\n"
@@ -870,7 +1056,7 @@ async def reset_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             logging.info("User %s did not provide new cookie", user)
-            logging.debug("User %s provided: %s", text)
+            logging.debug("User %s provided: %s", user, text)
             await update.message.reply_text(
                 "No new cookie found in:\n\n"
                 f"<pre>{text}</pre>",
@@ -879,6 +1065,83 @@ async def reset_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
 
+async def archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Syncs user's conversations into the archive, for /search."""
+    user = update.message.from_user
+    user_status = await AsyncUserDB.get(user.username, 'status')
+    if user_status != 'active':
+        await update.message.reply_text(
+            f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
+
+    cookie = await AsyncUserDB.get(user.username, 'cookie')
+    if not cookie:
+        await update.message.reply_text(
+            f"No cookie found, set cookie with /reset_cookie.",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
+
+    if not await admission.allow(update, 'listing'):
+        return ConversationHandler.END
+
+    await update.message.reply_text("<i>Archiving your conversations...</i>", parse_mode='HTML')
+    # pages through all conversations, kept off the event loop
+    async with admission.slot(update, 'listing'):
+        async with clients.async_client(user.username, cookie) as c:
+            with tracing.child_span("archive sync"):
+                counts = await asyncio.to_thread(sync_archive, c, user.username)
+    await update.message.reply_text(
+        f"Archived {counts['conversations']} conversations, {counts['fetched']} changed, with {counts['messages']} new messages",
+        reply_markup=ReplyKeyboardRemove(),
+        parse_mode='HTML'
+    )
+
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Searches user's archived messages."""
+    user = update.message.from_user
+    user_status = await AsyncUserDB.get(user.username, 'status')
+    if user_status != 'active':
+        await update.message.reply_text(
+            f"You are not known for me, please talk to <a href='tg://user?id={admin_id()}'>admin</a>",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
+
+    query = " ".join(context.args)
+    # snippets are escaped for HTML, so matches are marked with control characters first
+    found = await AsyncArchiveDB.search(user.username, query, limit=10, highlight=('\x02', '\x03'))
+    if not found:
+        await update.message.reply_text(
+            "Nothing found, archive your conversations with /archive" if query else "Usage: /search {words}",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode='HTML'
+        )
+        return
+
+    results = []
+    for f in found:
+        author = f['peer'] if f['from_peer'] else 'You'
+        snippet = html.escape(f['snippet']).replace('\x02', '<b>').replace('\x03', '</b>')
+        conv_url = conversation_url(f['conversation'])
+        results.append(
+            f"<a href=\"{conv_url}\">{html.escape(f['title'])}</a> :: {html.escape(f['peer'])}\n"
+            f"<i>[{f['receivedDate']}]</i> <b>{html.escape(author)}:</b> {snippet}"
+        )
+    await update.message.reply_text(
+        "\n\n".join(results),
+        reply_markup=ReplyKeyboardRemove(),
+        parse_mode='HTML',
+        disable_web_page_preview=True
+    )
+
+
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
 
@@ -911,7 +1174,9 @@ def get_help():
     return """Available commands:
 /start -- start the session, by listing all conversations first, optional parameters are LIMIT and OFFSET
 /reset_cookie -- set your marktplaats.nl cookie (can parse the result of "Copy as cURL" browser command) or delete current one if nothing is provided
-/context -- reset the ChatGPT context, provide a new text or leave blank to load default
+/context -- reset the ChatGPT context, provide a new text, @name of a prepared context, or leave blank to load default
+/archive -- save all your conversations to the archive, run it again to add new messages
+/search {words} -- search your archived messages and item titles, all {words} must match
 /last -- list user's sessions
 /help -- show this help
 """
@@ -926,6 +1191,7 @@ def get_admin_help():
 /last {username} -- list sessions of {username}, showing OpenAI costs and tokens per request
 /last -- list all sessions for the last week, showing OpenAI costs and tokens per request
 /set_quota {username} {amount} -- set $$$ quota for OpenAI use for {username}
+/profile {seconds} -- profile the bot for {seconds}, or /profile {number} updates, /profile stop to stop earlier
 /admin_help -- show this help
 """
 
@@ -933,54 +1199,135 @@ def get_admin_help():
 def main():
     print("Starting")
 
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.DEBUG,
-        filename='marktplaats-gpt-bot.log',
-        filemode='a'
-    )
-
-    # set higher logging level for httpx to avoid all GET and POST requests being logged
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-    logging.getLogger("telegram").setLevel(logging.INFO)
-    logging.getLogger("httpcore").setLevel(logging.INFO)
-
     # Load environment variables from .env file
     load_dotenv()
 
+    configure()
+
+    # higher logging level for httpx to avoid all GET and POST requests being logged
+    configure_logging('marktplaats-gpt-bot.log', 'root=DEBUG,httpx=WARNING,telegram=INFO,httpcore=INFO')
+
+    ModelRouter.from_env().check_models()
+
     UserDB.init_db()
     SessionDB.init_db()
+    ArchiveDB.init_db()
+
+    metrics_port = os.environ.get("METRICS_PORT")
+    if metrics_port:
+        metrics.start_server(os.environ.get("METRICS_LISTEN", "127.0.0.1"), int(metrics_port))
+
+    builder = ApplicationBuilder().token(os.environ.get("TELEGRAM_TOKEN"))
+    # users don't wait for each other's updates, while updates of a chat go in order for the conversation handler
+    builder.concurrent_updates(ChatSequentialUpdateProcessor(int(os.environ.get("BOT_CONCURRENT_UPDATES", "64"))))
+    if os.environ.get("STORAGE_URL"):
+        # users' session state goes to the storage too, to be shared by replicas
+        StateDB.init_db()
+        builder.persistence(SharedStatePersistence())
+    application = build_application(builder)
+
+    # Run the bot until the user presses Ctrl-C
+    webhook_url = os.environ.get("TELEGRAM_WEBHOOK_URL")
+    if webhook_url:
+        # replicas behind a load balancer share the webhook, polling can't be shared
+        application.run_webhook(
+            listen=os.environ.get("TELEGRAM_WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.environ.get("TELEGRAM_WEBHOOK_PORT", "8443")),
+            url_path=urlparse(webhook_url).path.lstrip('/'),
+            webhook_url=webhook_url,
+            secret_token=os.environ.get("TELEGRAM_WEBHOOK_SECRET"),
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+async def stop_background_work(application):
+    session_writes().stop()
+    await asyncio.to_thread(clients.close_all)
+    # workers still starting would be left running if the pool was stopped before they are up
+    starting = application.bot_data.pop('item_parser_start', None)
+    if starting is not None:
+        await asyncio.gather(starting, return_exceptions=True)
+    await asyncio.to_thread(item_parser.stop)
 
-    application = ApplicationBuilder().token(os.environ.get("TELEGRAM_TOKEN")).build()
+
+async def start_item_parser():
+    try:
+        await asyncio.to_thread(item_parser.start)
+    except Exception:
+        logging.exception("Item parser workers failed to start, parsing pages on threads")
+
+
+async def compact_sessions_periodically(interval_seconds, older_than_days):
+    while True:
+        try:
+            result = await asyncio.to_thread(SessionDB.compact, older_than_days)
+            logging.info("Compacted sessions older than %d days: %s", older_than_days, result)
+        except Exception as e:
+            logging.error("Sessions compaction failed: %s", e)
+        await asyncio.sleep(interval_seconds)
+
+
+async def start_background_tasks(application):
+    application.create_task(metrics.monitor_event_loop())
+    # pages are parsed on threads until the workers are up; not awaited by the application as it isn't running yet
+    application.bot_data['item_parser_start'] = asyncio.create_task(start_item_parser())
+    await schedule_sessions_compaction(application)
+
+
+async def schedule_sessions_compaction(application):
+    interval_hours = float(os.environ.get("SESSIONS_COMPACTION_INTERVAL_HOURS", "0"))
+    if interval_hours > 0:
+        older_than_days = int(os.environ.get("SESSIONS_RETENTION_DAYS", "90"))
+        application.create_task(compact_sessions_periodically(interval_hours * 3600, older_than_days))
+
+
+def build_application(builder: ApplicationBuilder):
+    """Builds the bot application with all handlers registered, handlers are timed for metrics and traced."""
+    application = builder.post_init(start_background_tasks).post_shutdown(stop_background_work).build()
+
+    def timed(callback):
+        return tracing.traced_handler(metrics.timed_handler(callback))
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", timed(start))],
         states={
-            CONVERSATION: [MessageHandler(filters.Regex(".*"), conversation)],
-            SUGGESTION: [MessageHandler(filters.Regex("^(Yes|No)$"), suggestion)],
+            CONVERSATION: [MessageHandler(filters.Regex(".*"), timed(conversation))],
+            SUGGESTION: [MessageHandler(filters.Regex("^(Yes|Smarter|No)$"), timed(suggestion))],
         },
-        fallbacks=[CommandHandler("cancel", cancel)],
+        fallbacks=[CommandHandler("cancel", timed(cancel))],
+        name="conversation",
+        persistent=application.persistence is not None,
     )
 
-    application.add_handler(CommandHandler('set_quota', set_quota))
-    application.add_handler(CommandHandler('last', last))
-    application.add_handler(CommandHandler('users', users))
-    application.add_handler(CommandHandler('activate', activate))
-    application.add_handler(CommandHandler('deactivate', deactivate))
-    application.add_handler(CommandHandler('user_settings', user_settings))
-    application.add_handler(CommandHandler('load_cookie', load_cookie))
+    if application.persistence:
+        application.add_handler(TypeHandler(Update, refresh_conversations), group=-1)
+        application.add_handler(TypeHandler(Update, save_state), group=1)
+
+    application.add_handler(CommandHandler('set_quota', timed(set_quota)))
+    application.add_handler(CommandHandler('last', timed(last)))
+    application.add_handler(CommandHandler('users', timed(users)))
+    application.add_handler(CallbackQueryHandler(timed(page), pattern=r'^(last|users):'))
+    application.add_handler(CommandHandler('activate', timed(activate)))
+    application.add_handler(CommandHandler('deactivate', timed(deactivate)))
+    application.add_handler(CommandHandler('user_settings', timed(user_settings)))
+    application.add_handler(CommandHandler('load_cookie', timed(load_cookie)))
     application.add_handler(conv_handler)
-    application.add_handler(CommandHandler('quota', quota))
-    application.add_handler(CommandHandler('context', context))
-    application.add_handler(CommandHandler('reset_cookie', reset_cookie))
-    application.add_handler(CommandHandler('help', help))
-    application.add_handler(CommandHandler('admin_help', admin_help))
-    application.add_handler(CommandHandler('version', version))
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), echo))
-    application.add_handler(MessageHandler(filters.COMMAND, unknown))
+    application.add_handler(CommandHandler('quota', timed(quota)))
+    application.add_handler(CommandHandler('context', timed(context)))
+    application.add_handler(CommandHandler('reset_cookie', timed(reset_cookie)))
+    application.add_handler(CommandHandler('archive', timed(archive)))
+    application.add_handler(CommandHandler('search', timed(search)))
+    application.add_handler(CommandHandler('help', timed(help)))
+    application.add_handler(CommandHandler('admin_help', timed(admin_help)))
+    application.add_handler(CommandHandler('profile', timed(profile)))
+    application.add_handler(CommandHandler('version', timed(version)))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), timed(echo)))
+    application.add_handler(MessageHandler(filters.COMMAND, timed(unknown)))
+
+    return application
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,75 @@
+import logging
+import os
+from collections import OrderedDict
+
+
+def load_context(filename):
+    """
+    Loads context for system role for OpenAI chat completion task.
+    """
+    logging.info("Loading context from %s...", filename)
+    lines = []
+
+    with open(filename, 'r') as file:
+        lines = [line.strip() for line in file]
+    
+    return ' '.join(lines)
+
+
+class ContextRegistry:
+    """
+    Named contexts for ChatGPT, read from their files once and kept in memory. A file is read again when its
+    modification time or size changes, so contexts can be edited without restarting the bot.
+
+    Combined contexts (context plus item data) are cached per user and item, up to `combined_cache_size` entries.
+    """
+    def __init__(self, files=None, combined_cache_size=1024):
+        self.files = dict(files or {'default': 'chat-context'})
+        self.loaded = {} # name: (mtime_ns, size, text)
+        self.combined = OrderedDict() # (username, item_id): (context, item_data, combined)
+        self.combined_cache_size = combined_cache_size
+
+    @classmethod
+    def from_env(cls):
+        """
+        Contexts from CHAT_CONTEXTS env var, as comma-separated name=file pairs. The `default` context
+        is chat-context file, unless set there. Raises ValueError if files set there don't exist.
+        """
+        files = {'default': 'chat-context'}
+        for pair in os.environ.get("CHAT_CONTEXTS", "").split(','):
+            if pair.strip():
+                name, filename = pair.split('=', 1)
+                files[name.strip()] = filename.strip()
+                if not os.path.isfile(filename.strip()):
+                    raise ValueError(f"CHAT_CONTEXTS file of context {name.strip()!r} not found: {filename.strip()}")
+        return cls(files)
+
+    def names(self):
+        return list(self.files)
+
+    def get(self, name='default'):
+        """Returns text of context `name`, reading its file if it changed since last read. Raises OSError if it can't be read."""
+        filename = self.files[name]
+        stat = os.stat(filename)
+        loaded = self.loaded.get(name)
+        if loaded and loaded[:2] == (stat.st_mtime_ns, stat.st_size):
+            return loaded[2]
+        if loaded:
+            logging.info("Context %s changed, reloading %s", name, filename)
+        text = load_context(filename)
+        self.loaded[name] = (stat.st_mtime_ns, stat.st_size, text)
+        return text
+
+    def combine(self, username, item_id, context, item_data):
+        """Returns `context` with `item_data` of `item_id` appended, cached for `username` while both stay the same."""
+        key = (username, item_id)
+        cached = self.combined.get(key)
+        if cached and cached[0] == context and cached[1] == item_data:
+            self.combined.move_to_end(key)
+            return cached[2]
+        combined = context + "\n" + item_data
+        self.combined[key] = (context, item_data, combined)
+        self.combined.move_to_end(key)
+        if len(self.combined) > self.combined_cache_size:
+            self.combined.popitem(last=False)
+        return combined
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from marktplaats_gpt import metrics
+
+
+class ClientPool:
+    """
+    Marktplaats clients of bot users, kept between updates so their HTTP connections are reused instead of
+    handshaking again on every update. A client is made by `factory(cookie)` and is kept for its user and cookie.
+
+    Clients are not shared between threads: a client is taken out of the pool while in use and put back after,
+    a user with a call still running gets another one. At most `max_size` clients are kept, the least recently
+    used ones are dropped first, and clients idle for `idle_seconds` are dropped too. `invalidate` drops the user's
+    client at once, also one in use when it is put back.
+
+    Dropped clients have their HTTP session closed on a thread of the pool, as closing can block on the network,
+    so neither the lock nor the caller waits for it. `async_client` also makes new clients on a thread, for callers
+    on the event loop.
+    """
+    def __init__(self, factory, max_size=100, idle_seconds=300):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.clients = OrderedDict() # username: (cookie, client, last used), least recently used first
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.closer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='client-close')
+
+    @classmethod
+    def from_env(cls, factory):
+        return cls(
+            factory,
+            max_size=int(os.environ.get("MARKTPLAATS_CLIENTS_MAX", "100")),
+            idle_seconds=float(os.environ.get("MARKTPLAATS_CLIENTS_IDLE_SECONDS", "300")),
+        )
+
+    @contextmanager
+    def client(self, username: str, cookie: str):
+        """Client of the user for the time of the `with` block, blocking while a new one is made:
+
+            with clients.client(username, cookie) as c:
+                convs = c.get_conversations(params)
+        """
+        client, generation = self.take(username, cookie)
+        if client is None:
+            client = self.create(cookie)
+        try:
+            yield client
+        finally:
+            self.put(username, cookie, client, generation)
+
+    @asynccontextmanager
+    async def async_client(self, username: str, cookie: str):
+        """Client of the user for the time of the `async with` block, a new one is made on a thread:
+
+            async with clients.async_client(user.username, cookie) as c:
+                convs = await asyncio.to_thread(c.get_conversations, params)
+        """
+        client, generation = self.take(username, cookie)
+        if client is None:
+            client = await asyncio.to_thread(self.create, cookie)
+        try:
+            yield client
+        finally:
+            self.put(username, cookie, client, generation)
+
+    def take(self, username, cookie):
+        """Returns the user's pooled client for `cookie`, or None if a new one is to be made, and its generation."""
+        with self.lock:
+            dropped = self.expire(time.monotonic())
+            generation = self.generations.get(username, 0)
+            entry = self.clients.pop(username, None)
+        if entry and entry[0] != cookie:
+            dropped.append(entry[1])
+        self.close_later(dropped)
+        if entry and entry[0] == cookie:
+            metrics.MARKTPLAATS_CLIENTS.inc(result='reused')
+            return entry[1], generation
+        return None, generation
+
+    def create(self, cookie):
+        metrics.MARKTPLAATS_CLIENTS.inc(result='created')
+        return self.factory(cookie)
+
+    def put(self, username, cookie, client, generation):
+        dropped = []
+        with self.lock:
+            if self.generations.get(username, 0) != generation:
+                dropped.append(client) # the cookie was changed while the client was in use
+            else:
+                entry = self.clients.pop(username, None)
+                if entry:
+                    dropped.append(entry[1])
+                self.clients[username] = (cookie, client, time.monotonic())
+                while len(self.clients) > self.max_size:
+                    dropped.append(self.clients.popitem(last=False)[1][1])
+                metrics.MARKTPLAATS_CLIENTS_POOLED.set(len(self.clients))
+        self.close_later(dropped)
+
+    def invalidate(self, username: str):
+        """Drops the user's client, for when their cookie changes."""
+        with self.lock:
+            self.generations[username] = self.generations.get(username, 0) + 1
+            entry = self.clients.pop(username, None)
+            metrics.MARKTPLAATS_CLIENTS_POOLED.set(len(self.clients))
+        if entry:
+            logging.info("Dropped Marktplaats client of %s", username)
+            self.close_later([entry[1]])
+
+    def expire(self, now):
+        """Drops clients idle for `idle_seconds` and returns them, to be closed once the lock is released."""
+        dropped = []
+        while self.clients:
+            username, (_, client, last_used) = next(iter(self.clients.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self.clients[username]
+            dropped.append(client)
+        metrics.MARKTPLAATS_CLIENTS_POOLED.set(len(self.clients))
+        return dropped
+
+    def close_later(self, clients):
+        if clients:
+            self.closer.submit(close_clients, clients)
+
+    def wait_closed(self):
+        """Waits for clients dropped until now to be closed. Blocking."""
+        self.closer.submit(lambda: None).result()
+
+    def close_all(self):
+        """Drops and closes all pooled clients, for when the bot stops. Blocking, the pool can still be used after."""
+        with self.lock:
+            dropped = [client for _, client, _ in self.clients.values()]
+            self.clients.clear()
+            metrics.MARKTPLAATS_CLIENTS_POOLED.set(0)
+        self.close_later(dropped)
+        self.wait_closed()
+
+
+def close_clients(clients):
+    """Closes the HTTP sessions of dropped clients, a failing one is logged and does not stop the others."""
+    for client in clients:
+        close = getattr(client, 'close', None) or getattr(getattr(client, 'session', None), 'close', None)
+        if close is None:
+            continue
+        try:
+            close()
+        except Exception:
+            logging.exception("Failed to close Marktplaats client")
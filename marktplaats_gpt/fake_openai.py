@@ -0,0 +1,242 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_REPLY = "Hi! Yes, it is still available. You can pick it up any evening this week."
+
+
+def parse_latency(spec: str):
+    """
+    Parses latency distribution spec into a function returning delay in seconds.
+
+    Supported specs (all values in seconds):
+      fixed:0.5
+      uniform:0.2,1.5
+      normal:1.0,0.3        (mean, stddev, clipped at 0)
+      lognormal:0.0,0.5     (mu, sigma of underlying normal)
+      exponential:0.8       (mean)
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',')] if params else []
+    if kind == 'fixed':
+        delay, = values or [0.0]
+        return lambda: delay
+    elif kind == 'uniform':
+        low, high = values
+        return lambda: random.uniform(low, high)
+    elif kind == 'normal':
+        mean, stddev = values
+        return lambda: max(0.0, random.gauss(mean, stddev))
+    elif kind == 'lognormal':
+        mu, sigma = values
+        return lambda: random.lognormvariate(mu, sigma)
+    elif kind == 'exponential':
+        mean, = values
+        return lambda: random.expovariate(1.0 / mean)
+    else:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def estimate_tokens(text: str):
+    """Rough token estimate (4 characters per token), good enough for usage accounting."""
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAI:
+    """
+    Settings and counters of the stand-in, shared by all request handler threads.
+    """
+    def __init__(self, latency='fixed:0.5', error_rate=0.0, reply=DEFAULT_REPLY, stream_chunk_delay=0.02):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.reply = reply
+        self.stream_chunk_delay = stream_chunk_delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def completion(self, request):
+        """Returns (status, completion or error dict, delay) for a chat completion request."""
+        with self.lock:
+            self.requests += 1
+        delay = self.latency()
+        if random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            status = random.choice([429, 500, 503])
+            return status, {
+                "error": {
+                    "message": f"Simulated error {status} from fake OpenAI",
+                    "type": "server_error" if status != 429 else "rate_limit_exceeded",
+                    "param": None,
+                    "code": None,
+                }
+            }, delay
+
+        prompt_tokens = sum(estimate_tokens(m.get('content') or '') for m in request.get('messages', []))
+        completion_tokens = estimate_tokens(self.reply)
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        return 200, {
+            "id": f"chatcmpl-fake-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'gpt-4-1106-preview'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.reply},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }, delay
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug("fake-openai: " + format, *args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            self.send_json(200, self.server.fake.stats())
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        status, body, delay = self.server.fake.completion(request)
+        time.sleep(delay)
+        if status != 200 or not request.get('stream'):
+            self.send_json(status, body)
+        else:
+            self.stream(body)
+
+    def stream(self, completion):
+        """Sends the completion as server-sent events, word by word, like the real API does."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish_reason=None, usage=None):
+            data = {
+                "id": completion['id'],
+                "object": "chat.completion.chunk",
+                "created": completion['created'],
+                "model": completion['model'],
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if usage:
+                data['usage'] = usage
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        chunk({"role": "assistant", "content": ""})
+        words = completion['choices'][0]['message']['content'].split(' ')
+        for i, word in enumerate(words):
+            chunk({"content": word if i == 0 else ' ' + word})
+            time.sleep(self.server.fake.stream_chunk_delay)
+        chunk({}, finish_reason='stop', usage=completion['usage'])
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_server(fake: FakeOpenAI, host='127.0.0.1', port=0):
+    """
+    Starts the stand-in in a background thread, returns the server and its api base url
+    (to be set as `openai.api_base` or OPENAI_API_BASE env var).
+    """
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    thread = threading.Thread(target=server.serve_forever, name='fake-openai', daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for OpenAI chat completions endpoint.')
+
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1',
+                        help='Address to listen on (default is 127.0.0.1)')
+
+    parser.add_argument('--port',
+                        type=int,
+                        default=8765,
+                        help='Port to listen on (default is 8765)')
+
+    parser.add_argument('--latency',
+                        type=str,
+                        default='fixed:0.5',
+                        help='Latency distribution, like fixed:0.5, uniform:0.2,1.5, normal:1,0.3, lognormal:0,0.5 or exponential:0.8 (default is fixed:0.5)')
+
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests answered with 429/500/503 errors (default is 0)')
+
+    parser.add_argument('--reply',
+                        type=str,
+                        default=DEFAULT_REPLY,
+                        help='Text of every completion')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s [%(levelname)s] %(message)s')
+
+    fake = FakeOpenAI(latency=args.latency, error_rate=args.error_rate, reply=args.reply)
+    server = ThreadingHTTPServer((args.host, args.port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    print(f"Fake OpenAI listening, use OPENAI_API_BASE=http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Stats: {fake.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from telegram import Bot, Update, User
+from telegram.ext import ApplicationBuilder
+import openai
+from marktplaats_gpt import bot, metrics
+from marktplaats_gpt.logging_config import configure_logging
+from marktplaats_gpt.fake_openai import FakeOpenAI, parse_latency, start_server
+from marktplaats_gpt.users_db import UserDB
+from marktplaats_gpt.sessions_db import SessionDB
+from marktplaats_gpt.archive_db import ArchiveDB
+from marktplaats_gpt.state_db import StateDB, SharedStatePersistence
+
+
+LOADTEST_CONTEXT = "You are selling your item on marktplaats.nl. Answer questions and do not lower the price."
+
+
+class LoadTestBot(Bot):
+    """
+    Telegram Bot that never talks to Telegram: `getMe` is answered locally and sent messages are only counted.
+    """
+    sent_messages = itertools.count()
+
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(id=1, first_name='LoadTest', is_bot=True, username='loadtest_bot')
+        return self._bot_user
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        next(self.sent_messages)
+
+
+class FakeMarktplaatsClient:
+    """
+    Stand-in for `marktplaats_messages.client.Client`, with the same blocking behaviour (it sleeps in the calling thread).
+    """
+    latency = staticmethod(lambda: 0.0)
+
+    def __init__(self, load_env=True, use_jar=True, cookie=None):
+        self.cookie = cookie
+
+    def get_conversations(self, params):
+        time.sleep(self.latency())
+        offset, limit = int(params['offset']), int(params['limit'])
+        return {'_embedded': {'mc:conversations': [
+            {
+                'id': f"conv:{self.cookie}:{i}",
+                'itemId': f"m{2000000000 + i}",
+                'title': f"Item {i}",
+                'unreadMessagesCount': i % 3,
+                'otherParticipant': {'id': 1000 + i, 'name': f"Buyer{i}"},
+            }
+            for i in range(offset, offset + limit)
+        ]}}
+
+    def get_conversation(self, conversation_id):
+        time.sleep(self.latency())
+        peer_id = 1000 + int(conversation_id.rsplit(':', 1)[-1])
+        texts = [
+            (peer_id, "Hallo, is it still available?"),
+            (42, "Hi! Yes, it is."),
+            (peer_id, "Will you sell for 200? I can pick it up tomorrow."),
+        ]
+        return {
+            'totalCount': len(texts),
+            'limit': 25,
+            'offset': 0,
+            '_embedded': {
+                'otherParticipant': {'id': peer_id, 'name': f"Buyer{peer_id - 1000}"},
+                'mc:message': [
+                    {
+                        'senderId': sender_id,
+                        'text': text,
+                        'receivedDate': f"2023-10-13T0{i}:00:00Z",
+                        'isRead': True,
+                    }
+                    for i, (sender_id, text) in enumerate(texts)
+                ],
+            },
+        }
+
+
+def fake_item_page(item_id):
+    """Item page with the markup parsed for item data, padded with listing markup to the size of a real one (~250 KB)."""
+    product = {
+        "@type": "Product",
+        "name": f"Item {item_id}",
+        "description": "Cannondale Scalpel Lefty 26\" L Carbon",
+        "offers": {"price": "300.00", "priceCurrency": "EUR"},
+    }
+    related = "".join(
+        f'<li class="hz-Listing"><a href="/v/fietsen/{i}"><div class="hz-Listing-title">Related item {i}</div>'
+        f'<span class="hz-Listing-price">&euro; {i},00</span><img src="/img/{i}.jpg" alt="Item {i}"></a></li>'
+        for i in range(1200)
+    )
+    return (
+        f'<html><head><script type="application/ld+json">{json.dumps(product)}</script></head><body>'
+        f'<div class="Description-description" data-collapsable="description">Cannondale Scalpel Lefty 26" L Carbon, '
+        f'front wheel is after crash.</div><ul>{related}</ul></body></html>'
+    )
+
+
+def fake_fetch_item_page(item_id):
+    time.sleep(FakeMarktplaatsClient.latency())
+    return fake_item_page(item_id), f"https://www.marktplaats.nl/{item_id}"
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+class LoadTest:
+    def __init__(self, applications, suggestions_per_user, think_time):
+        self.applications = applications
+        self.suggestions_per_user = suggestions_per_user
+        self.think_time = think_time
+        self.update_ids = itertools.count(1)
+        self.latencies = {}
+        self.flows = []
+        self.failures = 0
+        self.loop_lags = []
+
+    def update(self, user_id, text):
+        data = {
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': next(self.update_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"loadtest_{user_id}"},
+                'text': text,
+            },
+        }
+        if text.startswith('/'):
+            data['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ')[0])}]
+        return Update.de_json(data, self.applications[0].bot)
+
+    async def send(self, step, user_id, text):
+        start = time.perf_counter()
+        # every update goes to a random replica, like from a load balancer
+        await random.choice(self.applications).process_update(self.update(user_id, text))
+        self.latencies.setdefault(step, []).append(time.perf_counter() - start)
+
+    async def user_flow(self, user_id, delay):
+        """Runs /start -> conversation -> suggestion (with regenerations) for one user."""
+        await asyncio.sleep(delay)
+        start = time.perf_counter()
+        try:
+            await self.send('start', user_id, '/start 5')
+            await asyncio.sleep(self.think_time())
+            await self.send('conversation', user_id, f"Buyer{user_id % 5} ({user_id % 5 + 1})")
+            for _ in range(self.suggestions_per_user):
+                await asyncio.sleep(self.think_time())
+                await self.send('suggestion', user_id, 'Yes')
+            await self.send('suggestion', user_id, 'No')
+            self.flows.append(time.perf_counter() - start)
+        except Exception as e:
+            logging.exception("Flow of user %s failed: %s", user_id, e)
+            self.failures += 1
+
+    async def monitor_loop(self, interval=0.01):
+        """Measures how late the event loop wakes up, i.e. how long it was blocked by synchronous code."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(max(0.0, time.perf_counter() - start - interval))
+
+    async def run(self, users, ramp_up):
+        monitor = asyncio.create_task(self.monitor_loop())
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            self.user_flow(user_id, random.uniform(0, ramp_up))
+            for user_id in range(1, users + 1)
+        ])
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+        return elapsed
+
+    def report(self, elapsed):
+        updates = sum(len(v) for v in self.latencies.values())
+        lines = [
+            f"Users: {len(self.flows) + self.failures} ({self.failures} failed), elapsed {elapsed:.2f}s",
+            f"Throughput: {updates / elapsed:.1f} updates/s, {len(self.flows) / elapsed:.2f} flows/s, {next(LoadTestBot.sent_messages)} messages sent",
+            "Latency (s):      count      p50      p90      p99      max",
+        ]
+        for step, values in list(self.latencies.items()) + [('flow', self.flows)]:
+            lines.append(f"  {step:<14} {len(values):>7} {percentile(values, 50):>8.3f} {percentile(values, 90):>8.3f} {percentile(values, 99):>8.3f} {max(values, default=0):>8.3f}")
+        blocked = [lag for lag in self.loop_lags if lag > 0.005]
+        lines.append(
+            f"Event loop blocked: {sum(blocked):.2f}s total ({100.0 * sum(blocked) / elapsed:.1f}% of run), "
+            f"lag p50 {percentile(self.loop_lags, 50) * 1000:.1f}ms, p99 {percentile(self.loop_lags, 99) * 1000:.1f}ms, "
+            f"max {max(self.loop_lags, default=0) * 1000:.1f}ms"
+        )
+        waits = list(metrics.ADMISSION_WAIT_SECONDS.values.values())
+        admitted = sum(sum(counts[:-1]) for counts in waits)
+        lines.append(
+            f"Admission: {sum(metrics.ADMISSION_REJECTIONS.values.values()):.0f} refused by rate limits, "
+            f"{admitted} admitted, waiting for a slot {1000 * sum(counts[-1] for counts in waits) / max(1, admitted):.1f}ms on average"
+        )
+        clients = metrics.MARKTPLAATS_CLIENTS.values
+        lines.append(f"Marktplaats clients: {clients.get(('created',), 0)} created, {clients.get(('reused',), 0)} reused from the pool")
+        return "\n".join(lines)
+
+
+def setup_users(users, quota):
+    UserDB.init_db()
+    SessionDB.init_db()
+    ArchiveDB.init_db()
+    if os.environ.get("STORAGE_URL"):
+        StateDB.init_db()
+    for user_id in range(1, users + 1):
+        username = f"loadtest_{user_id}"
+        UserDB.set(username, 'status', 'active')
+        UserDB.set(username, 'cookie', f"cookie-{user_id}")
+        UserDB.set(username, 'openai-quota', f"{quota}")
+
+
+async def run_load_test(args):
+    applications = []
+    for _ in range(args.replicas):
+        builder = ApplicationBuilder().bot(LoadTestBot(token='0:loadtest')).updater(None)
+        if os.environ.get("STORAGE_URL"):
+            builder.persistence(SharedStatePersistence())
+        application = bot.build_application(builder)
+        await application.initialize()
+        # background work of the bot (item parser workers, event loop monitor, compaction) as run_polling starts it
+        await application.post_init(application)
+        applications.append(application)
+    think_time = parse_latency(args.think_time)
+    load_test = LoadTest(applications, args.suggestions_per_user, think_time)
+    elapsed = await load_test.run(args.users, args.ramp_up)
+    for application in applications:
+        await application.post_shutdown(application)
+        await application.shutdown()
+    return load_test.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the Telegram bot with synthetic updates, fake Marktplaats and (by default) fake OpenAI.')
+
+    parser.add_argument('--users',
+                        type=int,
+                        default=200,
+                        help='Number of simulated Telegram users (default is 200)')
+
+    parser.add_argument('--suggestions-per-user',
+                        type=int,
+                        default=2,
+                        help='Number of "Yes" answers (suggestion and regenerations) per user (default is 2)')
+
+    parser.add_argument('--ramp-up',
+                        type=float,
+                        default=10.0,
+                        help='Users start at random moments within this number of seconds (default is 10)')
+
+    parser.add_argument('--think-time',
+                        type=str,
+                        default='uniform:0.5,2',
+                        help='Pause of a user between steps, as latency distribution (default is uniform:0.5,2)')
+
+    parser.add_argument('--openai-api-base',
+                        type=str,
+                        help='Use already running OpenAI stand-in at this url instead of starting one')
+
+    parser.add_argument('--openai-latency',
+                        type=str,
+                        default='lognormal:0,0.5',
+                        help='Latency distribution of the started OpenAI stand-in (default is lognormal:0,0.5)')
+
+    parser.add_argument('--openai-error-rate',
+                        type=float,
+                        default=0.0,
+                        help='Error rate of the started OpenAI stand-in (default is 0)')
+
+    parser.add_argument('--marktplaats-latency',
+                        type=str,
+                        default='uniform:0.1,0.4',
+                        help='Latency distribution of fake Marktplaats API and item page calls (default is uniform:0.1,0.4)')
+
+    parser.add_argument('--replicas',
+                        type=int,
+                        default=1,
+                        help='Number of bot applications sharing the storage, updates go to random ones (default is 1), needs STORAGE_URL')
+
+    parser.add_argument('--workdir',
+                        type=str,
+                        help='Directory for the databases and the log (default is a new temporary directory)')
+
+    args = parser.parse_args()
+    if args.replicas > 1 and not os.environ.get("STORAGE_URL"):
+        parser.error("--replicas needs shared state, set STORAGE_URL (sqlite: or postgresql://...)")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='marktplaats-gpt-loadtest-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    configure_logging('marktplaats-gpt-loadtest.log', 'root=INFO,httpx=WARNING')
+    print(f"Running in {workdir}")
+
+    with open('chat-context', 'w') as file:
+        file.write(LOADTEST_CONTEXT)
+    setup_users(args.users, quota=1000000)
+
+    if args.openai_api_base:
+        openai.api_base = args.openai_api_base
+    else:
+        fake = FakeOpenAI(latency=args.openai_latency, error_rate=args.openai_error_rate)
+        server, openai.api_base = start_server(fake)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-loadtest")
+
+    FakeMarktplaatsClient.latency = staticmethod(parse_latency(args.marktplaats_latency))
+    bot.Client = FakeMarktplaatsClient
+    bot.fetch_item_page = fake_fetch_item_page
+    bot.configure()
+
+    print(asyncio.run(run_load_test(args)))
+
+
+if __name__ == "__main__":
+    main()
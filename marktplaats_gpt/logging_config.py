@@ -0,0 +1,86 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from datetime import datetime, timezone
+from marktplaats_gpt import tracing # gives log records their trace_id
+
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+# Attributes of every log record, others are `extra` fields and go to JSON lines as they are
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'trace_id', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON lines with time, level, logger, trace id, message, exception and `extra` fields."""
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'trace_id': getattr(record, 'trace_id', '-'),
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records as they are, so messages are formatted by the listener thread and not by the logging one,
+    arguments of log calls should not be changed after the call.
+    """
+    def prepare(self, record):
+        return record
+
+
+def parse_levels(levels: str):
+    """Parses "root=INFO,httpx=WARNING,marktplaats_gpt.bot=DEBUG" into {logger name: level}."""
+    parsed = {}
+    for item in levels.split(','):
+        if item.strip():
+            name, level = item.split('=', 1)
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure_logging(filename: str, levels: str = 'root=DEBUG'):
+    """
+    Sets up logging of an entry point: log calls only put records in a queue, a background thread formats them and
+    writes to `filename`, rotating it after LOG_MAX_BYTES (10 MB) and keeping LOG_BACKUP_COUNT (5) old files.
+
+    Lines are JSON (LOG_FORMAT=json, default) or text (LOG_FORMAT=text). Logger levels are `levels` updated by
+    LOG_LEVELS env var, like "root=INFO,marktplaats_gpt.bot=DEBUG". Returns the queue listener, stopped at exit.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename,
+        maxBytes=int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+        backupCount=int(os.environ.get("LOG_BACKUP_COUNT", "5")),
+        encoding='utf-8',
+    )
+    if os.environ.get("LOG_FORMAT", "json") == "text":
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    else:
+        file_handler.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+
+    for name, level in {**parse_levels(levels), **parse_levels(os.environ.get("LOG_LEVELS", ""))}.items():
+        logging.getLogger(None if name == 'root' else name).setLevel(level)
+    return listener
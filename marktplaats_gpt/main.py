@@ -1,30 +1,19 @@
 import sys
 import os
-import openai
-from dotenv import load_dotenv
 import logging
 import argparse
-from marktplaats_messages.client import Client
-from marktplaats_gpt.scraping import load_item_data
+from marktplaats_gpt.chat_context import load_context
 
-# Load environment variables from .env file
-load_dotenv()
+# Heavy modules (openai, marktplaats_messages, bs4 and requests) are imported by the actions needing them,
+# not at module load, so that `--help` and light actions start fast. See benchmarks/startup.py.
 
-openai.organization = os.environ.get("OPENAI_ORG_ID")
-openai.api_key = os.environ.get("OPENAI_API_KEY")
 
-
-def load_context(filename):
-    """
-    Loads context for system role for OpenAI chat completion task.
-    """
-    logging.info(f"Loading context from {filename}...")
-    lines = []
-
-    with open(filename, 'r') as file:
-        lines = [line.strip() for line in file]
-    
-    return ' '.join(lines)
+def configure_openai():
+    """Imports and configures openai module, returns it."""
+    import openai
+    openai.organization = os.environ.get("OPENAI_ORG_ID")
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    return openai
 
 
 def get_yes_no_answer(prompt):
@@ -56,8 +45,12 @@ def main():
                         default=5,
                         help='Conversations list limit (default is 5)')
 
-    parser.add_argument('--conversation', 
-                        type=str, 
+    parser.add_argument('--ndjson',
+                        action='store_true',
+                        help='With --list-conversations, list all conversations from --conversations-offset, one JSON record per line (pages of --batch-page-size)')
+
+    parser.add_argument('--conversation',
+                        type=str,
                         help='Get details of a specific conversation by its ID')
 
     parser.add_argument('--load-item-data', 
@@ -87,17 +80,157 @@ def main():
                         default="context.txt",
                         help='File with context to be used for OpenAI chat completion (system role)')
     
+    parser.add_argument('--batch', 
+                        action='store_true', 
+                        help='Suggest replies for all unread conversations, whose last message is from peer, concurrently (no replies are sent)')
+
+    parser.add_argument('--batch-concurrency', 
+                        type=int,
+                        default=4,
+                        help='Conversations processed at once in --batch mode (default is 4)')
+
+    parser.add_argument('--batch-page-size', 
+                        type=int,
+                        default=50,
+                        help='Conversations listed per request in --batch, --ndjson and --archive modes, and watched in --watch mode (default is 50)')
+
+    parser.add_argument('--batch-max-conversations', 
+                        type=int,
+                        default=200,
+                        help='Most recent conversations looked through in --batch mode (default is 200), starting from --conversations-offset')
+
+    parser.add_argument('--batch-include-read', 
+                        action='store_true', 
+                        help='Look into read conversations too in --batch mode, a read question without an answer gets a suggestion as well (all --batch-max-conversations are listed)')
+
+    parser.add_argument('--batch-output', 
+                        type=str,
+                        help='File to append --batch results to, as JSON lines')
+
+    parser.add_argument('--watch', 
+                        action='store_true', 
+                        help='Keep polling conversations and suggest replies to new messages from peers, replying as with --conversation (see --dry-run and --good-luck)')
+
+    parser.add_argument('--watch-state-file', 
+                        type=str,
+                        default='watch-state.json',
+                        help='File keeping state of watched conversations between polls and runs (default is watch-state.json)')
+
+    parser.add_argument('--watch-min-interval', 
+                        type=float,
+                        default=30,
+                        help='Seconds between polls right after a change (default is 30)')
+
+    parser.add_argument('--watch-max-interval', 
+                        type=float,
+                        default=600,
+                        help='Seconds between polls after a long time without changes (default is 600)')
+
+    parser.add_argument('--archive', 
+                        action='store_true', 
+                        help='Sync all conversations and their messages into the local archive (archive.db), for --search')
+
+    parser.add_argument('--search', 
+                        type=str,
+                        help='Search messages and item titles in the local archive, all words must match, word* matches a prefix')
+
+    parser.add_argument('--search-days', 
+                        type=int,
+                        help='Search only messages of the last days')
+
+    parser.add_argument('--compact-sessions', 
+                        action='store_true', 
+                        help="Roll bot's sessions older than --sessions-retention-days into daily rollups (in sessions.db of current directory)")
+
+    parser.add_argument('--sessions-retention-days', 
+                        type=int,
+                        default=90,
+                        help='Days of sessions kept as they are by --compact-sessions (default is 90)')
+
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s [%(levelname)s] %(message)s',
-                    filename='marktplaats-gpt.log',
-                    filemode='a')
-    
-    c = Client()
+    # Load environment variables from .env file
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from marktplaats_gpt.logging_config import configure_logging
+    configure_logging('marktplaats-gpt.log')
+
+    if args.compact_sessions:
+        from marktplaats_gpt.sessions_db import SessionDB
+        SessionDB.init_db()
+        # the bot's periodic compaction leaves the one-time full VACUUM to this, run while the bot is stopped
+        result = SessionDB.compact(args.sessions_retention_days, full_vacuum=True)
+        print(f"Compacted {result['rows']} sessions rows of {result['days']} days")
+        return
+
+    if args.search:
+        from marktplaats_gpt.archive_db import ArchiveDB
+        ArchiveDB.init_db()
+        for found in ArchiveDB.search('', args.search, from_seconds=args.search_days and args.search_days * 3600*24):
+            author = found['peer'] if found['from_peer'] else 'You'
+            print(f"{found['conversation']} :: {found['title']} :: {found['peer']} :: {found['itemId']}")
+            print(f"[{found['receivedDate']}] {author}: {found['snippet']}")
+            print()
+        return
 
     if args.load_item_data:
+        from marktplaats_gpt.scraping import load_item_data
         print(load_item_data(args.load_item_data))
+        return
+
+    from marktplaats_messages.client import Client
+    c = Client()
+
+    if args.archive:
+        from marktplaats_gpt.archive_db import ArchiveDB, sync
+        ArchiveDB.init_db()
+        counts = sync(c, page_size=args.batch_page_size)
+        print(f"Archived {counts['conversations']} conversations, {counts['fetched']} changed, with {counts['messages']} new messages")
+
+    elif args.batch:
+        from marktplaats_gpt.batch import run_batch
+        configure_openai()
+        context = load_context(args.openai_context_file)
+        output = open(args.batch_output, 'a') if args.batch_output else None
+        try:
+            run_batch(c, context, args.openai_model,
+                      concurrency=args.batch_concurrency,
+                      offset=args.conversations_offset,
+                      page_size=args.batch_page_size,
+                      max_conversations=args.batch_max_conversations,
+                      output=output,
+                      include_read=args.batch_include_read)
+        finally:
+            if output:
+                output.close()
+
+    elif args.watch:
+        from marktplaats_gpt.watch import Watcher
+        configure_openai()
+        watcher = Watcher(c, load_context(args.openai_context_file), args.openai_model,
+                          state_file=args.watch_state_file,
+                          page_size=args.batch_page_size,
+                          min_interval=args.watch_min_interval,
+                          max_interval=args.watch_max_interval,
+                          dry_run=args.dry_run,
+                          good_luck=args.good_luck,
+                          approve=get_yes_no_answer)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+    elif args.list_conversations and args.ndjson:
+        import json
+        from marktplaats_gpt.batch import all_conversations
+        try:
+            for conv in all_conversations(c, offset=args.conversations_offset, page_size=args.batch_page_size):
+                sys.stdout.write(json.dumps(conv) + "\n")
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # Reader went away (like `| head`), don't let Python complain about it when flushing stdout at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
     elif args.list_conversations:
         convs = c.get_conversations(params = {
@@ -110,6 +243,7 @@ def main():
             print("{id} [{unreadMessagesCount}] :: {title} :: {otherParticipant_name} :: {itemId}".format(**conv, **{'otherParticipant_name': conv['otherParticipant']['name']}))
 
     elif args.conversation:
+        openai = configure_openai()
         messages = c.get_conversation(args.conversation)
         peer = messages['_embedded']['otherParticipant']
         if messages['totalCount'] > messages['limit'] + messages['offset']:
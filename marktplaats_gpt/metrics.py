@@ -0,0 +1,201 @@
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from marktplaats_gpt import tracing
+
+
+# Upper bounds of latency histogram buckets in seconds, OpenAI completions take tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in (*zip(labelnames, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Metric of Prometheus text format, with a value per combination of label values, safe to update from any thread."""
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.samples(key, value))
+        return lines
+
+    def samples(self, key, value):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}"]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per bucket counts (the last one is +Inf), then sum of the observed values
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {counts[-1]}")
+        lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+
+HANDLER_SECONDS = Histogram('marktplaats_gpt_handler_seconds', "Time of handling a bot update, by handler", ['handler'])
+HANDLER_ERRORS = Counter('marktplaats_gpt_handler_errors_total', "Bot handlers failed with an exception", ['handler'])
+UPSTREAM_SECONDS = Histogram('marktplaats_gpt_upstream_seconds', "Time of calls to Marktplaats API, item pages and OpenAI", ['upstream', 'call'])
+UPSTREAM_ERRORS = Counter('marktplaats_gpt_upstream_errors_total', "Calls to upstreams failed with an exception", ['upstream', 'call'])
+DB_SECONDS = Histogram('marktplaats_gpt_db_seconds', "Time of database calls, on database threads", ['call'])
+OPENAI_TOKENS = Counter('marktplaats_gpt_openai_tokens_total', "OpenAI tokens used, by model and kind (prompt or completion)", ['model', 'kind'])
+EVENT_LOOP_LAG = Histogram('marktplaats_gpt_event_loop_lag_seconds', "Delay of event loop wake-ups, how long the loop was blocked")
+ADMISSION_REJECTIONS = Counter('marktplaats_gpt_admission_rejections_total', "Requests refused by users' rate limits, by operation", ['operation'])
+ADMISSION_WAIT_SECONDS = Histogram('marktplaats_gpt_admission_wait_seconds', "Time of waiting for a slot of the concurrency budget, by operation", ['operation'])
+ADMISSION_QUEUED = Gauge('marktplaats_gpt_admission_queued', "Requests waiting for a slot of the concurrency budget")
+MARKTPLAATS_CLIENTS = Counter('marktplaats_gpt_marktplaats_clients_total', "Marktplaats clients taken for users' calls, by result (reused from the pool or created)", ['result'])
+MARKTPLAATS_CLIENTS_POOLED = Gauge('marktplaats_gpt_marktplaats_clients_pooled', "Marktplaats clients kept in the pool")
+ITEM_PARSE_SECONDS = Histogram('marktplaats_gpt_item_parse_seconds', "Time of parsing item pages, waiting for a parser worker included")
+
+
+@contextmanager
+def upstream(name: str, call: str):
+    """Times a call to an upstream, counting the failed ones, and traces it as a span of the current trace:
+
+        with metrics.upstream('openai', 'ChatCompletion.create'):
+            completion = openai.ChatCompletion.create(...)
+    """
+    start = time.perf_counter()
+    try:
+        with tracing.child_span(f"{name} {call}", upstream=name):
+            yield
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream=name, call=call)
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start, upstream=name, call=call)
+
+
+def timed_handler(callback):
+    """Wraps a bot handler callback to time it, by its function name."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+
+    return timed
+
+
+def timed_call(call: str, func, *args, **kwargs):
+    with DB_SECONDS.time(call=call), tracing.child_span(f"db {call}"):
+        return func(*args, **kwargs)
+
+
+async def monitor_event_loop(interval=0.5):
+    """Measures, every `interval` seconds, how late the event loop wakes up."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+def expose():
+    """Returns all metrics in Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug("Metrics %s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = expose().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(host='127.0.0.1', port=9464):
+    """Serves /metrics on a daemon thread, returns the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logging.info("Serving metrics at http://%s:%d/metrics", *server.server_address[:2])
+    return server
@@ -0,0 +1,93 @@
+import os
+import re
+from marktplaats_gpt.openai_pricing import OPENAI_PRICES
+
+
+# Short questions that any model answers well: availability, pick-up, shipping, location, timing.
+SIMPLE_QUESTION_PATTERNS = [
+    r'\b(nog )?(beschikbaar|te koop)\b',
+    r'\b(still )?available\b',
+    r'\b(ophalen|afhalen|pick ?up|collect)\b',
+    r'\b(verzenden|versturen|opsturen|ship|shipping|send|postnl)\b',
+    r'\b(waar|where|adres|address|locatie|location)\b',
+    r'\b(wanneer|when|vandaag|morgen|today|tomorrow|tonight|vanavond)\b',
+]
+
+# Anything about money or a deal needs the larger model, as it must hold the price.
+COMPLEX_QUESTION_PATTERNS = [
+    r'(€|\beuros?\b|\d+\s*eur\b|\b(for|voor)\s*\d+)',
+    r'\b(bod|bieden|bied|offer|korting|discount|lager|lower|prijs|price|deal|onderhandel|negotia\w*|ruil|trade)\b',
+    r'\b(garantie|warranty|kapot|broken|defect|schade|damage|waarom|why)\b',
+]
+
+SIMPLE, COMPLEX, UNKNOWN = 'simple', 'complex', 'unknown'
+
+
+def classify_question(text: str):
+    """Classifies buyer's message with keyword heuristics into SIMPLE, COMPLEX or UNKNOWN."""
+    text = text.lower()
+    if any(re.search(p, text) for p in COMPLEX_QUESTION_PATTERNS):
+        return COMPLEX
+    if len(text) > 200 or text.count('?') > 2:
+        return COMPLEX
+    if any(re.search(p, text) for p in SIMPLE_QUESTION_PATTERNS):
+        return SIMPLE
+    return UNKNOWN
+
+
+def estimate_prompt_tokens(completion_messages):
+    """Rough token estimate (4 characters per token) of the whole prompt."""
+    return sum(len(m['content']) for m in completion_messages) // 4
+
+
+class ModelRouter:
+    """
+    Picks OpenAI model for a suggestion request.
+
+    Rules, in order of precedence:
+      1. escalation (user asked for a smarter answer) -> large model
+      2. no small model configured -> large model
+      3. remaining quota below `low_quota` -> small model
+      4. prompt longer than `max_small_prompt_tokens` -> large model
+      5. last buyer message classified as SIMPLE -> small model, otherwise large model
+    """
+    def __init__(self, large_model, small_model=None, max_small_prompt_tokens=2000, low_quota=0.05):
+        self.large_model = large_model
+        self.small_model = small_model
+        self.max_small_prompt_tokens = max_small_prompt_tokens
+        self.low_quota = low_quota
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            large_model=os.environ.get("OPENAI_MODEL", "gpt-4-1106-preview"),
+            small_model=os.environ.get("OPENAI_SMALL_MODEL", "gpt-3.5-turbo-1106"),
+            max_small_prompt_tokens=int(os.environ.get("OPENAI_ROUTING_MAX_SMALL_PROMPT_TOKENS", "2000")),
+            low_quota=float(os.environ.get("OPENAI_ROUTING_LOW_QUOTA", "0.05")),
+        )
+
+    def models(self):
+        return [m for m in [self.large_model, self.small_model] if m]
+
+    def check_models(self):
+        """Fails fast if costs of a routed model are unknown, as usage accounting would break on it."""
+        for model in self.models():
+            if model not in OPENAI_PRICES:
+                raise NotImplementedError(f"Model's costs are unknown: {model}!!!")
+
+    def route(self, completion_messages, remaining_quota: float, escalate: bool = False):
+        """Returns (model, reason) for the completion request."""
+        if escalate:
+            return self.large_model, 'escalated'
+        if not self.small_model:
+            return self.large_model, 'routing disabled'
+        if remaining_quota < self.low_quota:
+            return self.small_model, f"remaining quota ${remaining_quota:.4f} is low"
+        prompt_tokens = estimate_prompt_tokens(completion_messages)
+        if prompt_tokens > self.max_small_prompt_tokens:
+            return self.large_model, f"long prompt (~{prompt_tokens} tokens)"
+        buyer_messages = [m['content'] for m in completion_messages if m['role'] == 'user']
+        question = classify_question(buyer_messages[-1]) if buyer_messages else UNKNOWN
+        if question == SIMPLE:
+            return self.small_model, 'simple question'
+        return self.large_model, f"{question} question"
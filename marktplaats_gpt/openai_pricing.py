@@ -0,0 +1,45 @@
+import logging
+
+
+# model: (micro-dollars per 1K prompt tokens, micro-dollars per 1K completion tokens), see https://openai.com/pricing
+OPENAI_PRICES = {
+    "gpt-4-1106-preview": (10000, 30000), # 128k context, $0.01 / $0.03
+    "gpt-4-0613": (30000, 60000), # 8K context, $0.03 / $0.06
+    "gpt-3.5-turbo-1106": (1000, 2000), # 16K context, $0.001 / $0.002
+    "gpt-3.5-turbo-0613": (1500, 2000), # 4K context, $0.0015 / $0.002
+}
+
+
+def openai_cost_micro_usd(model: str, prompt_tokens: int, completion_tokens: int):
+    """
+    Return estimated cost of OpenAI completion in micro-dollars (rounded), based on prices at https://openai.com/pricing as of 2023-11-06.
+
+    See https://platform.openai.com/docs/models/continuous-model-upgrades for models status.
+    """
+    if model not in OPENAI_PRICES:
+        raise NotImplementedError(f"Model's costs are unknown: {model}!!!")
+    prompt_price, completion_price = OPENAI_PRICES[model]
+    return (prompt_price * prompt_tokens + completion_price * completion_tokens + 500) // 1000
+
+
+def usage_cost_micro_usd(model: str, prompt_tokens: int, completion_tokens: int, requested_model: str = None):
+    """
+    Cost of a completion for usage accounting, which must not fail as OpenAI has charged for it already.
+    `model` returned by OpenAI can be a snapshot without a price, it is then priced as `requested_model`,
+    and at 0 if that has no price either.
+    """
+    for priced_model in [model, requested_model]:
+        if priced_model in OPENAI_PRICES:
+            if priced_model != model:
+                logging.warning("Model %s has no price, its usage is priced as %s", model, priced_model)
+            return openai_cost_micro_usd(priced_model, prompt_tokens, completion_tokens)
+    logging.error("Model %s has no price, its usage is not counted in quota", model)
+    return 0
+
+
+def openai_cost(model: str, prompt_tokens: int, completion_tokens: int):
+    """Return estimated cost of OpenAI completion in $$."""
+    if model not in OPENAI_PRICES:
+        raise NotImplementedError(f"Model's costs are unknown: {model}!!!")
+    prompt_price, completion_price = OPENAI_PRICES[model]
+    return (prompt_price * prompt_tokens + completion_price * completion_tokens) / 1e9
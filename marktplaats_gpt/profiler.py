@@ -0,0 +1,107 @@
+import asyncio
+import cProfile
+import html
+import logging
+import os
+import pstats
+import time
+from datetime import datetime, timezone
+from telegram import Update
+from telegram.ext import TypeHandler
+
+
+# Group of the handler counting profiled updates, after all others, so that it sees updates fully handled
+PROFILE_GROUP = 100
+
+# Length of the summary, escaped for HTML, to fit a Telegram message (4096) with the rest of the reply
+SUMMARY_MAX_LENGTH = 3900
+
+
+class UpdateProfiler:
+    """
+    cProfile of the event loop thread for a number of seconds or of updates, started and stopped by `/profile`.
+    Results are saved to a stats file in `directory` (for `python -m pstats` or snakeviz) and summarized as
+    the `top` functions by own time.
+
+    When not profiling nothing is added to handling of updates: the handler counting them is registered only
+    while profiling by updates. Database and other threads are not profiled.
+    """
+    def __init__(self, directory='.', top=15):
+        self.directory = directory
+        self.top = top
+        self.profile = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(directory=os.environ.get("PROFILE_DIR", "."), top=int(os.environ.get("PROFILE_TOP", "15")))
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self, application, chat_id, seconds=None, updates=None):
+        self.chat_id = chat_id
+        self.max_updates = updates
+        self.updates = 0
+        self.started = time.perf_counter()
+        self.timer = None
+        self.counter = None
+        if seconds:
+            self.timer = application.create_task(self.stop_after(application, seconds))
+        if updates:
+            self.counter = TypeHandler(Update, self.count)
+            # the handlers dict is being iterated by the update calling us, it's replaced, not changed
+            application.handlers = {**application.handlers, PROFILE_GROUP: [self.counter]}
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        logging.warning("Profiling started for %s seconds, %s updates", seconds, updates)
+
+    async def stop_after(self, application, seconds):
+        await asyncio.sleep(seconds)
+        await self.stop(application)
+
+    async def count(self, update, context):
+        self.updates += 1
+        if self.max_updates and self.updates >= self.max_updates:
+            await self.stop(context.application)
+
+    async def stop(self, application):
+        """Stops profiling, saves the stats and sends their summary to the chat it was started from."""
+        if not self.running:
+            return
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+        if self.counter:
+            application.handlers = {group: handlers for group, handlers in application.handlers.items() if group != PROFILE_GROUP}
+        if self.timer and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+
+        seconds = time.perf_counter() - self.started
+        filename = os.path.join(self.directory, f"profile-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.prof")
+        profile.dump_stats(filename)
+        logging.warning("Profiling stopped after %.1f seconds, stats saved to %s", seconds, filename)
+        text = self.summary(pstats.Stats(profile), seconds)
+        await application.bot.send_message(
+            chat_id=self.chat_id,
+            text=f"<pre>{text}</pre>\nStats are saved to {filename}",
+            parse_mode='HTML'
+        )
+
+    def summary(self, stats, seconds):
+        """Returns the top functions by own time, with their total time and calls, escaped for HTML and cut by whole lines."""
+        updates = f", {self.updates} updates" if self.counter else ""
+        lines = [
+            f"Profiled {seconds:.1f}s{updates}, {stats.total_calls} calls, {stats.total_tt:.3f}s in functions",
+            f"{'own ms':>9} {'total ms':>9} {'calls':>7}  function",
+        ]
+        hot = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+        for (file, line, function), (_, calls, own_time, total_time, _) in hot:
+            location = f" {os.path.basename(file)}:{line}" if line else "" # built-ins have no location
+            lines.append(f"{own_time * 1000:>9.1f} {total_time * 1000:>9.1f} {calls:>7}  {function}{location}")
+        text = html.escape(lines[0], quote=False)
+        for line in lines[1:]:
+            line = html.escape(line, quote=False)
+            if len(text) + 1 + len(line) > SUMMARY_MAX_LENGTH:
+                break
+            text += "\n" + line
+        return text
@@ -0,0 +1,77 @@
+import logging
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from marktplaats_gpt.archive_db import ArchiveDB
+
+
+def match_threshold():
+    """Cosine similarity of buyer's message to a past one needed to offer the past reply, REPLY_MATCH_THRESHOLD env var."""
+    return float(os.environ.get("REPLY_MATCH_THRESHOLD", "0.6"))
+
+
+def tokenize(text: str):
+    text = unicodedata.normalize('NFKD', text.lower())
+    return re.findall(r'\w+', ''.join(c for c in text if not unicodedata.combining(c)))
+
+
+class ReplyIndex:
+    """
+    TF-IDF index of past (buyer message, seller reply) pairs, fully local. Buyer messages are sparse vectors
+    of sublinear term frequencies times smoothed inverse document frequencies, normalized, and a new message is
+    matched by cosine similarity, computed over an inverted index of the terms.
+
+    Messages with the same words are indexed once, with the latest reply, so frequent questions don't lose weight
+    of their own terms.
+    """
+    def __init__(self, pairs):
+        self.pairs = list({tuple(tokenize(question)): (question, reply) for question, reply in pairs}.values())
+        documents = [Counter(tokenize(question)) for question, _ in self.pairs]
+        document_frequency = Counter(term for terms in documents for term in terms)
+        self.idf = {term: self.smooth_idf(df) for term, df in document_frequency.items()}
+        self.postings = {}
+        for number, terms in enumerate(documents):
+            for term, weight in self.vector(terms).items():
+                self.postings.setdefault(term, []).append((number, weight))
+
+    def smooth_idf(self, df: int):
+        return math.log((1 + len(self.pairs)) / (1 + df)) + 1
+
+    def vector(self, terms: Counter):
+        vector = {term: (1 + math.log(count)) * self.idf.get(term, self.smooth_idf(0)) for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {term: weight / norm for term, weight in vector.items()} if norm else {}
+
+    def match(self, text: str):
+        """Returns (similarity, buyer message, reply) of the most similar past message, or None."""
+        scores = Counter()
+        for term, weight in self.vector(Counter(tokenize(text))).items():
+            for number, document_weight in self.postings.get(term, ()):
+                scores[number] += weight * document_weight
+        if not scores:
+            return None
+        number = max(scores, key=scores.get)
+        question, reply = self.pairs[number]
+        return scores[number], question, reply
+
+
+_indexes = {}
+
+
+def best_reply(owner: str, text: str, threshold: float = None):
+    """
+    Returns (similarity, buyer message, reply) of `owner`'s archived reply to the message most similar to `text`,
+    if similar enough, or None. Indexes are kept per owner and rebuilt when the archive gets new messages.
+    """
+    version = ArchiveDB.get_version(owner)
+    cached = _indexes.get(owner)
+    if cached is None or cached[0] != version:
+        cached = (version, ReplyIndex(ArchiveDB.get_reply_pairs(owner)))
+        _indexes[owner] = cached
+        logging.info("Indexed %d past replies of %r", len(cached[1].pairs), owner)
+    match = cached[1].match(text)
+    if match and match[0] >= (match_threshold() if threshold is None else threshold):
+        return match
+    return None
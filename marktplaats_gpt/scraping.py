@@ -1,13 +1,27 @@
 from bs4 import BeautifulSoup
 import requests
+import asyncio
 import logging
+import logging.handlers
 import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-def load_item_data(item_id):
+
+# Parsed by every started parser worker, to have bs4 imported and its parser warmed up before the first item page
+WARM_UP_PAGE = """<html><body>
+<script type="application/ld+json">{"@type": "Product", "name": "Warm-up", "offers": {"price": "1", "priceCurrency": "EUR"}}</script>
+<div class="Description-description" data-collapsable="description">Warm-up</div>
+</body></html>"""
+
+
+def fetch_item_page(item_id):
     """
-    Loads marktplaats item data by scraping the html page.
+    Fetches html page of marktplaats item, saving it to cache/{item_id}.html. Returns the html and the page url.
     """
-
     url = f'https://www.marktplaats.nl/{item_id}'
     response = requests.get(url)
 
@@ -15,8 +29,15 @@ def load_item_data(item_id):
     with open(f'cache/{item_id}.html', 'w') as file:
         file.write(response.text)
     logging.debug('reply saved to %s', file.name)
+    return response.text, url
+
 
-    soup = BeautifulSoup(response.text, "html.parser")
+def parse_item_page(html, item_id, url):
+    """
+    Returns item data (name, description, price and currency) as JSON text, scraped from the item html page,
+    or None if there is none. CPU-bound, see ItemParserPool.
+    """
+    soup = BeautifulSoup(html, "html.parser")
 
     for e in soup.find_all(type="application/ld+json"):
         try:
@@ -38,9 +59,120 @@ def load_item_data(item_id):
                 else:
                     logging.error("The desired div with class 'Description-description' was not found.")
 
-                return json.dumps(product), url
-        except e:
-            logging.error(e)
+                return json.dumps(product)
+        except (ValueError, KeyError, TypeError) as error:
+            logging.error("Item %s (%s) has unexpected application/ld+json: %r", item_id, url, error)
 
     logging.warn("No product information found")
-    return None, url
\ No newline at end of file
+    return None
+
+
+def load_item_data(item_id):
+    """
+    Loads marktplaats item data by scraping the html page.
+    """
+    html, url = fetch_item_page(item_id)
+    return parse_item_page(html, item_id, url), url
+
+
+class RelayHandler(logging.Handler):
+    """Handles log records of parser workers by the loggers of this process."""
+    def emit(self, record):
+        if not hasattr(record, 'trace_id'):
+            record.trace_id = '-'
+        logging.getLogger(record.name).handle(record)
+
+
+# Seconds `ItemParserPool.start` waits for every worker to be warmed up
+WARM_UP_TIMEOUT = 60
+
+warm_up_barrier = None
+
+
+def init_worker(log_queue, level, barrier):
+    global warm_up_barrier
+    warm_up_barrier = barrier
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    BeautifulSoup(WARM_UP_PAGE, "html.parser").find_all(type="application/ld+json")
+
+
+def confirm_warm_up(timeout):
+    """
+    Run by `ItemParserPool.start` once per worker: a worker waits at the barrier until all of them reach it, so no
+    worker runs two of these and every one of them must have been started and warmed up.
+    """
+    warm_up_barrier.wait(timeout)
+    return os.getpid()
+
+
+class ItemParserPool:
+    """
+    Parses item pages in `workers` processes, so that BeautifulSoup's pure-Python work doesn't hold the GIL of the bot
+    and stall its event loop; with 0 workers pages are parsed on a thread of the bot process.
+
+    Workers are spawned, not forked from the threaded bot process, and `start` waits for all of them to be warmed up.
+    A worker gets the page html and sends back only item data as JSON text, its log records go to the logging of
+    this process.
+    """
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.executor = None
+        self.listener = None
+        self.start_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(workers=int(os.environ.get("ITEM_PARSER_WORKERS", "0")))
+
+    def start(self):
+        """Starts the workers and waits for them to be ready, blocking, once for all callers. Until then pages are parsed on threads."""
+        # replicas of the load test start the shared pool at once
+        with self.start_lock:
+            if not self.workers or self.executor is not None:
+                return
+            context = multiprocessing.get_context('spawn')
+            if self.listener is None:
+                self.log_queue = context.Queue()
+                self.listener = logging.handlers.QueueListener(self.log_queue, RelayHandler())
+                self.listener.start()
+            # a barrier can't be sent with a task, workers get it when they are spawned
+            barrier = context.Barrier(self.workers)
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=init_worker,
+                initargs=(self.log_queue, logging.getLogger().getEffectiveLevel(), barrier),
+            )
+            try:
+                for future in [executor.submit(confirm_warm_up, WARM_UP_TIMEOUT) for _ in range(self.workers)]:
+                    future.result()
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            self.executor = executor
+            logging.info("Started %d item parser workers", self.workers)
+
+    async def parse(self, html, item_id, url):
+        """Item data of the page as JSON text, or None, see parse_item_page."""
+        executor = self.executor
+        if executor is None:
+            return await asyncio.to_thread(parse_item_page, html, item_id, url)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, parse_item_page, html, item_id, url)
+        except BrokenProcessPool:
+            if self.executor is executor:
+                logging.error("Item parser workers died, starting new ones")
+                self.executor = None
+                executor.shutdown(wait=False)
+                await asyncio.to_thread(self.start)
+            return await asyncio.to_thread(parse_item_page, html, item_id, url)
+
+    def stop(self):
+        executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
@@ -1,55 +1,278 @@
-import sqlite3
+import logging
+from datetime import date, timedelta
+from marktplaats_gpt.db import connect, migrate, storage, utc_timestamp
+from marktplaats_gpt.openai_pricing import OPENAI_PRICES, openai_cost_micro_usd, usage_cost_micro_usd
 
 
 DB_FILE = 'sessions.db'
 
+
+def create_usage_ledger(conn):
+    """
+    Creates running totals of users' OpenAI usage and backfills them from user_sessions history.
+    Requests of models without a price are counted without their cost.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_usage (
+            username TEXT PRIMARY KEY,
+            requests INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            cost_micro_usd INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("DELETE FROM user_usage")
+    ledger = {}
+    unpriced = 0
+    cursor = conn.execute("SELECT username, model, prompt_tokens, completion_tokens FROM user_sessions WHERE model IS NOT NULL")
+    for username, model, prompt_tokens, completion_tokens in cursor:
+        requests, total_prompt_tokens, total_completion_tokens, cost_micro_usd = ledger.get(username, (0, 0, 0, 0))
+        if model in OPENAI_PRICES:
+            cost_micro_usd += openai_cost_micro_usd(model, prompt_tokens, completion_tokens)
+        else:
+            unpriced += 1
+        ledger[username] = (
+            requests + 1,
+            total_prompt_tokens + prompt_tokens,
+            total_completion_tokens + completion_tokens,
+            cost_micro_usd,
+        )
+    if unpriced:
+        logging.warning("Usage ledger doesn't count costs of %d requests of models without a price", unpriced)
+    conn.executemany(
+        "INSERT INTO user_usage (username, requests, prompt_tokens, completion_tokens, cost_micro_usd) VALUES (?,?,?,?,?)",
+        [(username, *totals) for username, totals in ledger.items()]
+    )
+
+
+MIGRATIONS = [
+    # 1: initial schema
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            model TEXT NULL,
+            prompt_tokens INTEGER NULL,
+            completion_tokens INTEGER NULL
+        )
+        ''',
+    ],
+    # 2: indexes for user's sessions (quota, /last {username}) and sessions of a period (/users, /last)
+    [
+        "CREATE INDEX IF NOT EXISTS user_sessions_username_created_time ON user_sessions (username, created_time)",
+        "CREATE INDEX IF NOT EXISTS user_sessions_created_time ON user_sessions (created_time)",
+    ],
+    # 3: usage ledger for quota checks
+    create_usage_ledger,
+    # 4: daily per-user/per-model rollups of compacted sessions, model is '' for session starts
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_sessions_daily (
+            day TEXT,
+            username TEXT,
+            model TEXT,
+            rows_count INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost_micro_usd INTEGER NOT NULL,
+            first_time TIMESTAMP,
+            last_time TIMESTAMP,
+            PRIMARY KEY (day, username, model)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS user_sessions_daily_username_day ON user_sessions_daily (username, day)",
+    ],
+    # 5: prices to sum costs in SQL, kept in sync with OPENAI_PRICES by init_db
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS openai_prices (
+            model TEXT PRIMARY KEY,
+            prompt_micro_usd_per_1k INTEGER NOT NULL,
+            completion_micro_usd_per_1k INTEGER NOT NULL
+        )
+        ''',
+    ],
+    # 6: compacted requests of models without a price, not in cost_micro_usd
+    [
+        "ALTER TABLE user_sessions_daily ADD COLUMN unpriced_count INTEGER NOT NULL DEFAULT 0",
+    ],
+]
+
+ADD_USAGE = """
+    INSERT INTO user_usage (username, requests, prompt_tokens, completion_tokens, cost_micro_usd) VALUES (?,?,?,?,?)
+    ON CONFLICT(username) DO UPDATE SET
+        requests = user_usage.requests + excluded.requests,
+        prompt_tokens = user_usage.prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = user_usage.completion_tokens + excluded.completion_tokens,
+        cost_micro_usd = user_usage.cost_micro_usd + excluded.cost_micro_usd
+"""
+
+ADD_DAILY = """
+    INSERT INTO user_sessions_daily (day, username, model, rows_count, prompt_tokens, completion_tokens, cost_micro_usd, unpriced_count, first_time, last_time)
+    VALUES (?,?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(day, username, model) DO UPDATE SET
+        rows_count = user_sessions_daily.rows_count + excluded.rows_count,
+        prompt_tokens = user_sessions_daily.prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = user_sessions_daily.completion_tokens + excluded.completion_tokens,
+        cost_micro_usd = user_sessions_daily.cost_micro_usd + excluded.cost_micro_usd,
+        unpriced_count = user_sessions_daily.unpriced_count + excluded.unpriced_count,
+        first_time = CASE WHEN excluded.first_time < user_sessions_daily.first_time THEN excluded.first_time ELSE user_sessions_daily.first_time END,
+        last_time = CASE WHEN excluded.last_time > user_sessions_daily.last_time THEN excluded.last_time ELSE user_sessions_daily.last_time END
+"""
+
+# Cost of a user_sessions row `s` joined with its price `p`, rounded to micro-dollars like openai_cost_micro_usd
+ROW_COST = "(p.prompt_micro_usd_per_1k * s.prompt_tokens + p.completion_micro_usd_per_1k * s.completion_tokens + 500) / 1000"
+
+# 1 for a request `s` of a model without price `p`, its cost is unknown (NULL) and is not in the sums
+ROW_UNPRICED = "CASE WHEN s.model IS NOT NULL AND p.model IS NULL THEN 1 ELSE 0 END"
+
+SESSIONS_PAGE = f"""
+    WITH numbered AS (
+        SELECT id, username, created_time, model, prompt_tokens, completion_tokens,
+            SUM(CASE WHEN model IS NULL THEN 1 ELSE 0 END) OVER (PARTITION BY username ORDER BY created_time, id) AS session_no
+        FROM user_sessions
+        WHERE {{where}}
+    ),
+    sessions AS (
+        SELECT s.username,
+            MIN(CASE WHEN s.model IS NULL THEN s.created_time END) AS start_time,
+            MAX(CASE WHEN s.model IS NOT NULL THEN s.created_time END) AS end_time,
+            1 AS sessions_count,
+            COUNT(s.model) AS requests_count,
+            COALESCE(SUM(s.prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(s.completion_tokens), 0) AS completion_tokens,
+            COALESCE(SUM({ROW_COST}), 0) AS cost_micro_usd,
+            SUM({ROW_UNPRICED}) AS unpriced_count,
+            0 AS compacted
+        FROM numbered s LEFT JOIN openai_prices p ON p.model = s.model
+        GROUP BY s.username, s.session_no
+    ),
+    daily AS (
+        SELECT username,
+            MIN(first_time) AS start_time,
+            MAX(CASE WHEN model <> '' THEN last_time END) AS end_time,
+            SUM(CASE WHEN model = '' THEN rows_count ELSE 0 END) AS sessions_count,
+            SUM(CASE WHEN model <> '' THEN rows_count ELSE 0 END) AS requests_count,
+            SUM(prompt_tokens) AS prompt_tokens,
+            SUM(completion_tokens) AS completion_tokens,
+            SUM(cost_micro_usd) AS cost_micro_usd,
+            SUM(unpriced_count) AS unpriced_count,
+            1 AS compacted
+        FROM user_sessions_daily
+        WHERE {{daily_where}}
+        GROUP BY day, username
+    )
+    SELECT username, start_time, end_time, sessions_count, requests_count, prompt_tokens, completion_tokens, cost_micro_usd, unpriced_count, compacted
+    FROM (SELECT * FROM sessions WHERE start_time IS NOT NULL UNION ALL SELECT * FROM daily) AS all_sessions
+    ORDER BY start_time DESC, username
+    LIMIT ? OFFSET ?
+"""
+
+USERS_PAGE = f"""
+    SELECT username, MAX(last_time) AS last_time, SUM(requests_count), SUM(cost_micro_usd), SUM(unpriced_count)
+    FROM (
+        SELECT s.username, s.created_time AS last_time,
+            CASE WHEN s.model IS NULL THEN 0 ELSE 1 END AS requests_count,
+            COALESCE({ROW_COST}, 0) AS cost_micro_usd,
+            {ROW_UNPRICED} AS unpriced_count
+        FROM user_sessions s LEFT JOIN openai_prices p ON p.model = s.model
+        WHERE s.created_time > ?
+        UNION ALL
+        SELECT username, last_time, CASE WHEN model = '' THEN 0 ELSE rows_count END, cost_micro_usd, unpriced_count
+        FROM user_sessions_daily
+        WHERE day >= ?
+    ) AS all_sessions
+    GROUP BY username
+    ORDER BY last_time DESC, username
+    LIMIT ? OFFSET ?
+"""
+
 class SessionDB:
     def init_db():
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_sessions (
-                    id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    model TEXT NULL,
-                    prompt_tokens INTEGER NULL,
-                    completion_tokens INTEGER NULL
-                )
-            ''')
-            conn.commit()
+        conn = connect(DB_FILE)
+        migrate(conn, MIGRATIONS)
+        with conn:
+            conn.executemany(
+                """
+                INSERT INTO openai_prices (model, prompt_micro_usd_per_1k, completion_micro_usd_per_1k) VALUES (?,?,?)
+                ON CONFLICT(model) DO UPDATE SET
+                    prompt_micro_usd_per_1k = excluded.prompt_micro_usd_per_1k,
+                    completion_micro_usd_per_1k = excluded.completion_micro_usd_per_1k
+                """,
+                [(model, *prices) for model, prices in OPENAI_PRICES.items()]
+            )
 
 
     def create(username: str):
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO user_sessions (username) VALUES (?)",
+        with connect(DB_FILE) as conn:
+            conn.execute(
+                "INSERT INTO user_sessions (username) VALUES (?)",
                 (username,)
             )
-            conn.commit()
-
-    
-    def use(username: str, model: str, prompt_tokens: int, completion_tokens: int):
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO user_sessions (username, model, prompt_tokens, completion_tokens) VALUES (?,?,?,?)",
+
+
+    def use(username: str, model: str, prompt_tokens: int, completion_tokens: int, requested_model: str = None):
+        cost_micro_usd = usage_cost_micro_usd(model, prompt_tokens, completion_tokens, requested_model)
+        with connect(DB_FILE) as conn:
+            conn.execute(
+                "INSERT INTO user_sessions (username, model, prompt_tokens, completion_tokens) VALUES (?,?,?,?)",
                 (username, model, prompt_tokens, completion_tokens)
             )
-            conn.commit()
+            conn.execute(ADD_USAGE, (username, 1, prompt_tokens, completion_tokens, cost_micro_usd))
+
+
+    def write_batch(events):
+        """
+        Writes session events in one transaction, every event is a tuple of
+        (username, created_time, model, prompt_tokens, completion_tokens, cost_micro_usd), with model, tokens and cost
+        being None for session starts.
+        """
+        usage = {}
+        for username, created_time, model, prompt_tokens, completion_tokens, cost_micro_usd in events:
+            if model:
+                requests, total_prompt_tokens, total_completion_tokens, total_cost_micro_usd = usage.get(username, (0, 0, 0, 0))
+                usage[username] = (
+                    requests + 1,
+                    total_prompt_tokens + prompt_tokens,
+                    total_completion_tokens + completion_tokens,
+                    total_cost_micro_usd + cost_micro_usd,
+                )
+        with connect(DB_FILE) as conn:
+            conn.executemany(
+                "INSERT INTO user_sessions (username, created_time, model, prompt_tokens, completion_tokens) VALUES (?,?,?,?,?)",
+                [event[:5] for event in events]
+            )
+            conn.executemany(ADD_USAGE, [(username, *totals) for username, totals in usage.items()])
+
+
+    def get_usage(username: str):
+        """Returns user's OpenAI usage totals, cost is in micro-dollars."""
+        with connect(DB_FILE) as conn:
+            cursor = conn.execute(
+                "SELECT requests, prompt_tokens, completion_tokens, cost_micro_usd FROM user_usage WHERE username=?",
+                (username,)
+            )
+            selection = cursor.fetchone() or (0, 0, 0, 0)
+            requests, prompt_tokens, completion_tokens, cost_micro_usd = selection
+            return {
+                'requests': requests,
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'cost_micro_usd': cost_micro_usd
+            }
 
 
     def get_all_for_user(username: str):
         sessions = {}
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        with connect(DB_FILE) as conn:
+            cursor = conn.execute(
                 "SELECT id, created_time, username, model, prompt_tokens, completion_tokens FROM user_sessions WHERE username=?",
                 (username,)
             )
             rows = cursor.fetchall()
-        
+
             for row in rows:
                 id, created_time, row_username, model, prompt_tokens, completion_tokens = row
                 sessions[id] = {
@@ -65,14 +288,13 @@ class SessionDB:
 
     def get_all(from_seconds: int = 3600*24):
         sessions = {}
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, created_time, username, model, prompt_tokens, completion_tokens FROM user_sessions WHERE created_time > DATETIME(CURRENT_TIMESTAMP, '-' || ? || ' seconds')",
-                (from_seconds, )
+        with connect(DB_FILE) as conn:
+            cursor = conn.execute(
+                "SELECT id, created_time, username, model, prompt_tokens, completion_tokens FROM user_sessions WHERE created_time > ?",
+                (utc_timestamp(from_seconds),)
             )
             rows = cursor.fetchall()
-        
+
             for row in rows:
                 id, created_time, row_username, model, prompt_tokens, completion_tokens = row
                 sessions[id] = {
@@ -85,3 +307,185 @@ class SessionDB:
                 }
 
         return sessions
+
+    def get_daily(username: str = None, from_seconds: int = None):
+        """Returns daily rollups of compacted sessions, of one user or all and of days in last `from_seconds` or all."""
+        daily = []
+        conditions, params = [], []
+        if username:
+            conditions.append("username=?")
+            params.append(username)
+        if from_seconds:
+            conditions.append("day >= ?")
+            params.append(utc_timestamp(from_seconds)[:10])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with connect(DB_FILE) as conn:
+            cursor = conn.execute(
+                f"SELECT day, username, model, rows_count, prompt_tokens, completion_tokens, cost_micro_usd, unpriced_count, first_time, last_time FROM user_sessions_daily{where}",
+                params
+            )
+            for row in cursor.fetchall():
+                day, row_username, model, rows_count, prompt_tokens, completion_tokens, cost_micro_usd, unpriced_count, first_time, last_time = row
+                daily.append({
+                    'day': day,
+                    'username': row_username,
+                    'model': model or None,
+                    'rows_count': rows_count,
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'cost_micro_usd': cost_micro_usd,
+                    'unpriced_count': unpriced_count,
+                    'first_time': first_time,
+                    'last_time': last_time
+                })
+
+        return daily
+
+    def compact(older_than_days: int, vacuum_pages: int = 1000, full_vacuum: bool = False):
+        """
+        Rolls sessions of the days before last `older_than_days` into daily per-user/per-model rollups and
+        deletes them, a day per transaction. Usage ledger is not touched, so quota totals stay the same.
+        Requests of models without a price are counted in the rollup's `unpriced_count`, not in its cost.
+        A session running at the cutoff is kept whole, from its start, so that it isn't split into a compacted
+        part and requests without a session start.
+
+        Freed pages are given back to the file system by `vacuum_pages` after every day (SQLite's incremental vacuum).
+        That needs a one-time switch of the database by a full VACUUM, blocking other writers, which runs only with
+        `full_vacuum` (the CLI), until then freed pages are only reused.
+        Returns numbers of days that had rows compacted and of compacted rows.
+        """
+        conn = connect(DB_FILE)
+        reclaim = storage().prepare_compaction(conn, full_vacuum)
+
+        cutoff_day = (date.fromisoformat(utc_timestamp()[:10]) - timedelta(days=older_than_days)).isoformat()
+        kept_from = SessionDB.running_sessions_starts(conn, cutoff_day)
+        days = [day for day, in conn.execute(
+            "SELECT DISTINCT substr(created_time, 1, 10) FROM user_sessions WHERE created_time < ? ORDER BY 1",
+            (cutoff_day,)
+        )]
+        compacted_days, compacted_rows = 0, 0
+        for day in days:
+            next_day = (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+            where, params = "created_time >= ? AND created_time < ?", [day, next_day]
+            for username, start_time in kept_from.items():
+                if start_time < next_day:
+                    where += " AND NOT (username = ? AND created_time >= ?)"
+                    params += [username, start_time]
+            with conn:
+                rollups = {}
+                cursor = conn.execute(
+                    f"SELECT username, created_time, model, prompt_tokens, completion_tokens FROM user_sessions WHERE {where}",
+                    params
+                )
+                for username, created_time, model, prompt_tokens, completion_tokens in cursor.fetchall():
+                    key = (username, model or '')
+                    rows_count, total_prompt_tokens, total_completion_tokens, cost_micro_usd, unpriced_count, first_time, last_time = rollups.get(key, (0, 0, 0, 0, 0, created_time, created_time))
+                    priced = model in OPENAI_PRICES
+                    rollups[key] = (
+                        rows_count + 1,
+                        total_prompt_tokens + (prompt_tokens or 0),
+                        total_completion_tokens + (completion_tokens or 0),
+                        cost_micro_usd + (openai_cost_micro_usd(model, prompt_tokens, completion_tokens) if priced else 0),
+                        unpriced_count + (1 if model and not priced else 0),
+                        min(first_time, created_time),
+                        max(last_time, created_time),
+                    )
+                    compacted_rows += 1
+                if not rollups:
+                    continue # all rows of the day are in kept sessions
+                conn.executemany(ADD_DAILY, [(day, *key, *totals) for key, totals in rollups.items()])
+                conn.execute(f"DELETE FROM user_sessions WHERE {where}", params)
+            compacted_days += 1
+            if reclaim:
+                storage().reclaim_space(conn, vacuum_pages)
+            logging.info("Compacted %s sessions of %s", DB_FILE, day)
+
+        return {'days': compacted_days, 'rows': compacted_rows}
+
+    def running_sessions_starts(conn, cutoff_time: str):
+        """Returns {username: start time} of users' sessions started before `cutoff_time` and having requests after it."""
+        starts = {}
+        cursor = conn.execute(
+            """
+            SELECT username FROM (
+                SELECT username, model, ROW_NUMBER() OVER (PARTITION BY username ORDER BY created_time, id) AS row_no
+                FROM user_sessions
+                WHERE created_time >= ?
+            ) AS after_cutoff
+            WHERE row_no = 1 AND model IS NOT NULL
+            """,
+            (cutoff_time,)
+        )
+        for username, in cursor.fetchall():
+            start_time, = conn.execute(
+                "SELECT MAX(created_time) FROM user_sessions WHERE username = ? AND model IS NULL AND created_time < ?",
+                (username, cutoff_time)
+            ).fetchone()
+            if start_time:
+                starts[username] = start_time
+        return starts
+
+    def get_sessions_page(username: str = None, from_seconds: int = None, limit: int = 20, offset: int = 0):
+        """
+        Returns a page of sessions, newest first, of one user or all and started in last `from_seconds` or ever.
+
+        A session is a start with the requests that followed it, compacted days are returned as one
+        session-like entry per day and user, with `compacted` set. Costs are in micro-dollars, requests of models
+        without a price in `openai_prices` are counted in `unpriced_count` and not in the cost.
+        """
+        conditions, daily_conditions, params, daily_params = [], [], [], []
+        if username:
+            conditions.append("username = ?")
+            daily_conditions.append("username = ?")
+            params.append(username)
+            daily_params.append(username)
+        if from_seconds:
+            from_time = utc_timestamp(from_seconds)
+            conditions.append("created_time > ?")
+            daily_conditions.append("day >= ?")
+            params.append(from_time)
+            daily_params.append(from_time[:10])
+        sql = SESSIONS_PAGE.format(
+            where=" AND ".join(conditions) or "1 = 1",
+            daily_where=" AND ".join(daily_conditions) or "1 = 1"
+        )
+        sessions = []
+        with connect(DB_FILE) as conn:
+            cursor = conn.execute(sql, params + daily_params + [limit, offset])
+            for row in cursor.fetchall():
+                row_username, start_time, end_time, sessions_count, requests_count, prompt_tokens, completion_tokens, cost_micro_usd, unpriced_count, compacted = row
+                sessions.append({
+                    'username': row_username,
+                    'start_time': start_time,
+                    'end_time': end_time,
+                    'sessions_count': int(sessions_count),
+                    'requests_count': int(requests_count),
+                    'prompt_tokens': int(prompt_tokens),
+                    'completion_tokens': int(completion_tokens),
+                    'cost_micro_usd': int(cost_micro_usd),
+                    'unpriced_count': int(unpriced_count),
+                    'compacted': bool(compacted)
+                })
+
+        return sessions
+
+    def get_users_page(from_seconds: int = 3600*24, limit: int = 20, offset: int = 0):
+        """
+        Returns a page of users active in last `from_seconds`, most recently active first, with their requests and
+        costs (micro-dollars) in that period. Requests of models without a price are counted in `unpriced_count`.
+        """
+        from_time = utc_timestamp(from_seconds)
+        users = []
+        with connect(DB_FILE) as conn:
+            cursor = conn.execute(USERS_PAGE, (from_time, from_time[:10], limit, offset))
+            for row in cursor.fetchall():
+                row_username, last_time, requests_count, cost_micro_usd, unpriced_count = row
+                users.append({
+                    'username': row_username,
+                    'last_time': last_time,
+                    'requests_count': int(requests_count),
+                    'cost_micro_usd': int(cost_micro_usd),
+                    'unpriced_count': int(unpriced_count)
+                })
+
+        return users
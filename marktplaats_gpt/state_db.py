@@ -0,0 +1,199 @@
+import json
+import logging
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+from marktplaats_gpt.db import connect, migrate
+from marktplaats_gpt.async_db import run
+
+
+DB_FILE = 'bot_state.db'
+
+MIGRATIONS = [
+    # 1: users' session state (context.user_data) and conversation handlers' states, as JSON
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            modified_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            data TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            name TEXT,
+            conversation_key TEXT,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, conversation_key)
+        )
+        ''',
+    ],
+]
+
+class StateDB:
+    def init_db():
+        migrate(connect(DB_FILE), MIGRATIONS)
+
+
+    def get_user_data(user_id: int):
+        with connect(DB_FILE) as conn:
+            selection = conn.execute("SELECT data FROM user_state WHERE user_id=?", (user_id,)).fetchone()
+            if selection:
+                data, = selection
+                return json.loads(data)
+            else:
+                return None
+
+
+    def set_user_data(user_id: int, data: dict):
+        with connect(DB_FILE) as conn:
+            conn.execute(
+                """
+                INSERT INTO user_state (user_id, data) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, modified_time = excluded.modified_time
+                """,
+                (user_id, json.dumps(data, default=str))
+            )
+
+
+    def delete_user_data(user_id: int):
+        with connect(DB_FILE) as conn:
+            conn.execute("DELETE FROM user_state WHERE user_id=?", (user_id,))
+
+
+    def get_conversations(name: str):
+        """Returns states of conversations of handler `name`, by their keys (tuples of chat and user ids)."""
+        with connect(DB_FILE) as conn:
+            cursor = conn.execute("SELECT conversation_key, state FROM conversation_states WHERE name=?", (name,))
+            return {tuple(json.loads(key)): json.loads(state) for key, state in cursor.fetchall()}
+
+
+    def get_conversation(name: str, key: tuple):
+        with connect(DB_FILE) as conn:
+            selection = conn.execute(
+                "SELECT state FROM conversation_states WHERE name=? AND conversation_key=?",
+                (name, json.dumps(key))
+            ).fetchone()
+            if selection:
+                state, = selection
+                return json.loads(state)
+            else:
+                return None
+
+
+    def set_conversation(name: str, key: tuple, state):
+        with connect(DB_FILE) as conn:
+            if state is None:
+                conn.execute("DELETE FROM conversation_states WHERE name=? AND conversation_key=?", (name, json.dumps(key)))
+            else:
+                conn.execute(
+                    """
+                    INSERT INTO conversation_states (name, conversation_key, state) VALUES (?, ?, ?)
+                    ON CONFLICT(name, conversation_key) DO UPDATE SET state = excluded.state
+                    """,
+                    (name, json.dumps(key), json.dumps(state))
+                )
+
+
+class SharedStatePersistence(BasePersistence):
+    """
+    Keeps users' `context.user_data` and conversation states in the configured storage (see STORAGE_URL),
+    so that bot replicas sharing a database can continue each other's conversations.
+
+    User data is read before every handler call (`refresh_user_data`), conversation states by `refresh_conversations`,
+    which should run before other handlers, and both are written after every update by `save_state`.
+    User data not changed since it was read is not written, so that a replica never overwrites newer data
+    of another one with its stale copy. Chat, bot and callback data are not used by the bot and not stored.
+    """
+    def __init__(self, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.synced_user_data = {} # user id: JSON of user data as last read or written
+
+    async def get_user_data(self):
+        return {} # loaded per user by refresh_user_data
+
+    async def refresh_user_data(self, user_id, user_data):
+        data = await run(StateDB.get_user_data, user_id)
+        user_data.clear()
+        if data:
+            user_data.update(data)
+        self.synced_user_data[user_id] = json.dumps(user_data, default=str)
+
+    async def update_user_data(self, user_id, data):
+        encoded = json.dumps(data, default=str)
+        if self.synced_user_data.get(user_id) == encoded:
+            return
+        await run(StateDB.set_user_data, user_id, data)
+        self.synced_user_data[user_id] = encoded
+
+    async def drop_user_data(self, user_id):
+        await run(StateDB.delete_user_data, user_id)
+        self.synced_user_data.pop(user_id, None)
+
+    async def get_conversations(self, name):
+        return await run(StateDB.get_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        await run(StateDB.set_conversation, name, key, new_state)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+
+async def refresh_conversations(update, context):
+    """
+    Reads states of the update's conversations from the storage, as another replica could have moved them.
+
+    ConversationHandler reads persisted states only on start, so they are put into its (private) state dict here.
+    """
+    for handler in context.application.handlers.get(0, []):
+        if not (isinstance(handler, ConversationHandler) and handler.persistent):
+            continue
+        try:
+            key = handler._get_key(update)
+        except RuntimeError:
+            continue # not a chat or user update
+        state = await run(StateDB.get_conversation, handler.name, key)
+        if state is None:
+            handler._conversations.data.pop(key, None)
+        else:
+            handler._conversations.update_no_track({key: state})
+
+
+async def save_state(update, context):
+    """Writes user data and conversation states changed by the update, for other replicas to see them."""
+    try:
+        if update.effective_user:
+            # the application marks them only after all handler groups, i.e. after this one
+            context.application.mark_data_for_update_persistence(user_ids=update.effective_user.id)
+        await context.application.update_persistence()
+    except Exception as e:
+        logging.error("Failed to save bot state: %s", e)
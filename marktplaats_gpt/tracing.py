@@ -0,0 +1,242 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+_current = contextvars.ContextVar('span', default=None)
+
+
+class Trace:
+    __slots__ = ('trace_id', 'sampled', 'spans')
+
+    def __init__(self, sampled: bool):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.sampled = sampled
+        self.spans = []
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, trace: Trace, name: str, parent_id, attributes):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def record(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(span: Span):
+    otlp = {
+        'traceId': span.trace.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': 1, # internal
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in span.attributes.items()],
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+    }
+    if span.parent_id:
+        otlp['parentSpanId'] = span.parent_id
+    return otlp
+
+
+class SpanExporter:
+    """
+    Writes spans of finished traces on a background thread: as JSON lines appended to `file` and/or to an OTLP/HTTP
+    collector at `otlp_endpoint` (like http://localhost:4318/v1/traces), in batches of up to `max_batch` traces.
+    Traces still queued are written at interpreter exit.
+    """
+    def __init__(self, file=None, otlp_endpoint=None, service_name='marktplaats-gpt', max_batch=100):
+        self.file = file
+        self.otlp_endpoint = otlp_endpoint
+        self.service_name = service_name
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Exporter configured by TRACE_FILE and OTEL_EXPORTER_OTLP_(TRACES_)ENDPOINT env vars, None if neither is set."""
+        otlp_endpoint = os.environ.get("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+        if not otlp_endpoint and os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+            otlp_endpoint = os.environ["OTEL_EXPORTER_OTLP_ENDPOINT"].rstrip('/') + '/v1/traces'
+        file = os.environ.get("TRACE_FILE")
+        if not file and not otlp_endpoint:
+            return None
+        return cls(file=file, otlp_endpoint=otlp_endpoint, service_name=os.environ.get("OTEL_SERVICE_NAME", 'marktplaats-gpt'))
+
+    def export(self, spans):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='trace-exporter', daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+        self.queue.put(spans)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get())
+            stop = None in batch
+            spans = [span for trace_spans in batch if trace_spans for span in trace_spans]
+            try:
+                self.write(spans)
+            except Exception as e:
+                logging.error("Failed to export %d spans: %s", len(spans), e)
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def write(self, spans):
+        if not spans:
+            return
+        if self.file:
+            with open(self.file, 'a') as file:
+                file.writelines(json.dumps(span.record()) + "\n" for span in spans)
+        if self.otlp_endpoint:
+            import requests
+            body = {'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+                'scopeSpans': [{'scope': {'name': 'marktplaats_gpt'}, 'spans': [otlp_span(span) for span in spans]}],
+            }]}
+            requests.post(self.otlp_endpoint, json=body, timeout=10).raise_for_status()
+
+    def stop(self):
+        """Exports queued traces and stops the thread."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=10)
+
+
+# Share of traces exported, traces slower than TRACE_SLOW_SECONDS are exported anyway, and the exporter,
+# set by `configure` on first use
+TRACE_SAMPLE_RATE = 0.1
+TRACE_SLOW_SECONDS = 10.0
+exporter = None
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def configure():
+    """Reads TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS and the exporter's env vars, once."""
+    global TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS, exporter, _configured
+    with _configure_lock:
+        if _configured:
+            return
+        TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.1"))
+        TRACE_SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", "10"))
+        exporter = SpanExporter.from_env()
+        _configured = True
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Span of work within the current trace, or the root span of a new trace if there is none. Context is copied to
+    database threads and `asyncio.to_thread`, so spans there are children of the awaiting one.
+
+    Without an exporter only root spans are created, to have trace ids in log lines.
+    """
+    if not _configured:
+        configure()
+    parent = _current.get()
+    if parent is None:
+        trace = Trace(sampled=random.random() < TRACE_SAMPLE_RATE)
+    elif exporter is None:
+        yield parent
+        return
+    else:
+        trace = parent.trace
+    current = Span(trace, name, parent.span_id if parent else None, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current.reset(token)
+        if exporter is not None:
+            trace.spans.append(current)
+            if parent is None and (trace.sampled or current.end_ns - current.start_ns >= TRACE_SLOW_SECONDS * 1e9):
+                exporter.export(trace.spans)
+
+
+@contextmanager
+def child_span(name: str, **attributes):
+    """Span within the current trace, nothing outside of traces or without an exporter."""
+    if _current.get() is None or exporter is None:
+        yield None
+    else:
+        with span(name, **attributes) as current:
+            yield current
+
+
+def traced_handler(callback):
+    """Wraps a bot handler callback to run in a root span of the update."""
+    name = callback.__name__
+
+    async def traced(update, context):
+        user = update.effective_user
+        with span(f"handler {name}", update_id=update.update_id, user=user.username if user else ''):
+            return await callback(update, context)
+
+    traced.__name__ = name
+    return traced
+
+
+def trace_id():
+    current = _current.get()
+    return current.trace.trace_id if current else '-'
+
+
+_record_factory = logging.getLogRecordFactory()
+
+
+def record_with_trace_id(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.trace_id = trace_id()
+    return record
+
+
+# every log record gets `trace_id` of the current trace, for `%(trace_id)s` in log formats
+logging.setLogRecordFactory(record_with_trace_id)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from marktplaats_gpt.batch import print_result, suggest
+
+
+class Watcher:
+    """
+    Polls the newest `page_size` conversations and suggests replies to new messages from peers.
+
+    A conversation is looked into only when its listing entry changed since the previous poll and it has unread
+    messages, changes are detected by fingerprints of the entries kept in `state_file` (JSON), together with
+    the date of the last peer message handled, so that restarts don't suggest twice. The first poll without a state
+    file only records the fingerprints.
+
+    Polling interval starts at `min_interval` seconds and grows by half after every poll without changes,
+    up to `max_interval`, it is back to `min_interval` after a change. Failed polls double it.
+
+    A conversation that fails to be handled is logged and tried again by the next polls, up to `max_failures` times,
+    then it's left until its entry changes again. Other conversations are handled meanwhile.
+
+    Suggestions are only printed with `dry_run`, sent with `good_luck`, or sent when `approve(prompt)` returns True.
+    """
+    def __init__(self, client, context, openai_model, state_file='watch-state.json', page_size=50,
+                 min_interval=30.0, max_interval=600.0, dry_run=False, good_luck=False, approve=None, max_failures=3):
+        self.client = client
+        self.context = context
+        self.openai_model = openai_model
+        self.state_file = state_file
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.dry_run = dry_run
+        self.good_luck = good_luck
+        self.approve = approve
+        self.max_failures = max_failures
+        self.interval = min_interval
+        self.state = self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return None
+        with open(self.state_file, 'r') as file:
+            return json.load(file)
+
+    def save_state(self):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump(self.state, file, indent=1)
+        os.replace(tmp_file, self.state_file)
+
+    def fingerprint(self, conv):
+        return hashlib.sha1(json.dumps(conv, sort_keys=True).encode()).hexdigest()
+
+    def poll(self):
+        """Lists conversations once and handles the changed ones, returns their number."""
+        convs = self.client.get_conversations(params={
+            'offset': '0',
+            'limit': str(self.page_size),
+        })['_embedded']['mc:conversations']
+
+        if self.state is None:
+            self.state = {conv['id']: {'fingerprint': self.fingerprint(conv)} for conv in convs}
+            self.save_state()
+            logging.info("Watching %d conversations from now on", len(convs))
+            print(f"Watching {len(convs)} conversations, suggestions will be given for new messages")
+            return 0
+
+        changed = 0
+        for conv in convs:
+            entry = self.state.setdefault(conv['id'], {})
+            fingerprint = self.fingerprint(conv)
+            if entry.get('fingerprint') == fingerprint:
+                continue
+            changed += 1
+            if conv['unreadMessagesCount']:
+                try:
+                    self.handle(conv, entry)
+                except Exception as e:
+                    entry['failures'] = entry.get('failures', 0) + 1
+                    logging.exception("Handling conversation %s failed (%d times)", conv['id'], entry['failures'])
+                    print(f"Handling conversation {conv['id']} failed: {e}")
+                    if entry['failures'] < self.max_failures:
+                        self.save_state()
+                        continue # fingerprint is kept, next poll tries again
+                    logging.error("Leaving conversation %s until it changes again", conv['id'])
+            entry.pop('failures', None)
+            entry['fingerprint'] = fingerprint
+            self.save_state()
+        return changed
+
+    def handle(self, conv, entry):
+        logging.info("Conversation %s changed, looking for new peer messages", conv['id'])
+        result = suggest(conv, self.context, self.openai_model, client=self.client, since=entry.get('last_peer_message'))
+        entry['last_peer_message'] = max(entry.get('last_peer_message', ''), result['last_message']['receivedDate'])
+        if 'skipped' in result:
+            logging.info("Conversation %s skipped: %s", conv['id'], result['skipped'])
+            return
+        print_result(result)
+        if self.dry_run:
+            print("Not replying in conversation (dry-run mode)")
+        elif self.good_luck or (self.approve and self.approve('Reply in conversation? [y/n] ')):
+            print(f"Replying in conversation {conv['id']}")
+            message_data = self.client.add_message(conv['id'], text=result['suggestion'])
+            logging.debug("New message: %s", message_data)
+        else:
+            print(f"Not replying in conversation {conv['id']}")
+            logging.info("Not replying in conversation %s", conv['id'])
+
+    def run(self, max_polls=None):
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            try:
+                if self.poll():
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * 1.5, self.max_interval)
+            except Exception as e:
+                logging.exception("Polling conversations failed")
+                print(f"Polling conversations failed: {e}")
+                self.interval = min(self.interval * 2, self.max_interval)
+            if max_polls is None or polls < max_polls:
+                logging.debug("Next poll in %.1fs", self.interval)
+                time.sleep(self.interval)
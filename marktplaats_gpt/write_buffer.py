@@ -0,0 +1,148 @@
+import atexit
+import logging
+import os
+import threading
+from marktplaats_gpt import metrics
+from marktplaats_gpt.db import utc_timestamp
+from marktplaats_gpt.openai_pricing import usage_cost_micro_usd
+from marktplaats_gpt.sessions_db import SessionDB
+
+
+class SessionWriteBuffer:
+    """
+    Collects session starts and OpenAI usage events in memory and writes them with `SessionDB.write_batch`,
+    one transaction every `flush_interval_ms` or as soon as `max_rows` events are pending.
+
+    Costs of pending events are kept per user until their batch is committed, `cost_micro_usd` adds them to
+    the stored usage for quota checks.
+
+    A batch that fails to be written is retried by the next flushes, apart from the newer events, and after
+    `max_attempts` attempts its events are logged and dropped. Costs of dropped events stay counted in quota checks.
+
+    The flushing thread is started with the first event, remaining events are flushed at interpreter exit or by `stop`.
+    """
+    def __init__(self, flush_interval_ms=500, max_rows=100, max_attempts=10):
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_rows = max_rows
+        self.max_attempts = max_attempts
+        self.condition = threading.Condition()
+        self.pending = []
+        self.pending_costs = {}
+        self.failed = [] # (events, attempts) of batches that failed to be written
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            flush_interval_ms=int(os.environ.get("SESSIONS_FLUSH_INTERVAL_MS", "500")),
+            max_rows=int(os.environ.get("SESSIONS_FLUSH_MAX_ROWS", "100")),
+            max_attempts=int(os.environ.get("SESSIONS_FLUSH_MAX_ATTEMPTS", "10")),
+        )
+
+    def create(self, username: str):
+        self.add((username, utc_timestamp(), None, None, None, None))
+
+    def use(self, username: str, model: str, prompt_tokens: int, completion_tokens: int, requested_model: str = None):
+        """Records a completion of `model`, the one OpenAI returned, see usage_cost_micro_usd."""
+        cost_micro_usd = usage_cost_micro_usd(model, prompt_tokens, completion_tokens, requested_model)
+        self.add((username, utc_timestamp(), model, prompt_tokens, completion_tokens, cost_micro_usd))
+
+    def add(self, event):
+        with self.condition:
+            if self.thread is None:
+                self.start()
+            username, _, _, _, _, cost_micro_usd = event
+            if cost_micro_usd:
+                self.pending_costs[username] = self.pending_costs.get(username, 0) + cost_micro_usd
+            self.pending.append(event)
+            if len(self.pending) >= self.max_rows:
+                self.condition.notify()
+
+    def pending_cost_micro_usd(self, username: str):
+        with self.condition:
+            return self.pending_costs.get(username, 0)
+
+    def cost_micro_usd(self, username: str):
+        """
+        User's OpenAI usage cost, stored and not yet written, in micro-dollars. Blocking, reads the database.
+
+        Pending costs are read first: a batch committed between the two reads is then counted twice, which errs
+        on the safe side, and never missed.
+        """
+        pending_cost_micro_usd = self.pending_cost_micro_usd(username)
+        return SessionDB.get_usage(username)['cost_micro_usd'] + pending_cost_micro_usd
+
+    def flush(self):
+        """Writes all pending events in one transaction and retries batches that failed before, each in its own."""
+        with self.flush_lock:
+            with self.condition:
+                events, self.pending = self.pending, []
+            batches, self.failed = self.failed, []
+            if events:
+                batches.append((events, 0))
+            for events, attempts in batches:
+                self.write(events, attempts)
+
+    def write(self, events, attempts):
+        try:
+            metrics.timed_call('SessionDB.write_batch', SessionDB.write_batch, events)
+        except Exception as e:
+            attempts += 1
+            if attempts < self.max_attempts:
+                logging.error("Failed to write %d session events (attempt %d), will retry: %s", len(events), attempts, e)
+                self.failed.append((events, attempts))
+                return
+            logging.error("Failed to write %d session events %d times, dropping them: %s", len(events), attempts, e)
+            for event in events:
+                logging.error("Dropped session event %s", event)
+            return
+        with self.condition:
+            for username, _, _, _, _, cost_micro_usd in events:
+                if cost_micro_usd:
+                    self.pending_costs[username] -= cost_micro_usd
+                    if self.pending_costs[username] == 0:
+                        del self.pending_costs[username]
+        logging.debug("Written %d session events", len(events))
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or len(self.pending) >= self.max_rows, timeout=self.flush_interval)
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                return
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='session-writes', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops the flushing thread, writing all pending events."""
+        with self.condition:
+            thread, self.thread = self.thread, None
+            self.stopped = True
+            self.condition.notify()
+        if thread:
+            thread.join()
+            atexit.unregister(self.stop)
+        self.flush()
+        for events, _ in self.failed:
+            for event in events:
+                logging.error("Dropped session event %s", event)
+        self.failed = []
+
+
+_session_writes = None
+
+
+def session_writes():
+    """Buffer of the process, configured by SESSIONS_FLUSH_* env vars on first use."""
+    global _session_writes
+    if _session_writes is None:
+        _session_writes = SessionWriteBuffer.from_env()
+    return _session_writes
@@ -0,0 +1,45 @@
+import os
+import uuid
+import pytest
+from marktplaats_gpt import async_db, db
+
+
+def using(storage):
+    db.use_storage(storage)
+    yield storage
+    db.use_storage(None)
+    # the database thread of async_db keeps its own connections
+    async_db.executor().submit(db.close_all).result()
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    """Databases of the test in SQLite files of a temporary directory."""
+    yield from using(db.SQLiteStorage(str(tmp_path)))
+
+
+@pytest.fixture
+def postgres_storage():
+    """
+    Databases of the test in a new schema of the Postgres server at STORAGE_URL, dropped after the test.
+    Skips the test when STORAGE_URL is not a Postgres one.
+    """
+    url = os.environ.get("STORAGE_URL", "")
+    if not url.startswith(('postgresql://', 'postgres://')):
+        pytest.skip("STORAGE_URL of a Postgres server is not set")
+    psycopg = pytest.importorskip("psycopg")
+    schema = f"marktplaats_gpt_test_{uuid.uuid4().hex[:12]}"
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute(f"CREATE SCHEMA {schema}")
+    try:
+        separator = '&' if '?' in url else '?'
+        yield from using(db.PostgresStorage(f"{url}{separator}options=-csearch_path%3D{schema}"))
+    finally:
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def storage(request):
+    """Runs the test on both storages, see sqlite_storage and postgres_storage."""
+    return request.getfixturevalue(f"{request.param}_storage")
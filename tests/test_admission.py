@@ -0,0 +1,182 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+from telegram import Chat, Message, Update
+from marktplaats_gpt.admission import SUGGESTION, Admission, ChatSequentialUpdateProcessor, FairQueue, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('marktplaats_gpt.admission.time.monotonic', clock)
+    return clock
+
+
+class Replies:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def update(username):
+    return SimpleNamespace(effective_user=SimpleNamespace(username=username), message=Replies())
+
+
+def test_token_bucket_allows_burst_then_rate(clock):
+    bucket = TokenBucket(rate=0.5, burst=2)
+    assert bucket.take() == 0 and bucket.take() == 0
+    assert bucket.take() == pytest.approx(2.0)
+    clock.now += 1
+    assert bucket.take() == pytest.approx(1.0)
+    clock.now += 1
+    assert bucket.take() == 0
+
+
+def test_token_bucket_does_not_save_above_burst(clock):
+    bucket = TokenBucket(rate=1, burst=2)
+    clock.now += 3600
+    assert [bucket.take() for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+
+
+def test_fair_queue_serves_users_in_turn():
+    async def run():
+        queue = FairQueue(concurrency=1)
+        running, position = queue.enqueue('other')
+        assert running.done() and position == 0
+        waiting = [('alice', *queue.enqueue('alice')) for _ in range(3)] + [('bob', *queue.enqueue('bob'))]
+        assert [position for _, _, position in waiting] == [1, 2, 3, 2]
+        served = []
+        while waiting:
+            queue.release()
+            done = next(entry for entry in waiting if entry[1].done())
+            waiting.remove(done)
+            served.append(done[0])
+        return served
+    assert asyncio.run(run()) == ['alice', 'bob', 'alice', 'alice']
+
+
+def test_fair_queue_weight_serves_user_more_often():
+    async def run():
+        queue = FairQueue(concurrency=1)
+        queue.enqueue('other')
+        waiting = [('alice', queue.enqueue('alice', 2.0)[0]) for _ in range(4)]
+        waiting += [('bob', queue.enqueue('bob')[0]) for _ in range(2)]
+        served = []
+        while waiting:
+            queue.release()
+            done = next(entry for entry in waiting if entry[1].done())
+            waiting.remove(done)
+            served.append(done[0])
+        return served
+    # alice's requests are half as far apart in virtual time as bob's
+    assert asyncio.run(run()) == ['alice', 'bob', 'alice', 'alice', 'bob', 'alice']
+
+
+def test_fair_queue_skips_cancelled_and_resets_when_idle():
+    async def run():
+        queue = FairQueue(concurrency=1)
+        queue.enqueue('other')
+        cancelled, _ = queue.enqueue('alice')
+        waiting, _ = queue.enqueue('bob')
+        cancelled.cancel()
+        queue.release()
+        assert waiting.done() and queue.running == 1
+        queue.release()
+        assert queue.running == 0 and not queue.finish_tags and queue.virtual_time == 0
+    asyncio.run(run())
+
+
+def test_admission_refuses_above_the_rate_with_a_reply(clock):
+    admission = Admission(limits={SUGGESTION: (60, 1)}, concurrency=0)
+    alice = update('alice')
+    assert asyncio.run(admission.allow(alice, SUGGESTION))
+    assert not asyncio.run(admission.allow(alice, SUGGESTION))
+    assert alice.message.replies == ["<i>Too many ChatGPT suggestions, please try again in 1 seconds.</i>"]
+    assert asyncio.run(admission.allow(update('bob'), SUGGESTION))
+
+
+def test_admission_without_limit_allows_everything():
+    admission = Admission(limits={SUGGESTION: (0, 0)}, concurrency=0)
+    assert all(asyncio.run(admission.allow(update('alice'), SUGGESTION)) for _ in range(100))
+
+
+def test_admission_slot_tells_queued_users_their_place():
+    async def run():
+        admission = Admission(concurrency=1)
+        alice, bob = update('alice'), update('bob')
+        entered = asyncio.Event()
+        release = asyncio.Event()
+
+        async def use(update, event=None):
+            async with admission.slot(update, SUGGESTION):
+                if event:
+                    entered.set()
+                    await release.wait()
+
+        first = asyncio.create_task(use(alice, entered))
+        await entered.wait()
+        second = asyncio.create_task(use(bob))
+        await asyncio.sleep(0)
+        assert bob.message.replies == ["<i>You're queued (#1), requests of all users are served in turn.</i>"]
+        release.set()
+        await asyncio.gather(first, second)
+        assert alice.message.replies == [] and admission.queue.running == 0
+    asyncio.run(run())
+
+
+def test_admission_slot_left_by_cancelled_request():
+    async def run():
+        admission = Admission(concurrency=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with admission.slot(update('alice'), SUGGESTION):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        release.set()
+        await holder
+        assert admission.queue.running == 0
+    asyncio.run(run())
+
+
+def test_updates_of_one_chat_run_in_order_and_chats_concurrently():
+    async def run():
+        processor = ChatSequentialUpdateProcessor(max_concurrent_updates=4)
+        events = []
+
+        async def handle(name, delay):
+            events.append(f"{name} start")
+            await asyncio.sleep(delay)
+            events.append(f"{name} end")
+
+        def chat_update(chat_id):
+            chat = Chat(chat_id, Chat.PRIVATE)
+            return Update(chat_id, message=Message(chat_id, datetime.now(timezone.utc), chat))
+
+        await asyncio.gather(
+            processor.process_update(chat_update(1), handle('a1', 0.02)),
+            processor.process_update(chat_update(1), handle('a2', 0)),
+            processor.process_update(chat_update(2), handle('b1', 0)),
+        )
+        return events, processor.chats
+    events, chats = asyncio.run(run())
+    assert events.index('a1 end') < events.index('a2 start')
+    assert events.index('b1 end') < events.index('a1 end')
+    assert chats == {}
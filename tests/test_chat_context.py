@@ -0,0 +1,62 @@
+import logging
+import os
+import pytest
+from marktplaats_gpt.chat_context import ContextRegistry
+
+
+@pytest.fixture
+def context_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'chat-context').write_text("You are selling\nan item.\n")
+    (tmp_path / 'cars.txt').write_text("You are selling a car.\n")
+    return tmp_path
+
+
+def test_from_env_names_contexts(context_files, monkeypatch):
+    monkeypatch.setenv("CHAT_CONTEXTS", "cars=cars.txt, short = chat-context")
+    contexts = ContextRegistry.from_env()
+    assert contexts.names() == ['default', 'cars', 'short']
+    assert contexts.get() == "You are selling an item."
+    assert contexts.get('cars') == "You are selling a car."
+
+
+def test_from_env_refuses_missing_files(context_files, monkeypatch):
+    monkeypatch.setenv("CHAT_CONTEXTS", "cars=cars.txt,boats=boats.txt")
+    with pytest.raises(ValueError, match="boats.txt"):
+        ContextRegistry.from_env()
+
+
+def test_get_raises_for_file_removed_later(context_files):
+    contexts = ContextRegistry({'default': 'chat-context', 'cars': 'cars.txt'})
+    os.remove('cars.txt')
+    with pytest.raises(OSError):
+        contexts.get('cars')
+
+
+def test_get_reloads_changed_file(context_files, caplog):
+    caplog.set_level(logging.INFO)
+    contexts = ContextRegistry({'default': 'chat-context'})
+    assert contexts.get() == "You are selling an item."
+    stat = os.stat('chat-context')
+    (context_files / 'chat-context').write_text("You are buying.\n")
+    os.utime('chat-context', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert contexts.get() == "You are buying."
+    assert "Context default changed" in caplog.text
+
+
+def test_get_reads_unchanged_file_once(context_files, monkeypatch):
+    contexts = ContextRegistry({'default': 'chat-context'})
+    contexts.get()
+    monkeypatch.setattr('marktplaats_gpt.chat_context.load_context', lambda filename: pytest.fail("read again"))
+    assert contexts.get() == "You are selling an item."
+
+
+def test_combine_caches_per_user_and_item():
+    contexts = ContextRegistry(combined_cache_size=2)
+    combined = contexts.combine('alice', 'm1', "Sell.", '{"name": "Bike"}')
+    assert combined == 'Sell.\n{"name": "Bike"}'
+    assert contexts.combine('alice', 'm1', "Sell.", '{"name": "Bike"}') is combined
+    assert contexts.combine('alice', 'm1', "Sell it.", '{"name": "Bike"}') == 'Sell it.\n{"name": "Bike"}'
+    contexts.combine('bob', 'm1', "Sell.", "{}")
+    contexts.combine('carol', 'm1', "Sell.", "{}")
+    assert list(contexts.combined) == [('bob', 'm1'), ('carol', 'm1')]
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import pytest
+from marktplaats_gpt.client_pool import ClientPool
+
+
+class Client:
+    def __init__(self, cookie):
+        self.cookie = cookie
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('marktplaats_gpt.client_pool.time.monotonic', clock)
+    return clock
+
+
+def test_client_is_reused_for_the_same_cookie():
+    pool = ClientPool(Client)
+    with pool.client('alice', 'c1') as first:
+        pass
+    with pool.client('alice', 'c1') as second:
+        assert second is first
+    assert not first.closed
+
+
+def test_busy_client_is_not_shared():
+    pool = ClientPool(Client)
+    with pool.client('alice', 'c1') as first:
+        with pool.client('alice', 'c1') as second:
+            assert second is not first
+    pool.wait_closed()
+    assert first.closed or second.closed # only one of them is kept
+
+
+def test_new_cookie_closes_the_old_client():
+    pool = ClientPool(Client)
+    with pool.client('alice', 'c1') as old:
+        pass
+    with pool.client('alice', 'c2') as new:
+        assert new is not old and new.cookie == 'c2'
+    pool.wait_closed()
+    assert old.closed
+
+
+def test_least_recently_used_client_is_closed():
+    pool = ClientPool(Client, max_size=2)
+    clients = {}
+    for username in ['alice', 'bob', 'carol']:
+        with pool.client(username, 'c') as clients[username]:
+            pass
+    assert list(pool.clients) == ['bob', 'carol']
+    pool.wait_closed()
+    assert clients['alice'].closed and not clients['bob'].closed
+
+
+def test_idle_client_is_closed(clock):
+    pool = ClientPool(Client, idle_seconds=300)
+    with pool.client('alice', 'c') as idle:
+        pass
+    clock.now += 300
+    with pool.client('bob', 'c'):
+        pass
+    pool.wait_closed()
+    assert idle.closed and 'alice' not in pool.clients
+
+
+def test_invalidate_closes_pooled_and_busy_clients():
+    pool = ClientPool(Client)
+    with pool.client('alice', 'c1') as pooled:
+        pass
+    pool.invalidate('alice')
+    pool.wait_closed()
+    assert pooled.closed
+    with pool.client('alice', 'c1') as busy:
+        pool.invalidate('alice')
+        pool.wait_closed()
+        assert not busy.closed
+    pool.wait_closed()
+    assert busy.closed and 'alice' not in pool.clients
+
+
+def test_failing_close_is_logged(caplog):
+    class Broken(Client):
+        def close(self):
+            raise OSError("reset")
+    pool = ClientPool(Broken)
+    with pool.client('alice', 'c1'):
+        pass
+    pool.invalidate('alice')
+    pool.wait_closed()
+    assert "Failed to close Marktplaats client" in caplog.text
+
+
+def test_clients_are_closed_off_the_calling_thread():
+    threads = []
+
+    class Recording(Client):
+        def close(self):
+            threads.append(threading.current_thread())
+            super().close()
+
+    pool = ClientPool(Recording)
+    with pool.client('alice', 'c1'):
+        pass
+    pool.invalidate('alice')
+    pool.wait_closed()
+    assert threads and threads[0] is not threading.current_thread()
+
+
+def test_async_client_is_made_off_the_event_loop():
+    threads = []
+
+    def factory(cookie):
+        threads.append(threading.current_thread())
+        return Client(cookie)
+
+    async def run():
+        pool = ClientPool(factory)
+        async with pool.async_client('alice', 'c1') as first:
+            pass
+        async with pool.async_client('alice', 'c1') as second:
+            assert second is first
+        return pool, first
+
+    pool, client = asyncio.run(run())
+    assert len(threads) == 1 and threads[0] is not threading.current_thread()
+    pool.close_all()
+    assert client.closed and not pool.clients
@@ -0,0 +1,61 @@
+import pytest
+from marktplaats_gpt import db
+from marktplaats_gpt.db import postgres_sql
+
+
+def test_postgres_sql_parameters():
+    assert postgres_sql("SELECT data FROM user_state WHERE user_id=? AND name=?") == "SELECT data FROM user_state WHERE user_id=%s AND name=%s"
+
+
+def test_postgres_sql_keeps_string_literals():
+    assert postgres_sql("SELECT 'why?', 'it''s ?' FROM t WHERE a=?") == "SELECT 'why?', 'it''s ?' FROM t WHERE a=%s"
+    assert postgres_sql("SELECT * FROM t WHERE name LIKE '%x' AND a=?") == "SELECT * FROM t WHERE name LIKE '%%x' AND a=%s"
+
+
+def test_postgres_sql_ddl():
+    sql = postgres_sql("CREATE TABLE IF NOT EXISTS t (id INTEGER PRIMARY KEY, n INTEGER NOT NULL, created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    assert sql == (
+        "CREATE TABLE IF NOT EXISTS t (id BIGSERIAL PRIMARY KEY, n BIGINT NOT NULL,"
+        " created_time TEXT DEFAULT to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS'))"
+    )
+
+
+def test_postgres_sql_rewrites_types_only_in_create_table():
+    assert postgres_sql("SELECT CAST(x AS INTEGER) FROM t") == "SELECT CAST(x AS INTEGER) FROM t"
+
+
+MIGRATIONS = [
+    ["CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, name TEXT NOT NULL)"],
+    ["ALTER TABLE items ADD COLUMN price INTEGER"],
+]
+
+
+def columns(conn):
+    return [column[0] for column in conn.execute("SELECT * FROM items").description]
+
+
+def test_migrate_applies_new_migrations_once(storage):
+    conn = db.connect('migrations.db')
+    db.migrate(conn, MIGRATIONS[:1])
+    with conn:
+        conn.execute("INSERT INTO items (name) VALUES (?)", ('bike',))
+    applied = []
+    db.migrate(conn, MIGRATIONS + [lambda conn: applied.append(conn)])
+    db.migrate(conn, MIGRATIONS + [lambda conn: applied.append(conn)])
+    assert len(applied) == 1
+    assert columns(conn) == ['id', 'name', 'price']
+    assert conn.execute("SELECT name, price FROM items").fetchall() == [('bike', None)]
+
+
+def test_migrate_failure_leaves_previous_version(storage):
+    conn = db.connect('migrations.db')
+
+    def failing(conn):
+        conn.execute("ALTER TABLE items ADD COLUMN price INTEGER")
+        raise RuntimeError("failed half-way")
+
+    with pytest.raises(RuntimeError):
+        db.migrate(conn, MIGRATIONS[:1] + [failing])
+    assert columns(conn) == ['id', 'name']
+    db.migrate(conn, MIGRATIONS)
+    assert columns(conn) == ['id', 'name', 'price']
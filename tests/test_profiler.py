@@ -0,0 +1,31 @@
+import re
+from types import SimpleNamespace
+from marktplaats_gpt.profiler import SUMMARY_MAX_LENGTH, UpdateProfiler
+
+
+def stats(functions):
+    return SimpleNamespace(
+        total_calls=functions,
+        total_tt=functions * 0.001,
+        stats={('bot.py', n, '<listcomp>'): (1, 1, 0.001 * (n + 1), 0.002 * (n + 1), {}) for n in range(functions)},
+    )
+
+
+def summary(functions, top):
+    profiler = UpdateProfiler(top=top)
+    profiler.counter = None
+    return profiler.summary(stats(functions), 60.0)
+
+
+def test_summary_lists_top_functions_by_own_time():
+    lines = summary(20, top=3).split("\n")
+    assert len(lines) == 5
+    assert lines[2].endswith("&lt;listcomp&gt; bot.py:19")
+
+
+def test_summary_is_cut_by_whole_lines_after_escaping():
+    text = summary(500, top=500)
+    assert len(text) <= SUMMARY_MAX_LENGTH
+    assert text.endswith(".py:" + text.rsplit(":", 1)[1])
+    for line in text.split("\n"):
+        assert re.fullmatch(r"([^&<>]|&(lt|gt|amp);)*", line)
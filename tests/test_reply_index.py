@@ -0,0 +1,85 @@
+import pytest
+from marktplaats_gpt.archive_db import ArchiveDB
+from marktplaats_gpt.reply_index import ReplyIndex, best_reply, tokenize
+
+PEER_ID = 1000
+
+
+def save(conversation_id, messages):
+    conv = {'id': conversation_id, 'itemId': 'm1', 'title': 'Bike'}
+    ArchiveDB.save_conversation('alice', conv, {'_embedded': {
+        'otherParticipant': {'id': PEER_ID, 'name': 'Bob'},
+        'mc:message': [
+            {'receivedDate': received_date, 'senderId': PEER_ID if from_peer else 42, 'text': text}
+            for received_date, from_peer, text in messages
+        ],
+    }}, fingerprint=conversation_id)
+
+
+@pytest.fixture
+def archive(sqlite_storage, monkeypatch):
+    # indexes are kept by archive version, which starts over in every test
+    monkeypatch.setattr('marktplaats_gpt.reply_index._indexes', {})
+    ArchiveDB.init_db()
+
+
+def test_reply_pairs_are_in_order_of_questions(archive):
+    save('conversation-a', [
+        ('2023-11-02T10:00:00Z', True, "Is it still available?"),
+        ('2023-11-02T10:05:00Z', False, "Sorry, it's sold."),
+    ])
+    save('conversation-b', [
+        ('2023-11-01T10:00:00Z', True, "Is it still available?"),
+        ('2023-11-01T10:05:00Z', False, "Yes, it is."),
+        ('2023-11-01T10:06:00Z', False, "Come and see it."),
+        ('2023-11-01T11:00:00Z', True, "Thanks"),
+    ])
+
+    assert ArchiveDB.get_reply_pairs('alice') == [
+        ("Is it still available?", "Yes, it is."),
+        ("Is it still available?", "Sorry, it's sold."),
+    ]
+    # duplicate questions keep the latest reply
+    similarity, question, reply = best_reply('alice', "is it still available")
+    assert reply == "Sorry, it's sold."
+
+
+def test_tokenize_folds_case_and_accents():
+    assert tokenize("Is de fiets nog béschikbaar? Ja!") == ['is', 'de', 'fiets', 'nog', 'beschikbaar', 'ja']
+
+
+def test_match_prefers_rare_terms():
+    index = ReplyIndex([
+        ("Is the bike still available?", "Yes"),
+        ("Is the price negotiable?", "No, fixed price"),
+        ("Can you deliver the bike?", "Only pick up"),
+    ])
+    similarity, question, reply = index.match("price negotiable")
+    assert reply == "No, fixed price" and 0 < similarity < 1
+    assert index.match("Can you deliver the bike?")[0] == pytest.approx(1.0)
+    assert index.match("hallo") is None
+    assert ReplyIndex([]).match("anything") is None
+
+
+def test_same_words_are_indexed_once_with_latest_reply():
+    index = ReplyIndex([("Still available?", "Yes"), ("still AVAILABLE", "Sold")])
+    assert index.pairs == [("still AVAILABLE", "Sold")]
+
+
+def test_best_reply_threshold_and_reindexing(archive, monkeypatch):
+    save('conversation-a', [
+        ('2023-11-01T10:00:00Z', True, "Is the bike still available?"),
+        ('2023-11-01T10:05:00Z', False, "Yes, it is."),
+    ])
+    assert best_reply('alice', "is the bike available")[2] == "Yes, it is."
+    assert best_reply('alice', "do you deliver") is None
+    monkeypatch.setenv("REPLY_MATCH_THRESHOLD", "0.99")
+    assert best_reply('alice', "is the bike available") is None
+    assert best_reply('alice', "is the bike available", threshold=0.5) is not None
+
+    save('conversation-b', [
+        ('2023-11-02T10:00:00Z', True, "Do you deliver?"),
+        ('2023-11-02T10:05:00Z', False, "Only pick up."),
+    ])
+    assert best_reply('alice', "do you deliver")[2] == "Only pick up."
+    assert best_reply('bob', "do you deliver") is None
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import pytest
+from marktplaats_gpt import scraping
+from marktplaats_gpt.scraping import ItemParserPool, parse_item_page
+
+PAGE = """<html><body>
+<script type="application/ld+json">{"@type": "BreadcrumbList"}</script>
+<script type="application/ld+json">{"@type": "Product", "name": "Bike", "description": "Short",
+    "offers": {"price": "120.00", "priceCurrency": "EUR"}}</script>
+<div class="Description-description" data-collapsable="description"><p>Blue bike,</p><p>new tyres</p></div>
+</body></html>"""
+
+
+class OneWorkerExecutor(scraping.ProcessPoolExecutor):
+    def __init__(self, max_workers, **kwargs):
+        super().__init__(max_workers=1, **kwargs)
+
+
+def test_parse_item_page_takes_the_product_and_full_description():
+    item = json.loads(parse_item_page(PAGE, 'm1', 'https://www.marktplaats.nl/m1'))
+    assert item == {"name": "Bike", "description": "Blue bike, new tyres", "price": "120.00", "priceCurrency": "EUR"}
+
+
+def test_parse_item_page_keeps_short_description_without_div():
+    page = PAGE.replace('Description-description', 'Other')
+    assert json.loads(parse_item_page(page, 'm1', 'url'))["description"] == "Short"
+
+
+def test_parse_item_page_without_product():
+    assert parse_item_page("<html><body><p>Gone</p></body></html>", 'm1', 'url') is None
+    broken = '<script type="application/ld+json">{"@type": "Product"}</script>'
+    assert parse_item_page(broken, 'm1', 'url') is None
+
+
+def test_parser_pool_without_workers_parses_on_threads():
+    pool = ItemParserPool(workers=0)
+    pool.start()
+    assert pool.executor is None
+    assert json.loads(asyncio.run(pool.parse(PAGE, 'm1', 'url')))["name"] == "Bike"
+    pool.stop()
+
+
+def test_parser_pool_warms_up_every_worker():
+    pool = ItemParserPool(workers=2)
+    pool.start()
+    try:
+        assert len(pool.executor._processes) == 2
+        assert json.loads(asyncio.run(pool.parse(PAGE, 'm1', 'url')))["name"] == "Bike"
+    finally:
+        pool.stop()
+    assert pool.executor is None
+
+
+def test_parser_pool_gives_up_when_a_worker_is_not_warmed_up(monkeypatch):
+    monkeypatch.setattr(scraping, 'WARM_UP_TIMEOUT', 0.5)
+    pool = ItemParserPool(workers=2)
+    # a single warm worker must not be taken for all of them
+    monkeypatch.setattr(scraping, 'ProcessPoolExecutor', OneWorkerExecutor)
+    with pytest.raises(Exception):
+        pool.start()
+    assert pool.executor is None
+    pool.stop()
@@ -0,0 +1,143 @@
+from datetime import date, timedelta
+import pytest
+from marktplaats_gpt.db import connect, migrate, utc_timestamp
+from marktplaats_gpt.openai_pricing import openai_cost_micro_usd
+from marktplaats_gpt.sessions_db import DB_FILE, MIGRATIONS, SessionDB
+
+MODEL = 'gpt-3.5-turbo-1106'
+
+
+@pytest.fixture
+def sessions_db(sqlite_storage):
+    SessionDB.init_db()
+
+
+def day(days_ago):
+    return (date.fromisoformat(utc_timestamp()[:10]) - timedelta(days=days_ago)).isoformat()
+
+
+def start(username, created_time):
+    return (username, created_time, None, None, None, None)
+
+
+def request(username, created_time, prompt_tokens=1000, completion_tokens=500):
+    return (username, created_time, MODEL, prompt_tokens, completion_tokens, openai_cost_micro_usd(MODEL, prompt_tokens, completion_tokens))
+
+
+def test_compact_rolls_old_days_into_daily_rows(sessions_db):
+    SessionDB.write_batch([
+        start('alice', f"{day(5)} 10:00:00"),
+        request('alice', f"{day(5)} 10:01:00"),
+        request('alice', f"{day(5)} 10:02:00"),
+        start('alice', f"{day(1)} 10:00:00"),
+    ])
+
+    assert SessionDB.compact(older_than_days=2) == {'days': 1, 'rows': 3}
+
+    daily = {row['model']: row for row in SessionDB.get_daily(username='alice')}
+    assert daily[None]['rows_count'] == 1
+    assert daily[MODEL]['rows_count'] == 2
+    assert daily[MODEL]['cost_micro_usd'] == 2 * openai_cost_micro_usd(MODEL, 1000, 500)
+    assert len(SessionDB.get_all_for_user('alice')) == 1
+    assert SessionDB.get_usage('alice')['requests'] == 2
+
+
+def test_compact_keeps_session_running_at_cutoff_whole(sessions_db):
+    SessionDB.write_batch([
+        start('alice', f"{day(4)} 09:00:00"),
+        start('alice', f"{day(3)} 23:30:00"),
+        request('alice', f"{day(3)} 23:45:00"),
+        request('alice', f"{day(2)} 00:10:00"),
+        start('bob', f"{day(3)} 23:30:00"),
+        request('bob', f"{day(3)} 23:45:00"),
+        start('bob', f"{day(2)} 00:10:00"),
+    ])
+
+    assert SessionDB.compact(older_than_days=2) == {'days': 2, 'rows': 3}
+
+    sessions = SessionDB.get_sessions_page(username='alice')
+    assert [(s['start_time'], s['requests_count'], s['compacted']) for s in sessions] == [
+        (f"{day(3)} 23:30:00", 2, False),
+        (f"{day(4)} 09:00:00", 0, True),
+    ]
+    assert sessions[0]['cost_micro_usd'] == 2 * openai_cost_micro_usd(MODEL, 1000, 500)
+    # bob's session ended before the cutoff, it's compacted
+    assert len(SessionDB.get_all_for_user('bob')) == 1
+
+
+def test_requests_of_unpriced_models_are_counted_apart(sessions_db):
+    SessionDB.write_batch([
+        start('alice', utc_timestamp(600)),
+        request('alice', utc_timestamp(500)),
+        ('alice', utc_timestamp(400), 'gpt-5-unknown', 1000, 500, 0),
+    ])
+
+    session, = SessionDB.get_sessions_page(username='alice')
+    assert session['requests_count'] == 2
+    assert session['unpriced_count'] == 1
+    assert session['cost_micro_usd'] == openai_cost_micro_usd(MODEL, 1000, 500)
+
+    user, = SessionDB.get_users_page()
+    assert user['unpriced_count'] == 1
+    assert user['cost_micro_usd'] == openai_cost_micro_usd(MODEL, 1000, 500)
+
+
+def test_compact_counts_unpriced_requests_apart(sessions_db):
+    SessionDB.write_batch([
+        start('alice', f"{day(5)} 10:00:00"),
+        request('alice', f"{day(5)} 10:01:00"),
+        ('alice', f"{day(5)} 10:02:00", 'gpt-4', 1000, 500, 0),
+    ])
+
+    assert SessionDB.compact(older_than_days=2) == {'days': 1, 'rows': 3}
+
+    daily = {row['model']: row for row in SessionDB.get_daily(username='alice')}
+    assert (daily['gpt-4']['unpriced_count'], daily['gpt-4']['cost_micro_usd']) == (1, 0)
+    assert daily[MODEL]['unpriced_count'] == 0
+    session, = SessionDB.get_sessions_page(username='alice')
+    assert (session['requests_count'], session['unpriced_count']) == (2, 1)
+    assert session['cost_micro_usd'] == openai_cost_micro_usd(MODEL, 1000, 500)
+    user, = SessionDB.get_users_page(from_seconds=3600 * 24 * 7)
+    assert (user['requests_count'], user['unpriced_count']) == (2, 1)
+
+
+def test_compact_doesnt_count_days_whose_rows_are_all_kept(sessions_db):
+    SessionDB.write_batch([
+        start('alice', f"{day(3)} 23:30:00"),
+        request('alice', f"{day(2)} 00:10:00"),
+    ])
+
+    assert SessionDB.compact(older_than_days=2) == {'days': 0, 'rows': 0}
+    assert SessionDB.get_daily() == []
+
+
+def test_only_compaction_with_full_vacuum_switches_to_incremental_vacuum(sessions_db):
+    SessionDB.write_batch([start('alice', f"{day(5)} 10:00:00"), start('alice', f"{day(4)} 10:00:00")])
+    auto_vacuum = lambda: connect(DB_FILE).execute("PRAGMA auto_vacuum").fetchone()[0]
+
+    assert SessionDB.compact(older_than_days=5) == {'days': 0, 'rows': 0}
+    assert SessionDB.compact(older_than_days=4) == {'days': 1, 'rows': 1}
+    assert auto_vacuum() == 0
+
+    SessionDB.compact(older_than_days=2, full_vacuum=True)
+    assert auto_vacuum() == 2
+
+
+def test_usage_ledger_backfill_counts_unpriced_requests_without_cost(sqlite_storage, caplog):
+    conn = connect(DB_FILE)
+    migrate(conn, MIGRATIONS[:1])
+    with conn:
+        conn.executemany(
+            "INSERT INTO user_sessions (username, model, prompt_tokens, completion_tokens) VALUES (?,?,?,?)",
+            [('alice', None, None, None), ('alice', 'gpt-4', 1000, 500), ('alice', MODEL, 1000, 500)]
+        )
+
+    SessionDB.init_db()
+
+    assert SessionDB.get_usage('alice') == {
+        'requests': 2,
+        'prompt_tokens': 2000,
+        'completion_tokens': 1000,
+        'cost_micro_usd': openai_cost_micro_usd(MODEL, 1000, 500),
+    }
+    assert "costs of 1 requests of models without a price" in caplog.text
@@ -0,0 +1,101 @@
+"""
+refresh_conversations puts states into private parts of python-telegram-bot's ConversationHandler,
+these tests run it against the real handler so that an upgrade breaking it fails them.
+"""
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+from telegram import Bot, Chat, Message, Update, User
+from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters
+from marktplaats_gpt.state_db import SharedStatePersistence, StateDB, refresh_conversations
+
+CONVERSATION, SUGGESTION = range(2)
+
+
+class OfflineBot(Bot):
+    async def get_me(self, *args, **kwargs):
+        return User(id=1, first_name='Test', is_bot=True, username='test_bot')
+
+
+async def callback(update, context):
+    pass
+
+
+@pytest.fixture
+def application(sqlite_storage):
+    StateDB.init_db()
+    application = ApplicationBuilder().bot(OfflineBot(token='0:test')).updater(None).persistence(SharedStatePersistence()).build()
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("start", callback)],
+        states={
+            CONVERSATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, callback)],
+            SUGGESTION: [CommandHandler("send", callback)],
+        },
+        fallbacks=[],
+        name="conversation",
+        persistent=True,
+    ))
+    asyncio.run(application.initialize())
+    yield application
+    asyncio.run(application.shutdown())
+
+
+def message_update(text, user_id=1):
+    user = User(user_id, "Alice", False)
+    message = Message(1, datetime.now(timezone.utc), Chat(user_id, Chat.PRIVATE), from_user=user, text=text)
+    return Update(1, message=message)
+
+
+def state_of(application, update):
+    """State of the update's conversation as the handler sees it, None if it doesn't handle the update."""
+    handler, = application.handlers[0]
+    check = handler.check_update(update)
+    return check[0] if check else None
+
+
+def refresh(application, update):
+    asyncio.run(refresh_conversations(update, SimpleNamespace(application=application)))
+
+
+def test_conversation_handler_still_has_the_private_parts_used(application):
+    handler, = application.handlers[0]
+    assert callable(getattr(handler, '_get_key', None)), \
+        "ConversationHandler._get_key is gone, refresh_conversations can't key conversations, see the pinned version"
+    conversations = getattr(handler, '_conversations', None)
+    assert callable(getattr(conversations, 'update_no_track', None)) and isinstance(getattr(conversations, 'data', None), dict), \
+        "ConversationHandler._conversations changed, refresh_conversations can't put states into it, see the pinned version"
+
+
+def test_refresh_puts_stored_state_into_handler(application):
+    update = message_update("hello")
+    assert state_of(application, update) is None
+
+    StateDB.set_conversation("conversation", (1, 1), CONVERSATION)
+    refresh(application, update)
+    assert state_of(application, update) == CONVERSATION
+
+    StateDB.set_conversation("conversation", (1, 1), SUGGESTION)
+    refresh(application, message_update("/send"))
+    assert state_of(application, message_update("hello")) is None
+
+
+def test_refresh_drops_state_ended_elsewhere(application):
+    update = message_update("hello")
+    StateDB.set_conversation("conversation", (1, 1), CONVERSATION)
+    refresh(application, update)
+
+    StateDB.set_conversation("conversation", (1, 1), None)
+    refresh(application, update)
+    assert state_of(application, update) is None
+
+
+def test_refresh_keeps_other_conversations(application):
+    StateDB.set_conversation("conversation", (1, 1), CONVERSATION)
+    StateDB.set_conversation("conversation", (2, 2), CONVERSATION)
+    refresh(application, message_update("hello", user_id=1))
+    refresh(application, message_update("hello", user_id=2))
+
+    StateDB.set_conversation("conversation", (2, 2), None)
+    refresh(application, message_update("hello", user_id=2))
+    assert state_of(application, message_update("hello", user_id=1)) == CONVERSATION
@@ -0,0 +1,88 @@
+"""Operations of the DB classes, on SQLite and, with STORAGE_URL of a Postgres server, on Postgres."""
+import pytest
+from marktplaats_gpt.db import utc_timestamp
+from marktplaats_gpt.openai_pricing import openai_cost_micro_usd
+from marktplaats_gpt.sessions_db import SessionDB
+from marktplaats_gpt.state_db import StateDB
+from marktplaats_gpt.users_db import UserDB
+
+MODEL = 'gpt-3.5-turbo-1106'
+
+
+@pytest.fixture
+def databases(storage):
+    UserDB.init_db()
+    SessionDB.init_db()
+    StateDB.init_db()
+    # migrations run again are no-ops
+    UserDB.init_db()
+    SessionDB.init_db()
+    StateDB.init_db()
+
+
+def test_user_settings(databases):
+    assert UserDB.get('alice', 'status') is None
+    UserDB.set('alice', 'status', 'active')
+    UserDB.set('alice', 'openai-quota', '2.5')
+    UserDB.set('alice', 'status', 'blocked')
+    assert UserDB.get('alice', 'status') == 'blocked'
+    assert {key: setting['value'] for key, setting in UserDB.get_all('alice').items()} == {'status': 'blocked', 'openai-quota': '2.5'}
+
+    UserDB.delete('alice', 'status')
+    assert UserDB.get('alice', 'status') is None
+
+
+def test_sessions_and_usage(databases):
+    cost = openai_cost_micro_usd(MODEL, 1000, 500)
+    SessionDB.write_batch([
+        ('alice', utc_timestamp(600), None, None, None, None),
+        ('alice', utc_timestamp(500), MODEL, 1000, 500, cost),
+        ('bob', utc_timestamp(400), None, None, None, None),
+    ])
+    SessionDB.use('alice', MODEL, 1000, 500)
+    SessionDB.create('bob')
+
+    assert SessionDB.get_usage('alice') == {'requests': 2, 'prompt_tokens': 2000, 'completion_tokens': 1000, 'cost_micro_usd': 2 * cost}
+    assert SessionDB.get_usage('carol')['cost_micro_usd'] == 0
+
+    sessions = SessionDB.get_sessions_page(username='alice')
+    assert len(sessions) == 1
+    assert sessions[0]['requests_count'] == 2
+    assert sessions[0]['cost_micro_usd'] == 2 * cost
+    assert len(SessionDB.get_sessions_page(from_seconds=3600)) == 3
+    assert len(SessionDB.get_sessions_page(limit=2, offset=2)) == 1
+
+    users = {user['username']: user for user in SessionDB.get_users_page()}
+    assert users['alice']['requests_count'] == 2
+    assert users['bob']['cost_micro_usd'] == 0
+
+
+def test_compaction(databases):
+    cost = openai_cost_micro_usd(MODEL, 1000, 500)
+    SessionDB.write_batch([
+        ('alice', utc_timestamp(3600*24*5), None, None, None, None),
+        ('alice', utc_timestamp(3600*24*5 - 60), MODEL, 1000, 500, cost),
+        ('alice', utc_timestamp(60), None, None, None, None),
+    ])
+
+    assert SessionDB.compact(older_than_days=2)['rows'] == 2
+
+    sessions = SessionDB.get_sessions_page(username='alice')
+    assert [session['compacted'] for session in sessions] == [False, True]
+    assert sessions[1]['cost_micro_usd'] == cost
+    assert SessionDB.get_usage('alice')['cost_micro_usd'] == cost
+
+
+def test_state(databases):
+    assert StateDB.get_user_data(1) is None
+    StateDB.set_user_data(1, {'marktplaats_conversation_id': 'abc?'})
+    StateDB.set_user_data(1, {'marktplaats_conversation_id': '100%'})
+    assert StateDB.get_user_data(1) == {'marktplaats_conversation_id': '100%'}
+    StateDB.delete_user_data(1)
+    assert StateDB.get_user_data(1) is None
+
+    StateDB.set_conversation('conversation', (1, 1), 0)
+    StateDB.set_conversation('conversation', (2, 2), 1)
+    assert StateDB.get_conversation('conversation', (1, 1)) == 0
+    StateDB.set_conversation('conversation', (1, 1), None)
+    assert StateDB.get_conversations('conversation') == {(2, 2): 1}
@@ -0,0 +1,97 @@
+import pytest
+from marktplaats_gpt.openai_pricing import openai_cost_micro_usd
+from marktplaats_gpt.sessions_db import SessionDB
+from marktplaats_gpt.write_buffer import SessionWriteBuffer
+
+
+@pytest.fixture
+def buffer(sqlite_storage):
+    SessionDB.init_db()
+    buffer = SessionWriteBuffer(flush_interval_ms=60000, max_rows=1000, max_attempts=3)
+    yield buffer
+    buffer.stop()
+
+
+def test_flush_writes_events_and_usage(buffer):
+    buffer.create('alice')
+    buffer.use('alice', 'gpt-3.5-turbo-1106', 1000, 500)
+    buffer.flush()
+
+    assert len(SessionDB.get_all_for_user('alice')) == 2
+    assert SessionDB.get_usage('alice')['requests'] == 1
+    assert buffer.pending_cost_micro_usd('alice') == 0
+
+
+def test_cost_counts_pending_and_stored_usage(buffer):
+    cost = openai_cost_micro_usd('gpt-3.5-turbo-1106', 1000, 500)
+    buffer.use('alice', 'gpt-3.5-turbo-1106', 1000, 500)
+    assert buffer.cost_micro_usd('alice') == cost
+
+    buffer.flush()
+    buffer.use('alice', 'gpt-3.5-turbo-1106', 1000, 500)
+    assert buffer.cost_micro_usd('alice') == 2 * cost
+
+
+def test_cost_doesnt_miss_batch_written_between_reads(buffer, monkeypatch):
+    cost = openai_cost_micro_usd('gpt-3.5-turbo-1106', 1000, 500)
+    buffer.use('alice', 'gpt-3.5-turbo-1106', 1000, 500)
+    reads = []
+
+    def flushing_after_first_read(read):
+        def wrapper(username):
+            result = read(username)
+            reads.append(read)
+            if len(reads) == 1:
+                buffer.flush()
+            return result
+        return wrapper
+
+    monkeypatch.setattr(SessionDB, 'get_usage', flushing_after_first_read(SessionDB.get_usage))
+    monkeypatch.setattr(buffer, 'pending_cost_micro_usd', flushing_after_first_read(buffer.pending_cost_micro_usd))
+    assert buffer.cost_micro_usd('alice') >= cost
+    assert len(reads) == 2
+
+
+def test_failed_batch_is_retried_apart_from_newer_events(buffer, monkeypatch):
+    write_batch = SessionDB.write_batch
+
+    def failing_for_bob(events):
+        if any(username == 'bob' for username, *_ in events):
+            raise RuntimeError("disk full")
+        write_batch(events)
+
+    monkeypatch.setattr(SessionDB, 'write_batch', failing_for_bob)
+    buffer.use('bob', 'gpt-3.5-turbo-1106', 1000, 500)
+    buffer.flush()
+    buffer.use('alice', 'gpt-3.5-turbo-1106', 1000, 500)
+    buffer.flush()
+
+    assert SessionDB.get_usage('alice')['requests'] == 1
+    assert [attempts for _, attempts in buffer.failed] == [2]
+
+
+def test_failed_batch_is_dropped_after_max_attempts(buffer, monkeypatch, caplog):
+    def failing(events):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(SessionDB, 'write_batch', failing)
+    buffer.use('bob', 'gpt-3.5-turbo-1106', 1000, 500)
+    for _ in range(3):
+        buffer.flush()
+
+    assert buffer.failed == []
+    assert "Dropped session event ('bob'" in caplog.text
+    # the money was spent, quota checks keep counting it
+    assert buffer.pending_cost_micro_usd('bob') > 0
+
+
+def test_unpriced_returned_model_is_recorded_at_requested_model_price(buffer):
+    buffer.use('alice', 'gpt-3.5-turbo-2024-snapshot', 1000, 500, requested_model='gpt-3.5-turbo-1106')
+    buffer.use('alice', 'gpt-5-unknown', 1000, 500)
+    buffer.flush()
+
+    assert [session['model'] for session in SessionDB.get_all_for_user('alice').values()] == ['gpt-3.5-turbo-2024-snapshot', 'gpt-5-unknown']
+    usage = SessionDB.get_usage('alice')
+    assert usage['requests'] == 2
+    assert usage['cost_micro_usd'] == openai_cost_micro_usd('gpt-3.5-turbo-1106', 1000, 500)
+    assert SessionDB.get_users_page()[0]['unpriced_count'] == 2